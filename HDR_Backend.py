@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+
+"""
+Fused Per-Pixel Kernels
+=======================
+
+The numba compute backend of HDR_ISOGainMap.py (--backend numba). The numpy
+strip stages in HDR_ISOGainMap.py are the reference backend; this module is
+imported only when numba is selected, so numba stays an optional dependency.
+
+MODEL:
+------
+- pass1() is pass 1 of one strip as a single loop over its pixels: PQ code
+  to nits by table, 3D LUT (trilinear or tetrahedral) on the codes, SDR
+  store (float32, or fixed16 codes), sRGB decode, both Rec.709 luminances
+  and their ratio. Per row block it keeps the ratio maximum, the PQ code
+  counts (the nits sketch) and the ratio sketch, summed after the loop.
+- pass2() is the full-resolution pass 2 of one strip: both decodes, per-channel
+  gain and normalization by the headroom, plus the log2 luminance gain for
+  --container ultrahdr, in one loop; then numpy's power ufunc for the gamma
+  and a second loop for the channel mean and the 8-bit code.
+- The gain map cannot be encoded in pass 1: its normalization needs the
+  headroom, a maximum over every pixel. So the two passes stay; what goes
+  away are the full-strip numpy temporaries between their steps.
+
+Row blocks run in parallel (numba.prange) on set_threads() threads. The
+kernels repeat the reference's float32 operations in the reference's order.
+numpy's SIMD powf (AVX-512 builds) and libm's, which numba calls, round one
+input in five differently, so the gamma is left to numpy: with a fixed16 SDR
+base, decoded by the shared table, the outputs are identical to the numpy
+backend (test_HDR_Backend.py). A float32 base still decodes sRGB with libm
+powf, so a gain map code may differ by one (HDR_Benchmark.py --backend times
+both and checks its BACKEND_TOLERANCE); with --composite-lut it decodes it
+from the baked composite_decode_table instead, about four times cheaper per
+value than powf and within COMPOSITE_TOLERANCE of it. Compiled kernels are cached in
+__pycache__.
+"""
+
+# ============================================================================
+# IMPORTS
+# ============================================================================
+
+import threading
+
+import numba
+import numpy as np
+
+
+# The default workqueue threading layer cannot run two parallel kernels at
+# once, so launches from several threads (read-ahead pipeline, server) queue
+_LAUNCH_LOCK = threading.Lock()
+
+
+def set_threads(count):
+    """Threads per kernel launch, e.g. the cores per worker of a -j pool."""
+    numba.set_num_threads(max(1, min(int(count), numba.config.NUMBA_NUM_THREADS)))
+
+
+# ============================================================================
+# PER-PIXEL HELPERS
+# ============================================================================
+
+@numba.njit(inline="always")
+def _luminance(b, g, r):
+    # Same operation order as luminance_bgr in HDR_ISOGainMap
+    lum = r * np.float32(0.2126)
+    lum += g * np.float32(0.7152)
+    lum += b * np.float32(0.0722)
+    return lum
+
+
+@numba.njit(inline="always")
+def _srgb_nits(value):
+    # sRGB EOTF scaled to SDR white (203 nits), as srgb_to_absolute_nits
+    if value <= np.float32(0.04045):
+        linear = value / np.float32(12.92)
+    else:
+        linear = ((value + np.float32(0.055)) / np.float32(1.055)) ** np.float32(2.4)
+    return linear * np.float32(203.0)
+
+
+@numba.njit(inline="always")
+def _srgb_nits_baked(value, table, slopes):
+    # composite_decode_table: linear interpolation between the baked nodes
+    position = value * np.float32(slopes.shape[0])
+    index = min(np.intp(position), slopes.shape[0] - 1)
+    return table[index] + slopes[index] * (position - np.float32(index))
+
+
+@numba.njit(inline="always")
+def _clip01(value):
+    return min(max(value, np.float32(0.0)), np.float32(1.0))
+
+
+@numba.njit(inline="always")
+def _lut_corner(scale, c0, c1, c2, size):
+    # _lut_cell_coords for one pixel of uint16 codes
+    s0 = np.float32(c0) * scale
+    s1 = np.float32(c1) * scale
+    s2 = np.float32(c2) * scale
+    b0 = min(np.int32(s0), size - 2)
+    b1 = min(np.int32(s1), size - 2)
+    b2 = min(np.int32(s2), size - 2)
+    return (b0 * size + b1) * size + b2, s0 - np.float32(b0), s1 - np.float32(b1), s2 - np.float32(b2)
+
+
+@numba.njit(inline="always")
+def _trilinear(lut, i, fx, fy, fz, size, k):
+    # _interp_trilinear: fastest axis first, then the other two
+    s0 = size * size
+    s1 = size
+    c00 = lut[i, k]
+    c00 += (lut[i + 1, k] - c00) * fz
+    c01 = lut[i + s1, k]
+    c01 += (lut[i + s1 + 1, k] - c01) * fz
+    c10 = lut[i + s0, k]
+    c10 += (lut[i + s0 + 1, k] - c10) * fz
+    c11 = lut[i + s0 + s1, k]
+    c11 += (lut[i + s0 + s1 + 1, k] - c11) * fz
+    c00 += (c01 - c00) * fy
+    c10 += (c11 - c10) * fy
+    c00 += (c10 - c00) * fx
+    return c00
+
+
+@numba.njit(inline="always")
+def _tetrahedral_walk(i, f0, f1, f2, size):
+    # _interp_tetrahedral: axes by descending fraction, ties in axis order
+    # (argsort kind='stable'); returns the two inner vertices and the sorted fractions
+    o0, o1, o2 = 0, 1, 2
+    g0, g1, g2 = f0, f1, f2
+    if g1 > g0:
+        o0, o1 = o1, o0
+        g0, g1 = g1, g0
+    if g2 > g1:
+        o1, o2 = o2, o1
+        g1, g2 = g2, g1
+    if g1 > g0:
+        o0, o1 = o1, o0
+        g0, g1 = g1, g0
+    strides = (size * size, size, 1)
+    v1 = i + strides[o0]
+    v2 = v1 + strides[o1]
+    return v1, v2, g0, g1, g2
+
+
+@numba.njit(inline="always")
+def _tetrahedral(lut, i, v1, v2, v3, g0, g1, g2, k):
+    out = lut[i, k] * (np.float32(1.0) - g0)
+    out += lut[v1, k] * (g0 - g1)
+    out += lut[v2, k] * (g1 - g2)
+    out += lut[v3, k] * g2
+    return out
+
+
+# ============================================================================
+# KERNELS
+# ============================================================================
+
+@numba.njit(parallel=True, cache=True, error_model="numpy")
+def _pass1_kernel(pq, pq_nits, lut, size, tetrahedral, sdr, fixed_point, srgb_nits, baked, decode_table,
+                  decode_slopes, histogram_origin, bins_per_stop, code_counts, ratio_counts, block_max):
+    height, width = pq.shape[0], pq.shape[1]
+    blocks = block_max.shape[0]
+    bins = ratio_counts.shape[1]
+    scale = np.float32((size - 1) / 65535.0)
+    far = size * size + size + 1
+    for block in numba.prange(blocks):
+        ratio_max = np.float32(0.0)
+        for y in range(block * height // blocks, (block + 1) * height // blocks):
+            for x in range(width):
+                c0, c1, c2 = pq[y, x, 0], pq[y, x, 1], pq[y, x, 2]
+                code_counts[block, c0] += 1
+                code_counts[block, c1] += 1
+                code_counts[block, c2] += 1
+
+                i, f0, f1, f2 = _lut_corner(scale, c0, c1, c2, size)
+                if tetrahedral:
+                    v1, v2, g0, g1, g2 = _tetrahedral_walk(i, f0, f1, f2, size)
+                    out0 = _tetrahedral(lut, i, v1, v2, i + far, g0, g1, g2, 0)
+                    out1 = _tetrahedral(lut, i, v1, v2, i + far, g0, g1, g2, 1)
+                    out2 = _tetrahedral(lut, i, v1, v2, i + far, g0, g1, g2, 2)
+                else:
+                    out0 = _trilinear(lut, i, f0, f1, f2, size, 0)
+                    out1 = _trilinear(lut, i, f0, f1, f2, size, 1)
+                    out2 = _trilinear(lut, i, f0, f1, f2, size, 2)
+                out0, out1, out2 = _clip01(out0), _clip01(out1), _clip01(out2)
+
+                # store_sdr, then decode what was stored, as the reference does
+                if fixed_point:
+                    q0 = np.uint16(out0 * np.float32(65535.0) + np.float32(0.5))
+                    q1 = np.uint16(out1 * np.float32(65535.0) + np.float32(0.5))
+                    q2 = np.uint16(out2 * np.float32(65535.0) + np.float32(0.5))
+                    sdr[y, x, 0], sdr[y, x, 1], sdr[y, x, 2] = q0, q1, q2
+                    lum_sdr = _luminance(srgb_nits[q0], srgb_nits[q1], srgb_nits[q2])
+                elif baked:
+                    sdr[y, x, 0], sdr[y, x, 1], sdr[y, x, 2] = out0, out1, out2
+                    lum_sdr = _luminance(_srgb_nits_baked(out0, decode_table, decode_slopes),
+                                         _srgb_nits_baked(out1, decode_table, decode_slopes),
+                                         _srgb_nits_baked(out2, decode_table, decode_slopes))
+                else:
+                    sdr[y, x, 0], sdr[y, x, 1], sdr[y, x, 2] = out0, out1, out2
+                    lum_sdr = _luminance(_srgb_nits(out0), _srgb_nits(out1), _srgb_nits(out2))
+
+                lum_hdr = _luminance(pq_nits[c0], pq_nits[c1], pq_nits[c2])
+                ratio = lum_hdr / max(lum_sdr, np.float32(1e-6))
+                ratio_max = max(ratio_max, ratio)
+
+                # log_histogram_add for one value
+                position = (np.log2(ratio) - np.float32(histogram_origin)) * np.float32(bins_per_stop)
+                position = min(max(position, np.float32(0.0)), np.float32(bins - 1))
+                ratio_counts[block, np.intp(position)] += 1
+        block_max[block] = ratio_max
+
+
+@numba.njit(parallel=True, cache=True, error_model="numpy")
+def _pass2_kernel(pq, pq_nits, sdr, fixed_point, srgb_nits, baked, decode_table, decode_slopes,
+                  headroom_range, gains, log_gain, with_log_gain, log_gain_scale, log_gain_offset):
+    height, width = pq.shape[0], pq.shape[1]
+    for y in numba.prange(height):
+        for x in range(width):
+            h0, h1, h2 = pq_nits[pq[y, x, 0]], pq_nits[pq[y, x, 1]], pq_nits[pq[y, x, 2]]
+            if fixed_point:
+                s0 = srgb_nits[np.intp(sdr[y, x, 0])]
+                s1 = srgb_nits[np.intp(sdr[y, x, 1])]
+                s2 = srgb_nits[np.intp(sdr[y, x, 2])]
+            elif baked:
+                s0 = _srgb_nits_baked(np.float32(sdr[y, x, 0]), decode_table, decode_slopes)
+                s1 = _srgb_nits_baked(np.float32(sdr[y, x, 1]), decode_table, decode_slopes)
+                s2 = _srgb_nits_baked(np.float32(sdr[y, x, 2]), decode_table, decode_slopes)
+            else:
+                s0 = _srgb_nits(np.float32(sdr[y, x, 0]))
+                s1 = _srgb_nits(np.float32(sdr[y, x, 1]))
+                s2 = _srgb_nits(np.float32(sdr[y, x, 2]))
+
+            # encode_gain_map: gain, normalize, clip (gamma and mean follow)
+            gains[y, x, 0] = _clip01((h0 / max(s0, np.float32(1e-6)) - np.float32(1.0)) / headroom_range)
+            gains[y, x, 1] = _clip01((h1 / max(s1, np.float32(1e-6)) - np.float32(1.0)) / headroom_range)
+            gains[y, x, 2] = _clip01((h2 / max(s2, np.float32(1e-6)) - np.float32(1.0)) / headroom_range)
+
+            if with_log_gain:
+                hdr = _luminance(h0, h1, h2) * log_gain_scale + log_gain_offset
+                sdr_lum = _luminance(s0, s1, s2) * log_gain_scale + log_gain_offset
+                log_gain[y, x] = np.log2(hdr / sdr_lum)
+
+
+@numba.njit(parallel=True, cache=True, error_model="numpy")
+def _gain_code_kernel(gains, gain_map):
+    # encode_gain_ratio's channel mean and 8-bit code
+    height, width = gains.shape[0], gains.shape[1]
+    for y in numba.prange(height):
+        for x in range(width):
+            mean = (gains[y, x, 0] + gains[y, x, 1] + gains[y, x, 2]) / np.float32(3.0)
+            gain_map[y, x] = np.uint8(mean * np.float32(255.0))
+
+
+# ============================================================================
+# STRIP ENTRY POINTS
+# ============================================================================
+
+def _decode_arrays(srgb_decode):
+    # Typed placeholders keep one compiled signature with and without a table
+    if srgb_decode is None:
+        return np.zeros(2, dtype=np.float32), np.zeros(1, dtype=np.float32)
+    return srgb_decode
+
+
+def pass1(image_pq_u16, pq_table, srgb_table, lut_3d, tetrahedral, sdr_out, ratio_histogram, histogram_origin,
+          bins_per_stop, srgb_decode=None):
+    """
+    Pass 1 of one strip: fills sdr_out (float32 or uint16 fixed-point, shaped
+    like image_pq_u16) and adds the strip's ratios to ratio_histogram, a
+    log2 sketch starting at histogram_origin with bins_per_stop bins per stop.
+    pq_table and srgb_table are the uint16 code → nits tables of the HDR
+    source and of a fixed-point SDR base; srgb_decode, when given, is the
+    (values, slopes) table a float32 SDR base is decoded with instead of powf.
+
+    Returns:
+        tuple: (PQ code counts as a 65536-entry int64 array, max gain ratio)
+    """
+    size = lut_3d.shape[0]
+    lut_flat = np.ascontiguousarray(lut_3d, dtype=np.float32).reshape(-1, 3)
+    blocks = max(1, min(numba.get_num_threads(), len(image_pq_u16)))
+    code_counts = np.zeros((blocks, 65536), dtype=np.int64)
+    ratio_counts = np.zeros((blocks, len(ratio_histogram)), dtype=np.int64)
+    block_max = np.zeros(blocks, dtype=np.float32)
+    decode_table, decode_slopes = _decode_arrays(srgb_decode)
+    with _LAUNCH_LOCK:
+        _pass1_kernel(np.asarray(image_pq_u16), pq_table, lut_flat, size, tetrahedral, sdr_out,
+                      sdr_out.dtype == np.uint16, srgb_table, srgb_decode is not None, decode_table, decode_slopes,
+                      histogram_origin, bins_per_stop, code_counts, ratio_counts, block_max)
+    ratio_histogram += ratio_counts.sum(axis=0)
+    return code_counts.sum(axis=0), float(block_max.max())
+
+
+def pass2(image_pq_u16, pq_table, srgb_table, sdr_base, estimated_headroom, gain_map_out, log_gain_out=None,
+          log_gain_scale=1.0, log_gain_offset=0.0, srgb_decode=None):
+    """
+    Full-resolution pass 2 of one strip into gain_map_out (uint8) and, when
+    given, log_gain_out (float32 log2 luminance gain with the given scale
+    and offset applied to both luminances). srgb_decode as for pass1.
+    """
+    headroom_range = np.float32(max(estimated_headroom - 1.0, 0.001))
+    with_log_gain = log_gain_out is not None
+    if log_gain_out is None:
+        log_gain_out = np.empty((1, 1), dtype=np.float32)
+    gains = np.empty(image_pq_u16.shape, dtype=np.float32)
+    decode_table, decode_slopes = _decode_arrays(srgb_decode)
+    with _LAUNCH_LOCK:
+        _pass2_kernel(np.asarray(image_pq_u16), pq_table, np.asarray(sdr_base), sdr_base.dtype == np.uint16,
+                      srgb_table, srgb_decode is not None, decode_table, decode_slopes,
+                      headroom_range, gains, log_gain_out, with_log_gain,
+                      np.float32(log_gain_scale), np.float32(log_gain_offset))
+    # The reference's own ufunc, so each gamma-encoded value is bit-identical
+    np.power(gains, np.float32(1.0 / 2.2), out=gains)
+    with _LAUNCH_LOCK:
+        _gain_code_kernel(gains, gain_map_out)
+
@@ -0,0 +1,636 @@
+#!/usr/bin/env python3
+
+"""
+HDR Pipeline Benchmarks
+=======================
+
+Times every stage of the HDR_ISOGainMap pipeline on synthetic 16-bit P3 PQ
+frames (no test images or network access needed), plus HDR_ICC when
+ImageMagick is installed, and reports throughput and peak memory.
+
+STAGES:
+-------
+- pq_eotf         normalized_pq_to_absolute_nits (float path)
+- pq_eotf_u16     pq_u16_to_absolute_nits (table path)
+- decode          read_source_image of an uncompressed TIFF with cv2 + PQ table lookup
+- decode_mmap     the same TIFF memory-mapped (HDR_TIFF) + PQ table lookup
+- read_cube_lut   .cube text parse (resolution independent)
+- load_cube_lut   compiled, memory-mapped LUT (resolution independent)
+- apply_lut       3D LUT interpolation
+- headroom        sRGB decode + luminance + max gain ratio + ratio sketch
+- export_png      gain map encode + PNG write
+- gainmap_scaled  pass 2 at 1/4 resolution (area-averaged grid)
+- ultrahdr        log gain map encode + in-memory Ultra HDR JPEG assembly
+- end_to_end      convert_to_avif_gainmap on a synthetic TIFF
+- corpus          convert_to_avif_gainmap over the source TIFFs below --corpus
+- icc             HDR_ICC.convert_to_heif_with_icc (if magick is installed)
+
+The corpus is test_image by default. Its source TIFFs are not part of the
+repository (only the converted outputs are), so drop them anywhere below
+test_image/ outside the converted_* directories. A stage that cannot run is
+reported as skipped, with the reason, in the table and in the JSON results.
+
+Each stage is timed over --repeat runs (best wall time reported), then run
+once more under tracemalloc for peak numpy/Python allocation.
+
+Usage:
+    python HDR_Benchmark.py [--resolutions 1080p 4k 8k] [--stages ...]
+                            [--output results.json] [--baseline old.json]
+    python HDR_Benchmark.py --lut-engine     # apply_lut vs scipy reference
+    python HDR_Benchmark.py --precision      # --precision modes vs float32
+    python HDR_Benchmark.py --backend        # --backend numba vs numpy (needs numba)
+
+With --baseline, any stage slower than the baseline by more than
+--tolerance (default 10%) is reported and the exit code is 1.
+"""
+
+# ============================================================================
+# IMPORTS
+# ============================================================================
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from io import StringIO
+
+import cv2
+import numpy as np
+
+import HDR_ISOGainMap as gainmap
+import HDR_UltraHDR
+import HDR_Walk
+
+
+RESOLUTIONS = {
+    "1080p": (1080, 1920),
+    "4k": (2160, 3840),
+    "6k": (3160, 6144),
+    "8k": (4320, 7680),
+}
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+LUT_PATH = gainmap.LUT_PATH
+CORPUS_DIR = os.path.join(SCRIPT_DIR, "test_image")
+MAGICK_PATH = "/opt/homebrew/bin/magick"
+
+
+# ============================================================================
+# SYNTHETIC INPUT
+# ============================================================================
+
+def synthetic_pq_image(height, width, seed=0, levels=(0.0, 1.0), tint=(0.9, 1.0, 0.8), noise=0.05,
+                       hot_fraction=0.0):
+    """
+    Generates a (H, W, 3) uint16 P3 PQ frame: a tinted horizontal ramp over
+    the PQ levels plus gaussian noise. The defaults cover the whole code
+    range, so every LUT cell and highlight is exercised; hot_fraction of the
+    pixels can also be set to isolated near-peak highlights (PQ 0.95).
+    The tests build their frames here too.
+    """
+    rng = np.random.default_rng(seed)
+    ramp = np.linspace(levels[0], levels[1], width, dtype=np.float32)[None, :, None]
+    image = np.broadcast_to(ramp * np.array(tint, dtype=np.float32), (height, width, 3)).copy()
+    image += rng.normal(0.0, noise, size=image.shape).astype(np.float32)
+    if hot_fraction:
+        image[rng.random((height, width)) < hot_fraction] = 0.95
+    return (np.clip(image, 0.0, 1.0) * 65535.0).astype(np.uint16)
+
+
+def best_time(func, repeat):
+    """Returns (best wall time in seconds, last result) over `repeat` runs."""
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def peak_memory_mb(func):
+    """Peak traced allocation (numpy buffers included) of one call, in MB."""
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / (1024 * 1024)
+
+
+def corpus_files(corpus_dir):
+    """
+    Source TIFFs below corpus_dir, sorted; the converted_* output directories
+    are left out. Empty if corpus_dir does not exist.
+    """
+    try:
+        entries = HDR_Walk.walk_images(corpus_dir, (".tif", ".tiff"), recursive=True)
+    except FileNotFoundError:
+        return []
+    return [os.path.join(corpus_dir, path) for path, _ in entries
+            if not path.split(os.sep)[0].startswith("converted_")]
+
+
+def corpus_missing(corpus_dir):
+    """Why corpus_dir provides no source TIFFs."""
+    if not os.path.isdir(corpus_dir):
+        return f"{corpus_dir} missing"
+    return f"no source TIFFs in {corpus_dir}"
+
+
+def quiet(func):
+    """Wrap func so its console output is discarded."""
+    def run():
+        with redirect_stdout(StringIO()):
+            return func()
+    return run
+
+
+# ============================================================================
+# STAGE SETUP
+# ============================================================================
+# Each factory receives a per-resolution context and returns a zero-argument
+# callable for the stage, or raises StageSkipped when it cannot run here.
+
+
+class StageSkipped(Exception):
+    """The stage cannot run here; the message says why."""
+
+def _stage_pq_eotf(ctx):
+    return lambda: gainmap.normalized_pq_to_absolute_nits(ctx["pq_float"])
+
+
+def _stage_pq_eotf_u16(ctx):
+    return lambda: gainmap.pq_u16_to_absolute_nits(ctx["pq_u16"])
+
+
+def _uncompressed_source(ctx):
+    input_file = os.path.join(ctx["workdir"], "bench_src_uncompressed.tif")
+    if not os.path.exists(input_file):
+        cv2.imwrite(input_file, ctx["pq_u16"], [cv2.IMWRITE_TIFF_COMPRESSION, 1])
+    return input_file
+
+
+def _stage_decode(ctx):
+    input_file = _uncompressed_source(ctx)
+    return lambda: gainmap.pq_u16_to_absolute_nits(gainmap.read_source_image(input_file))
+
+
+def _stage_decode_mmap(ctx):
+    input_file = _uncompressed_source(ctx)
+    return lambda: gainmap.pq_u16_to_absolute_nits(gainmap.read_source_image(input_file, mmap_input=True))
+
+
+def _stage_read_cube_lut(ctx):
+    return lambda: gainmap.read_cube_lut(LUT_PATH)
+
+
+def _stage_load_cube_lut(ctx):
+    def run():
+        gainmap._LUT_CACHE.clear()
+        return gainmap.load_cube_lut(LUT_PATH)
+    return run
+
+
+def _stage_apply_lut(ctx):
+    return lambda: gainmap.apply_lut(ctx["pq_u16"], ctx["lut_3d"], ctx["lut_method"])
+
+
+def _stage_headroom(ctx):
+    return lambda: gainmap.fused_max_gain_ratio(ctx["hdr_nits"], ctx["sdr"], gainmap.log_histogram())
+
+
+def _stage_export_png(ctx):
+    def run():
+        sdr_nits = gainmap.srgb_to_absolute_nits(ctx["sdr"])
+        path = os.path.join(ctx["workdir"], "bench_gainmap.png")
+        gainmap.export_gain_map_png(ctx["hdr_nits"], sdr_nits, ctx["headroom"], path)
+    return quiet(run)
+
+
+def _stage_gainmap_scaled(ctx):
+    height, width = ctx["pq_u16"].shape[:2]
+    arrays = {"sdr_base": ctx["sdr"], "hdr_pq": ctx["pq_u16"], "pq_to_nits": gainmap.pq_u16_to_absolute_nits}
+    stats = {"shape": [height, width, 3]}
+    return lambda: gainmap.encode_reduced_resolution(arrays, stats, 4)
+
+
+def _stage_ultrahdr(ctx):
+    def run():
+        sdr_nits = gainmap.srgb_to_absolute_nits(ctx["sdr"])
+        plane = gainmap.log_gain(gainmap.luminance_bgr(ctx["hdr_nits"]), gainmap.luminance_bgr(sdr_nits))
+        low, high = float(plane.min()), float(plane.max())
+        encoded = gainmap.encode_log_gain(plane, low, high)
+        return HDR_UltraHDR.encode_ultrahdr_jpeg(ctx["sdr"], encoded, gainmap.ultrahdr_metadata(low, high))
+    return run
+
+
+def _stage_end_to_end(ctx):
+    input_file = os.path.join(ctx["workdir"], "bench_src.tif")
+    if not os.path.exists(input_file):
+        cv2.imwrite(input_file, ctx["pq_u16"])
+    output_file = os.path.join(ctx["workdir"], "bench.avif")
+    return quiet(lambda: gainmap.convert_to_avif_gainmap(input_file, output_file, ctx["lut_method"]))
+
+
+def _stage_corpus(ctx):
+    files = corpus_files(ctx["corpus"])
+    if not files:
+        raise StageSkipped(f"corpus case skipped: {corpus_missing(ctx['corpus'])}")
+    def run():
+        for index, input_file in enumerate(files):
+            output_file = os.path.join(ctx["workdir"], f"corpus_{index}.avif")
+            gainmap.convert_to_avif_gainmap(input_file, output_file, ctx["lut_method"])
+    return quiet(run)
+
+
+def _stage_icc(ctx):
+    if not os.path.exists(MAGICK_PATH):
+        raise StageSkipped(f"icc case skipped: {MAGICK_PATH} missing")
+    import HDR_ICC
+    input_file = os.path.join(ctx["workdir"], "bench_src.tif")
+    if not os.path.exists(input_file):
+        cv2.imwrite(input_file, ctx["pq_u16"])
+    output_file = os.path.join(ctx["workdir"], "bench.heic")
+    icc_profile = os.path.join(SCRIPT_DIR, "HDR_P3_D65_ST2084.icc")
+    return quiet(lambda: HDR_ICC.convert_to_heif_with_icc(input_file, output_file, icc_profile, "HDR_P3_D65_ST2084"))
+
+
+# name → (factory, scales with resolution)
+STAGES = {
+    "pq_eotf": (_stage_pq_eotf, True),
+    "pq_eotf_u16": (_stage_pq_eotf_u16, True),
+    "decode": (_stage_decode, True),
+    "decode_mmap": (_stage_decode_mmap, True),
+    "read_cube_lut": (_stage_read_cube_lut, False),
+    "load_cube_lut": (_stage_load_cube_lut, False),
+    "apply_lut": (_stage_apply_lut, True),
+    "headroom": (_stage_headroom, True),
+    "export_png": (_stage_export_png, True),
+    "gainmap_scaled": (_stage_gainmap_scaled, True),
+    "ultrahdr": (_stage_ultrahdr, True),
+    "end_to_end": (_stage_end_to_end, True),
+    "corpus": (_stage_corpus, False),
+    "icc": (_stage_icc, True),
+}
+
+
+def make_context(height, width, workdir, lut_method, corpus=CORPUS_DIR):
+    """Precompute the inputs every stage needs for one resolution."""
+    pq_u16 = synthetic_pq_image(height, width)
+    lut_3d = gainmap.load_cube_lut(LUT_PATH)
+    hdr_nits = gainmap.pq_u16_to_absolute_nits(pq_u16)
+    sdr = np.clip(gainmap.apply_lut(pq_u16, lut_3d, lut_method), 0, 1)
+    headroom = max(gainmap.fused_max_gain_ratio(hdr_nits, sdr), 1.0)
+    return {
+        "pq_u16": pq_u16,
+        "pq_float": pq_u16.astype(np.float32) / 65535.0,
+        "lut_3d": lut_3d,
+        "lut_method": lut_method,
+        "hdr_nits": hdr_nits,
+        "sdr": sdr,
+        "headroom": headroom,
+        "workdir": workdir,
+        "corpus": corpus,
+    }
+
+
+# ============================================================================
+# BENCHMARKS
+# ============================================================================
+
+def run_benchmarks(resolutions, stages, repeat, lut_method, corpus=CORPUS_DIR):
+    """
+    Runs the selected stages at each resolution.
+
+    Returns:
+        list: One dict per (stage, resolution) with seconds, MPix/s and peak
+            MB, or with "skipped" (the reason) for a stage that cannot run here
+    """
+    results = []
+    done_fixed = set()
+
+    with tempfile.TemporaryDirectory(prefix="hdr_bench_") as workdir:
+        for name in resolutions:
+            height, width = RESOLUTIONS[name]
+            mpix = height * width / 1e6
+            print(f"\n{name} ({width}x{height})")
+            ctx = make_context(height, width, workdir, lut_method, corpus)
+
+            for stage in stages:
+                factory, scales = STAGES[stage]
+                if not scales and stage in done_fixed:
+                    continue
+                try:
+                    func = factory(ctx)
+                except StageSkipped as e:
+                    print(f"  {stage:<14} skipped: {e}")
+                    results.append({"stage": stage, "resolution": name if scales else None, "skipped": str(e)})
+                    if not scales:
+                        done_fixed.add(stage)
+                    continue
+
+                seconds, _ = best_time(func, repeat)
+                peak_mb = peak_memory_mb(func)
+                result = {
+                    "stage": stage,
+                    "resolution": name if scales else None,
+                    "seconds": seconds,
+                    "mpix_per_s": mpix / seconds if scales else None,
+                    "peak_mb": peak_mb,
+                }
+                results.append(result)
+                if not scales:
+                    done_fixed.add(stage)
+
+                rate = f"{result['mpix_per_s']:8.1f} MPix/s" if scales else " " * 15
+                print(f"  {stage:<14} {seconds:8.3f} s  {rate}  peak {peak_mb:8.1f} MB")
+
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """
+    Prints per-stage speed changes against a stored baseline.
+
+    Returns:
+        list: (stage, resolution, ratio) for stages slower than tolerance allows
+    """
+    previous = {(r["stage"], r["resolution"]): r for r in baseline["results"] if "skipped" not in r}
+    regressions = []
+
+    print(f"\nComparison with baseline ({baseline['meta'].get('timestamp', 'unknown')}):")
+    for result in results:
+        key = (result["stage"], result["resolution"])
+        if key not in previous or "skipped" in result:
+            continue
+        ratio = result["seconds"] / previous[key]["seconds"]
+        flag = "  ✗ REGRESSION" if ratio > 1.0 + tolerance else ""
+        label = f"{result['stage']} @ {result['resolution'] or '-'}"
+        print(f"  {label:<24} x{ratio:5.2f} time{flag}")
+        if flag:
+            regressions.append((result["stage"], result["resolution"], ratio))
+    return regressions
+
+
+def bench_lut_engine(height, width, repeat):
+    """Compares apply_lut (both methods) against the scipy reference path."""
+    lut_3d = gainmap.load_cube_lut(LUT_PATH)
+    image = synthetic_pq_image(height, width).astype(np.float32) / 65535.0
+    mpix = height * width / 1e6
+
+    t_ref, reference = best_time(lambda: gainmap.apply_lut_reference(image, lut_3d), repeat)
+    print(f"  scipy reference   {t_ref:7.3f} s  {mpix / t_ref:7.1f} MPix/s")
+
+    for method in gainmap.LUT_METHODS:
+        t, result = best_time(lambda: gainmap.apply_lut(image, lut_3d, method), repeat)
+        max_err = float(np.max(np.abs(result - reference)))
+        print(f"  {method:<17} {t:7.3f} s  {mpix / t:7.1f} MPix/s  "
+              f"x{t_ref / t:4.1f}  max |Δ| vs reference {max_err:.2e}")
+
+
+# Reduced-accuracy conversion options compared by --precision, the
+# default (float32) first as the reference
+ACCURACY_VARIANTS = [(precision, {"precision": precision}) for precision in gainmap.PRECISIONS]
+
+
+def bench_precision(sources, repeat, lut_method, variants=ACCURACY_VARIANTS):
+    """
+    Runs convert_to_avif_gainmap with every option set of variants (by
+    default ACCURACY_VARIANTS) and reports, per source, time, SDR base size
+    and the error against the first variant's run: SDR base in 8-bit code
+    values, gain map codes and relative headroom.
+
+    sources: list of (label, input_file)
+
+    Returns:
+        list: One dict per (source, variant)
+    """
+    results = []
+    width = max(10, max(len(variant) + 1 for variant, _ in variants))
+    with tempfile.TemporaryDirectory(prefix="hdr_bench_") as workdir:
+        output_file = os.path.join(workdir, "bench.avif")
+        for label, input_file in sources:
+            print(f"\n{label}")
+            print(f"  {'variant':<{width}}{'time':>9}{'SDR MB':>9}{'SDR Δ max/mean (8-bit)':>26}"
+                  f"{'gain map Δ max/mean':>22}{'headroom Δ':>12}")
+            reference = None
+            for variant, options in variants:
+                run = quiet(lambda: gainmap.convert_to_avif_gainmap(input_file, output_file, lut_method, **options))
+                seconds, result = best_time(run, repeat)
+                sdr = gainmap.sdr_as_float32(result["sdr_base"]) * 255.0
+                gain_map = result["gain_map"].astype(np.int16)
+                if reference is None:
+                    reference = (sdr, gain_map, result["estimated_headroom"])
+                sdr_error = np.abs(sdr - reference[0])
+                map_error = np.abs(gain_map - reference[1])
+                entry = {
+                    "source": label,
+                    "variant": variant,
+                    "seconds": seconds,
+                    "sdr_base_mb": result["sdr_base"].nbytes / (1024 * 1024),
+                    "sdr_max_abs": float(sdr_error.max()),
+                    "sdr_mean_abs": float(sdr_error.mean()),
+                    "gain_map_max_abs": int(map_error.max()),
+                    "gain_map_mean_abs": float(map_error.mean()),
+                    "headroom_rel": abs(result["estimated_headroom"] / reference[2] - 1.0),
+                }
+                results.append(entry)
+                print(f"  {variant:<{width}}{seconds:8.3f}s{entry['sdr_base_mb']:9.1f}"
+                      f"{entry['sdr_max_abs']:>15.3f} / {entry['sdr_mean_abs']:<8.4f}"
+                      f"{entry['gain_map_max_abs']:>11d} / {entry['gain_map_mean_abs']:<8.4f}"
+                      f"{entry['headroom_rel']:>12.2e}")
+    return results
+
+
+# Compute backends compared by --backend: each storage the fused kernels
+# support, numpy (the reference) first; float32 also with the baked decode
+BACKEND_VARIANTS = [
+    [(f"{backend} {precision}", {"precision": precision, "backend": backend}) for backend in gainmap.BACKENDS]
+    for precision in ("float32", "fixed16")
+]
+BACKEND_VARIANTS[0].append(("numba float32 composite",
+                            {"precision": "float32", "backend": "numba", "composite_lut": True}))
+
+# Largest differences from the numpy backend, in bench_precision's units
+BACKEND_TOLERANCE = {
+    "sdr_max_abs": 255.0 / 65535.0,   # one fixed16 code, in 8-bit code values
+    "gain_map_max_abs": 1,
+    "headroom_rel": gainmap.COMPOSITE_TOLERANCE,
+}
+
+
+def bench_backend(sources, repeat, lut_method):
+    """
+    bench_precision over BACKEND_VARIANTS, plus a check of every non-numpy
+    run against BACKEND_TOLERANCE.
+
+    Returns:
+        tuple: (results, list of (source, variant, metric, value) out of tolerance)
+    """
+    results = []
+    for variants in BACKEND_VARIANTS:
+        results.extend(bench_precision(sources, repeat, lut_method, variants))
+
+    failures = []
+    for entry in results:
+        if entry["variant"].startswith("numpy"):
+            continue
+        for metric, limit in BACKEND_TOLERANCE.items():
+            if entry[metric] > limit:
+                failures.append((entry["source"], entry["variant"], metric, entry[metric]))
+    return results, failures
+
+
+# ============================================================================
+# MAIN EXECUTION BLOCK
+# ============================================================================
+
+def parse_arguments():
+    """Parse command-line arguments."""
+    parser = argparse.ArgumentParser(description='Benchmark HDR gain map pipeline stages')
+    parser.add_argument(
+        '--resolutions',
+        nargs='+',
+        choices=list(RESOLUTIONS),
+        default=['1080p', '4k'],
+        help='Synthetic frame sizes to benchmark (default: 1080p 4k)'
+    )
+    parser.add_argument(
+        '--stages',
+        nargs='+',
+        choices=list(STAGES),
+        default=list(STAGES),
+        help='Stages to run (default: all)'
+    )
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=3,
+        help='Runs per stage; the best time is reported (default: 3)'
+    )
+    parser.add_argument(
+        '--lut-method',
+        choices=gainmap.LUT_METHODS,
+        default='trilinear',
+        help='3D LUT interpolation used by the pipeline stages (default: trilinear)'
+    )
+    parser.add_argument(
+        '--output',
+        help='Write results as JSON to this path'
+    )
+    parser.add_argument(
+        '--baseline',
+        help='Compare against a JSON file from an earlier --output run'
+    )
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=0.10,
+        help='Allowed slowdown vs baseline before flagging a regression (default: 0.10)'
+    )
+    parser.add_argument(
+        '--lut-engine',
+        action='store_true',
+        help='Only compare apply_lut against the scipy reference implementation'
+    )
+    parser.add_argument(
+        '--precision',
+        action='store_true',
+        help='Only report reduced-precision error vs float32, on --corpus or synthetic --resolutions'
+    )
+    parser.add_argument(
+        '--backend',
+        action='store_true',
+        help='Only time --backend numba against numpy and check its difference (exit 1 beyond tolerance)'
+    )
+    parser.add_argument(
+        '--corpus',
+        default=CORPUS_DIR,
+        help='Directory searched recursively for source TIFFs, outside converted_* '
+             '(default: test_image; --precision / --backend use synthetic frames if it has none)'
+    )
+    return parser.parse_args()
+
+
+def main(args):
+    if args.lut_engine:
+        for name in args.resolutions:
+            height, width = RESOLUTIONS[name]
+            print(f"\n{name} ({width}x{height}) — apply_lut")
+            bench_lut_engine(height, width, args.repeat)
+        return
+
+    if args.precision or args.backend:
+        failures = []
+        with tempfile.TemporaryDirectory(prefix="hdr_bench_src_") as srcdir:
+            sources = [(os.path.relpath(path, args.corpus), path) for path in corpus_files(args.corpus)]
+            if sources:
+                inputs = f"corpus: {len(sources)} TIFF(s) in {args.corpus}"
+            else:
+                inputs = f"synthetic frames ({corpus_missing(args.corpus)})"
+                for name in args.resolutions:
+                    height, width = RESOLUTIONS[name]
+                    path = os.path.join(srcdir, f"synthetic_{name}.tif")
+                    cv2.imwrite(path, synthetic_pq_image(height, width))
+                    sources.append((f"{name} ({width}x{height}) synthetic", path))
+            print(f"Input: {inputs}")
+            if args.backend:
+                results, failures = bench_backend(sources, args.repeat, args.lut_method)
+            else:
+                results = bench_precision(sources, args.repeat, args.lut_method)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump({"meta": {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                                    "lut_method": args.lut_method, "repeat": args.repeat, "input": inputs},
+                           "backend" if args.backend else "precision": results}, f, indent=2)
+            print(f"\n✓ Results written to {args.output}")
+        if args.backend:
+            for source, variant, metric, value in failures:
+                print(f"  ✗ {source}: {variant} {metric} {value:.3g} exceeds {BACKEND_TOLERANCE[metric]:.3g}")
+            if failures:
+                sys.exit(1)
+            print("\n✓ Backends agree within tolerance")
+        return
+
+    results = run_benchmarks(args.resolutions, args.stages, args.repeat, args.lut_method, args.corpus)
+    skipped = [result["skipped"] for result in results if "skipped" in result]
+    if skipped:
+        print()
+        for reason in dict.fromkeys(skipped):
+            print(f"⚠ {reason}")
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "lut_method": args.lut_method,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\n✓ Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare_to_baseline(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+"""
+Content-Addressed Artifact Cache
+================================
+
+On-disk cache for expensive pipeline intermediates (numpy arrays plus a small
+JSON of statistics), used by HDR_ISOGainMap.py.
+
+LAYOUT:
+-------
+<cache_dir>/<key>/          one entry per key, created atomically
+    <name>.npy              arrays, memory-mapped on read
+    stats.json              scalar results; its mtime is the LRU timestamp
+
+Keys are hex digests supplied by the caller (input content hash + LUT hash +
+parameters), so identical inputs share one entry. Entries are staged in a
+temp directory and renamed into place, so concurrent workers never read a
+half-written entry. cache_evict() drops least recently used entries until
+the cache fits its size budget.
+"""
+
+# ============================================================================
+# IMPORTS
+# ============================================================================
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+
+STATS_FILENAME = "stats.json"
+
+
+# ============================================================================
+# KEYS
+# ============================================================================
+
+def file_digest(path):
+    """SHA-1 hex digest of a file's contents."""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def cache_key(*parts):
+    """Combine digests and parameters into one entry key."""
+    return hashlib.sha1("\0".join(str(p) for p in parts).encode()).hexdigest()
+
+
+# ============================================================================
+# ENTRIES
+# ============================================================================
+
+def cache_lookup(cache_dir, key):
+    """
+    Return (arrays, stats) for a cached entry, or None on a miss.
+
+    Arrays are read-only memory maps. A hit refreshes the entry's LRU time.
+    """
+    entry_dir = os.path.join(cache_dir, key)
+    stats_path = os.path.join(entry_dir, STATS_FILENAME)
+    try:
+        with open(stats_path) as f:
+            stats = json.load(f)
+        arrays = {
+            os.path.splitext(name)[0]: np.load(os.path.join(entry_dir, name), mmap_mode='r')
+            for name in os.listdir(entry_dir) if name.endswith(".npy")
+        }
+        os.utime(stats_path)
+    except (OSError, ValueError):
+        return None
+    return arrays, stats
+
+
+def cache_stage(cache_dir):
+    """Create and return a private staging directory for a new entry."""
+    os.makedirs(cache_dir, exist_ok=True)
+    return tempfile.mkdtemp(dir=cache_dir, prefix=".staging_")
+
+
+def stage_array(staging_dir, name, shape, dtype):
+    """Allocate a writable memory-mapped .npy array inside a staging entry."""
+    path = os.path.join(staging_dir, f"{name}.npy")
+    return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+
+
+def cache_commit(cache_dir, key, staging_dir, stats):
+    """
+    Publish a staged entry under key. If another process published the same
+    key first, the staged copy is discarded.
+    """
+    with open(os.path.join(staging_dir, STATS_FILENAME), 'w') as f:
+        json.dump(stats, f)
+    try:
+        os.rename(staging_dir, os.path.join(cache_dir, key))
+    except OSError:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def cache_abort(staging_dir):
+    """Discard a staging directory after a failed computation."""
+    shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+# ============================================================================
+# EVICTION
+# ============================================================================
+
+def _entry_size(entry_dir):
+    total = 0
+    for name in os.listdir(entry_dir):
+        try:
+            total += os.path.getsize(os.path.join(entry_dir, name))
+        except OSError:
+            pass
+    return total
+
+
+def cache_evict(cache_dir, max_bytes):
+    """
+    Delete least recently used entries until the cache is at most max_bytes.
+
+    Returns:
+        int: Number of entries removed
+    """
+    entries = []
+    try:
+        names = os.listdir(cache_dir)
+    except OSError:
+        return 0
+
+    for name in names:
+        entry_dir = os.path.join(cache_dir, name)
+        if name.startswith(".") or not os.path.isdir(entry_dir):
+            continue
+        try:
+            last_used = os.path.getmtime(os.path.join(entry_dir, STATS_FILENAME))
+        except OSError:
+            last_used = 0.0
+        entries.append((last_used, _entry_size(entry_dir), entry_dir))
+
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, entry_dir in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total -= size
+        removed += 1
+    return removed
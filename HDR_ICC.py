@@ -37,7 +37,10 @@ WORKFLOW:
 3. Output to converted_with_ICC/ directory
 
 Usage:
-    python HDR_ICC.py <input_file_or_directory>
+    python HDR_ICC.py [-j N] <input_file_or_directory>
+
+    -j/--jobs N keeps up to N magick processes in flight for directory
+    batches; each is capped at MAGICK_THREAD_LIMIT = cores / N threads.
 
 Requirements:
     - ImageMagick 7+ installed at /opt/homebrew/bin/magick
@@ -54,13 +57,50 @@ Output:
 import os           # Operating system interface for file/directory operations
 import subprocess   # Module to spawn new processes and execute shell commands
 import sys          # System-specific parameters and functions (command-line args, exit codes)
+import time         # Wall-clock timing of batch runs
+from concurrent.futures import ThreadPoolExecutor  # Bounded pool of magick jobs
+
+import HDR_Pipeline  # Read-ahead thread for directory batches
+import HDR_Profile  # Per-stage timing/memory instrumentation (--profile/--report)
+import HDR_Shard  # Multi-node sharding, work claims and atomic output writes
+import HDR_Walk  # Streaming directory walk and resume journal for directory batches
+
+
+# ImageMagick 7 binary that runs every conversion
+MAGICK_PATH = "/opt/homebrew/bin/magick"
+
+# Define ICC profiles to use for conversion
+# Each tuple contains (profile_filename, profile_display_name)
+ICC_PROFILES = [
+    ("HDR_P3_D65_ST2084.icc", "HDR_P3_D65_ST2084"),
+    ("P3_PQ.icc", "P3_PQ"),
+]
+
+
+# ============================================================================
+# READ-AHEAD
+# ============================================================================
+
+# Read size of the read-ahead pass over a source file
+READ_AHEAD_CHUNK = 1 << 20
+
+
+def read_ahead(input_file):
+    """
+    Read-ahead loader: read the source file through once, so the magick job
+    that opens it next finds its bytes in the page cache.
+    """
+    buffer = bytearray(READ_AHEAD_CHUNK)
+    with open(input_file, "rb", buffering=0) as f:
+        while f.readinto(buffer):
+            pass
 
 
 # ============================================================================
 # CORE CONVERSION FUNCTION
 # ============================================================================
 
-def convert_to_heif_with_icc(input_file, output_file, icc_profile, profile_name):
+def convert_to_heif_with_icc(input_file, output_file, icc_profile, profile_name, env=None, log=print):
     """
     Convert an image file to HEIF format with proper ICC profile handling.
     
@@ -80,6 +120,8 @@ def convert_to_heif_with_icc(input_file, output_file, icc_profile, profile_name)
         output_file (str): Path where the HEIF file will be saved
         icc_profile (str): Path to the ICC color profile to embed
         profile_name (str): Name of the ICC profile for display purposes
+        env (dict): Environment for the magick process (default: inherit)
+        log (callable): Receives each status line (default: print)
     
     Technical Details:
         - Bit Depth: 10-bit for HDR support (vs standard 8-bit)
@@ -93,7 +135,7 @@ def convert_to_heif_with_icc(input_file, output_file, icc_profile, profile_name)
     
     # Build the ImageMagick command
     convert_cmd = [
-        "/opt/homebrew/bin/magick",
+        MAGICK_PATH,
         input_file,
         
         # --- Image Quality Settings ---
@@ -123,36 +165,301 @@ def convert_to_heif_with_icc(input_file, output_file, icc_profile, profile_name)
     ])
     color_strategy = "Profile embedding (preserve pixels)"
     
-    convert_cmd.append(output_file)
+    # magick writes a temp name that is renamed once complete
+    partial_file = HDR_Shard.partial_path(output_file)
+    convert_cmd.append(partial_file)
     
     # Execute the ImageMagick command
     try:
-        subprocess.run(convert_cmd, check=True, capture_output=True, text=True)
-        print(f"✓ Successfully converted: {os.path.basename(input_file)} → {os.path.basename(output_file)}")
-        print(f"  Settings: 10-bit, 4:4:4 chroma, quality 100, ICC profile: {profile_name}")
-        print(f"  Color management: {color_strategy}")
+        with HDR_Profile.stage("magick"):
+            subprocess.run(convert_cmd, check=True, capture_output=True, text=True, env=env)
+            os.replace(partial_file, output_file)
+            HDR_Profile.record_io(read=HDR_Profile.file_size(input_file),
+                                  written=HDR_Profile.file_size(output_file))
+        log(f"✓ Successfully converted: {os.path.basename(input_file)} → {os.path.basename(output_file)}")
+        log(f"  Settings: 10-bit, 4:4:4 chroma, quality 100, ICC profile: {profile_name}")
+        log(f"  Color management: {color_strategy}")
     except subprocess.CalledProcessError as e:
-        print(f"✗ Error converting {input_file}:")
-        print(f"  Command: {' '.join(convert_cmd)}")
-        print(f"  Error output: {e.stderr}")
+        HDR_Shard.discard(partial_file)
+        log(f"✗ Error converting {input_file}:")
+        log(f"  Command: {' '.join(convert_cmd)}")
+        log(f"  Error output: {e.stderr}")
         raise
 
 
+def convert_to_heif_with_icc_profiles(input_file, targets, env=None, log=print):
+    """
+    Convert one source image to several ICC-tagged HEIF files in a single
+    ImageMagick process.
+    
+    The source is decoded and reduced to 10-bit once; each target then gets
+    its own clone with its own annotation and embedded profile, written with
+    -write. Settings and operator order per output match
+    convert_to_heif_with_icc, so the files are meant to be the same as one
+    call per profile: +clone copies the image with its properties and
+    profiles, and -write encodes it under the -quality and heic: defines
+    already set. Should an ImageMagick version encode a clone differently
+    (metadata or encoder state carried over from an earlier -write),
+    test_HDR_ICC.py shows it by byte-comparing both modes for every entry of
+    ICC_PROFILES; it needs a real ImageMagick with HEIC support at
+    MAGICK_PATH and is skipped otherwise.
+    
+    Parameters:
+        input_file (str): Path to the source image file
+        targets (list): (output_file, icc_profile, profile_name) tuples
+        env (dict): Environment for the magick process (default: inherit)
+        log (callable): Receives each status line (default: print)
+    
+    Raises:
+        subprocess.CalledProcessError: If ImageMagick conversion fails
+            (no output can be assumed complete in that case)
+    """
+    
+    # Shared decode and settings, identical to convert_to_heif_with_icc
+    convert_cmd = [
+        MAGICK_PATH,
+        input_file,
+        "-depth", "10",
+        "-gravity", "NorthWest",
+        "-font", "Arial",
+        "-pointsize", "15",
+        "-fill", "gray(50%)",
+        "-undercolor", "black",
+        "-define", "heic:preserve-orientation=true",
+        "-define", "heic:chroma=444",
+        "-quality", "100",
+    ]
+    
+    # Every target but the last works on a clone of the decoded image;
+    # the last one consumes the original, like the single-profile command.
+    # Files magick writes itself go to temp names, renamed once all are done.
+    partial_files = {output_file: HDR_Shard.partial_path(output_file) for output_file, _, _ in targets}
+    for output_file, icc_profile, profile_name in targets[:-1]:
+        convert_cmd.extend([
+            "(", "+clone",
+            "-annotate", "+10+10", profile_name,
+            "+profile", "*",
+            "-profile", icc_profile,
+            "-write", partial_files[output_file],
+            "+delete", ")",
+        ])
+    
+    output_file, icc_profile, profile_name = targets[-1]
+    convert_cmd.extend([
+        "-annotate", "+10+10", profile_name,
+        "+profile", "*",
+        "-profile", icc_profile,
+        partial_files[output_file],
+    ])
+    
+    # Execute the ImageMagick command
+    try:
+        with HDR_Profile.stage("magick"):
+            subprocess.run(convert_cmd, check=True, capture_output=True, text=True, env=env)
+            for final_file, partial_file in partial_files.items():
+                os.replace(partial_file, final_file)
+            HDR_Profile.record_io(read=HDR_Profile.file_size(input_file),
+                                  written=sum(HDR_Profile.file_size(out) for out, _, _ in targets))
+        for output_file, icc_profile, profile_name in targets:
+            log(f"✓ Successfully converted: {os.path.basename(input_file)} → {os.path.basename(output_file)}")
+            log(f"  Settings: 10-bit, 4:4:4 chroma, quality 100, ICC profile: {profile_name}")
+        log(f"  Color management: Profile embedding (preserve pixels), single decode for {len(targets)} profiles")
+    except subprocess.CalledProcessError as e:
+        for partial_file in partial_files.values():
+            HDR_Shard.discard(partial_file)
+        log(f"✗ Error converting {input_file}:")
+        log(f"  Command: {' '.join(convert_cmd)}")
+        log(f"  Error output: {e.stderr}")
+        raise
+
+
+# ============================================================================
+# JOB SCHEDULER
+# ============================================================================
+
+def magick_environment(jobs):
+    """
+    Environment for magick processes when `jobs` of them run at once.
+    
+    Each magick process would otherwise start one OpenMP thread per core,
+    so N concurrent jobs would oversubscribe the CPU N times over. The
+    per-process thread count is capped at cores / jobs unless the caller
+    already set MAGICK_THREAD_LIMIT.
+    """
+    env = os.environ.copy()
+    if jobs > 1 and "MAGICK_THREAD_LIMIT" not in env:
+        env["MAGICK_THREAD_LIMIT"] = str(max(1, (os.cpu_count() or 1) // jobs))
+    return env
+
+
+def run_conversion_job(convert, *convert_args, env=None, source=None):
+    """
+    Run one conversion function on a scheduler thread with its output buffered.
+    
+    Parameters:
+        convert (callable): convert_to_heif_with_icc or convert_to_heif_with_icc_profiles
+        convert_args: Positional arguments for convert
+        env (dict): Environment for the magick process
+        source (Future): Read-ahead future of the source file; the job
+            waits for it before starting magick
+    
+    Returns:
+        tuple: (log_lines, error, profile_record) where error is None on
+            success and profile_record is None unless HDR_Profile is enabled
+    """
+    lines = []
+    error = None
+    HDR_Profile.start_file(convert_args[0])
+    try:
+        if source is not None:
+            source.result()
+        convert(*convert_args, env=env, log=lines.append)
+    except Exception as e:
+        error = e
+    record = HDR_Profile.finish_file("ok" if error is None else "failed", error)
+    return lines, error, record
+
+
+def run_claimed_job(claim_dir, output_root, outputs, claim_ttl, convert, *convert_args, **job_options):
+    """
+    run_conversion_job under claims on its outputs (HDR_Shard.run_claimed),
+    for batches shared between nodes. Claiming outputs rather than sources
+    keeps nodes with and without --single-decode from converting the same
+    file twice. Each output is claimed by its path relative to output_root,
+    so same-named files in different subdirectories of a --recursive batch
+    get different claims.
+    
+    A job whose outputs all exist once claimed (finished by another node)
+    is not run. A job that is not run returns an HDR_Shard.ClaimSkipped as
+    its error.
+    
+    Returns:
+        tuple: As run_conversion_job
+    """
+    def run():
+        return run_conversion_job(convert, *convert_args, **job_options)
+    
+    def done():
+        return all(os.path.exists(output_file) for output_file in outputs)
+    
+    try:
+        return HDR_Shard.run_claimed(claim_dir, [os.path.relpath(output_file, output_root) for output_file in outputs],
+                                     run, done, claim_ttl)
+    except HDR_Shard.ClaimSkipped as e:
+        return [], e, None
+
+
+# ============================================================================
+# SINGLE FILE CONVERSION
+# ============================================================================
+
+def convert_file(input_path, single_decode=False, env=None, log=print):
+    """
+    Convert one image with every ICC profile into the "converted_with_ICC"
+    folder next to its directory, as in single-file mode.
+    
+    Parameters:
+        input_path (str): Path to the source image file
+        single_decode (bool): Write all profiles from one magick process
+        env (dict): Environment for the magick processes (default: inherit)
+        log (callable): Receives each status line (default: print)
+    
+    Returns:
+        list: Paths of the written HEIC files
+    
+    Raises:
+        subprocess.CalledProcessError: If ImageMagick conversion fails
+    """
+    # Get the script directory to locate ICC profiles
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    
+    # Create "converted_with_ICC" folder at the same level as the source directory
+    input_dir = os.path.dirname(os.path.abspath(input_path))
+    parent_dir = os.path.dirname(input_dir)
+    converted_dir = os.path.join(parent_dir, "converted_with_ICC")
+    os.makedirs(converted_dir, exist_ok=True)
+    
+    # Get base filename without extension
+    base_name = os.path.splitext(os.path.basename(input_path))[0]
+    
+    # Format: Src_<base_name>_SaveAs_<profile_name>.heic
+    targets = [
+        (os.path.join(converted_dir, f"Src_{base_name}_SaveAs_{profile_name}.heic"),
+         os.path.join(script_dir, profile_filename),
+         profile_name)
+        for profile_filename, profile_name in ICC_PROFILES
+    ]
+    
+    # Convert with all ICC profiles from a single decode
+    if single_decode:
+        log(f"Converting with {', '.join(name for _, _, name in targets)}...")
+        convert_to_heif_with_icc_profiles(input_path, targets, env=env, log=log)
+        log("")
+    
+    # Convert with each ICC profile (overwrites existing files)
+    else:
+        for output_path, icc_profile_path, profile_name in targets:
+            log(f"Converting with {profile_name}...")
+            convert_to_heif_with_icc(input_path, output_path, icc_profile_path, profile_name, env=env, log=log)
+            log("")
+    
+    return [output_path for output_path, _, _ in targets]
+
+
 # ============================================================================
 # BATCH PROCESSING FUNCTION
 # ============================================================================
 
-def process_directory(directory):
+def process_directory(directory, jobs=1, single_decode=False, records=None, show_profile=False,
+                      pipeline_depth=0, pipeline_memory_mb=HDR_Pipeline.DEFAULT_MEMORY_MB,
+                      shard=None, claim_dir=None, claim_ttl=HDR_Shard.DEFAULT_CLAIM_TTL_S,
+                      recursive=False, largest_first=False, journal=None):
     """
     Process all supported image files in a directory.
     
-    Recursively finds and converts all image files with supported extensions
-    in the specified directory. Each file is converted to HEIF with each
-    ICC profile, with the profile name appended to the output filename.
+    Finds and converts all image files with supported extensions in the
+    specified directory (and, with recursive, its subdirectories). Each file
+    is converted to HEIF with each ICC profile, with the profile name
+    appended to the output filename.
     
     Parameters:
         directory (str): Path to directory containing images
-
+        jobs (int): Number of magick processes kept in flight (default: 1)
+        single_decode (bool): Decode each file once and write all profiles
+            from one magick process (default: False)
+        records (list): Receives one HDR_Profile record per magick job
+            when instrumentation is enabled
+        show_profile (bool): Print each job's stage table (--profile)
+        pipeline_depth (int): Read up to this many source files ahead of
+            magick (0 = no read-ahead)
+        pipeline_memory_mb (float): Cap on the bytes of source files read ahead
+        shard (tuple): (i, N) to convert only shard i of N of the files
+        claim_dir (str): Shared directory in which each job claims its
+            outputs when it starts
+        claim_ttl (float): Seconds after which a claim of a crashed node expires
+        recursive (bool): Also convert images in subdirectories; outputs go
+            to the same subdirectories of converted_with_ICC
+        largest_first (bool): Convert the largest files first
+        journal (str): Journal file recording each fully converted file;
+            files already in it are skipped (resume an interrupted batch)
+    
+    Streaming (HDR_Walk):
+        Files are converted as the directory walk finds them, a few files
+        ahead of the one being reported, so a large tree starts converting
+        at once. largest_first lists the whole batch first to sort it.
+    
+    Multi-node batches (HDR_Shard):
+        Every node sees the same shard of each file name. With claim_dir,
+        jobs claimed by another node, or whose outputs another node has
+        already written, are skipped; everything else is still overwritten.
+    
+    Pipelining:
+        A reader thread reads the next source files (bounded by
+        pipeline_depth and pipeline_memory_mb, charged at file size before
+        each read) so that magick, which still opens them by name, finds them
+        in the page cache. magick writes its outputs itself, to temp names
+        renamed once complete, so there is no write-behind stage. A file's
+        charge is released once all of its jobs have finished.
     
     Supported Formats:
         - TIFF (.tif, .tiff) - Common for professional/HDR workflows
@@ -163,13 +470,6 @@ def process_directory(directory):
         tuple: (successful_count, failed_count, skipped_count)
     """
     
-    # Define ICC profiles to use for conversion
-    # Each tuple contains (profile_filename, profile_display_name)
-    ICC_PROFILES = [
-        ("HDR_P3_D65_ST2084.icc", "HDR_P3_D65_ST2084"),
-        ("P3_PQ.icc", "P3_PQ"),
-    ]
-    
     # Get the script directory to locate ICC profiles
     script_dir = os.path.dirname(os.path.abspath(__file__))
     
@@ -192,71 +492,187 @@ def process_directory(directory):
 
     print(f"{'='*70}\n")
     
-    # Get list of all files in directory
+    # Walk the directory (and subdirectories with recursive) lazily
     try:
-        files = os.listdir(directory)
+        entries = HDR_Walk.walk_images(directory, SUPPORTED_EXTENSIONS, recursive, ordered=not largest_first)
     except PermissionError:
         print(f"✗ Error: Permission denied to access directory: {directory}")
         return (0, 0, 0)
     
-    # Filter and process only image files
-    image_files = [f for f in files if f.lower().endswith(SUPPORTED_EXTENSIONS)]
+    # Files completed by an earlier, interrupted run
+    done = set()
+    record_done = None
+    if journal is not None:
+        done, record_done = HDR_Walk.open_journal(journal)
+        print(f"Journal {journal}: {len(done)} file(s) already done\n")
+    
+    # Keep only this node's share of a multi-node batch, minus journaled files
+    seen = {"found": 0, "other_shard": 0, "journaled": 0}
+    def image_files():
+        for filename, _ in entries:
+            seen["found"] += 1
+            if not HDR_Shard.in_shard(filename, shard):
+                seen["other_shard"] += 1
+            elif filename in done:
+                seen["journaled"] += 1
+            else:
+                yield filename
+    
+    # Sorting by size needs every file's size before the first conversion
+    if largest_first:
+        entries = HDR_Walk.largest_first(entries)
+        files = list(image_files())
+        print(f"Found {len(files)} image file(s) to process, largest first\n")
+    else:
+        files = image_files()
+        print(f"Streaming image files from {directory}{' and its subdirectories' if recursive else ''}\n")
     
-    if not image_files:
-        print(f"⚠ No supported image files found in {directory}")
-        print(f"  Supported formats: {', '.join(SUPPORTED_EXTENSIONS)}")
-        return (0, 0, 0)
+    if claim_dir is not None:
+        print(f"Claiming jobs in {claim_dir} (stale after {claim_ttl:g}s)\n")
     
-    print(f"Found {len(image_files)} image file(s) to process\n")
+    # Schedule every (file, profile) conversion on a bounded pool so that at
+    # most `jobs` magick processes run at once; results are reported in order
+    env = magick_environment(jobs)
+    if jobs > 1:
+        print(f"Running up to {jobs} magick processes (MAGICK_THREAD_LIMIT={env.get('MAGICK_THREAD_LIMIT', 'unset')})\n")
     
-    # Process each image file
-    for idx, filename in enumerate(image_files, 1):
-        # Construct full file paths
-        file_path = os.path.join(directory, filename)
-        base_name = os.path.splitext(filename)[0]
-        
-        print(f"[{idx}/{len(image_files)}] Processing: {filename}")
-        
-        # Convert with each ICC profile
-        file_successful = 0
-        file_failed = 0
-        file_skipped = 0
-        
-        for profile_filename, profile_name in ICC_PROFILES:
-            # Construct ICC profile path
-            icc_profile_path = os.path.join(script_dir, profile_filename)
-            
-            # Validate ICC profile exists
-            if not os.path.isfile(icc_profile_path):
-                print(f"  ✗ ICC profile not found: {profile_filename}")
-                file_failed += 1
-                continue
-            
-            # Construct output filename
-            output_file = os.path.join(converted_dir, f"Src_{base_name}_SaveAs_{profile_name}.heic")
+    # Read-ahead ahead of the magick jobs (magick writes its outputs itself)
+    reader = None
+    if pipeline_depth > 0:
+        print(f"Pipelining: read-ahead depth {pipeline_depth}, {pipeline_memory_mb:g} MB\n")
+        read_budget = HDR_Pipeline.pipeline_budget(pipeline_depth, int(pipeline_memory_mb * 1024 * 1024))
+        reader, read = HDR_Pipeline.start_reader(read_ahead, read_budget, HDR_Profile.file_size)
+    
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            def schedule(filename):
+                # Construct full file paths
+                file_path = os.path.join(directory, filename)
+                base_name = os.path.splitext(os.path.basename(filename))[0]
+                
+                # Outputs mirror the file's subdirectory
+                output_dir = os.path.join(converted_dir, os.path.dirname(filename))
+                os.makedirs(output_dir, exist_ok=True)
+                source = read(file_path) if reader is not None else None
+                
+                # Convert with each ICC profile
+                file_jobs = []
+                targets = []
+                for profile_filename, profile_name in ICC_PROFILES:
+                    # Construct ICC profile path
+                    icc_profile_path = os.path.join(script_dir, profile_filename)
+                    
+                    # Validate ICC profile exists
+                    if not os.path.isfile(icc_profile_path):
+                        file_jobs.append((profile_filename, [profile_name], None))
+                        continue
+                    
+                    # Construct output filename
+                    output_file = os.path.join(output_dir, f"Src_{base_name}_SaveAs_{profile_name}.heic")
+                    
+                    # Overwrite existing files (default behavior)
+                    if single_decode:
+                        targets.append((output_file, icc_profile_path, profile_name))
+                    elif claim_dir is not None:
+                        future = executor.submit(run_claimed_job, claim_dir, converted_dir, [output_file], claim_ttl,
+                                                 convert_to_heif_with_icc,
+                                                 file_path, output_file, icc_profile_path, profile_name,
+                                                 env=env, source=source)
+                        file_jobs.append((profile_filename, [profile_name], future))
+                    else:
+                        future = executor.submit(run_conversion_job, convert_to_heif_with_icc,
+                                                 file_path, output_file, icc_profile_path, profile_name,
+                                                 env=env, source=source)
+                        file_jobs.append((profile_filename, [profile_name], future))
+                
+                # One magick process fans out to every available profile
+                if targets and claim_dir is not None:
+                    future = executor.submit(run_claimed_job, claim_dir, converted_dir,
+                                             [output for output, _, _ in targets], claim_ttl,
+                                             convert_to_heif_with_icc_profiles,
+                                             file_path, targets, env=env, source=source)
+                    file_jobs.append((None, [name for _, _, name in targets], future))
+                elif targets:
+                    future = executor.submit(run_conversion_job, convert_to_heif_with_icc_profiles,
+                                             file_path, targets, env=env, source=source)
+                    file_jobs.append((None, [name for _, _, name in targets], future))
+                return source, file_jobs
             
-            # Overwrite existing files (default behavior)
+            # Schedule a few files ahead of the one being reported, enough
+            # to keep every magick slot and the read-ahead busy
+            ahead = max(jobs, pipeline_depth)
             
-            # Attempt conversion
-            try:
-                convert_to_heif_with_icc(file_path, output_file, icc_profile_path, profile_name)
-                file_successful += 1
-            except subprocess.CalledProcessError:
-                print(f"  ✗ Failed to convert with {profile_name}")
-                file_failed += 1
-            except Exception as e:
-                print(f"  ✗ Unexpected error with {profile_name}: {e}")
-                file_failed += 1
-        
-        # Update overall counters
-        if file_successful > 0:
-            successful += file_successful
-        if file_failed > 0:
-            failed += file_failed
-        if file_skipped > 0:
-            skipped += file_skipped
-        
-        print()  # Blank line for readability
+            # Process each image file
+            for idx, (filename, (source, file_jobs)) in enumerate(
+                    HDR_Pipeline.prefetch(files, schedule, ahead), 1):
+                progress = f"{idx}/{len(files)}" if largest_first else f"{idx}"
+                print(f"[{progress}] Processing: {filename}")
+                
+                file_successful = 0
+                file_failed = 0
+                file_skipped = 0
+                
+                for profile_filename, profile_names, future in file_jobs:
+                    if future is None:
+                        print(f"  ✗ ICC profile not found: {profile_filename}")
+                        file_failed += 1
+                        continue
+                    
+                    # Wait for this conversion and replay its output
+                    lines, error, record = future.result()
+                    for line in lines:
+                        print(line)
+                    
+                    if record is not None:
+                        if records is not None:
+                            records.append(record)
+                        if show_profile:
+                            print(HDR_Profile.format_record(record))
+                    
+                    # A single-decode job succeeds or fails for all its profiles
+                    for profile_name in profile_names:
+                        if error is None:
+                            file_successful += 1
+                        elif isinstance(error, HDR_Shard.ClaimSkipped):
+                            print(f"  Skipping {profile_name} ({error})")
+                            file_skipped += 1
+                        elif isinstance(error, subprocess.CalledProcessError):
+                            print(f"  ✗ Failed to convert with {profile_name}")
+                            file_failed += 1
+                        else:
+                            print(f"  ✗ Unexpected error with {profile_name}: {error}")
+                            file_failed += 1
+                
+                # Every job of this file is done: free its read-ahead charge
+                if source is not None and source.exception() is None:
+                    read_budget[1](source.result()[1])
+                
+                # Journal the file once all of its profiles are written here
+                if record_done is not None and file_failed == 0 and file_skipped == 0:
+                    record_done(filename, profiles=file_successful)
+                
+                # Update overall counters
+                if file_successful > 0:
+                    successful += file_successful
+                if file_failed > 0:
+                    failed += file_failed
+                if file_skipped > 0:
+                    skipped += file_skipped
+                
+                print()  # Blank line for readability
+    finally:
+        if reader is not None:
+            HDR_Pipeline.shutdown(reader, read_budget, wait=False)
+    
+    if seen["found"] == 0:
+        print(f"⚠ No supported image files found in {directory}")
+        print(f"  Supported formats: {', '.join(SUPPORTED_EXTENSIONS)}")
+        return (0, 0, 0)
+    if shard is not None:
+        print(f"Shard {shard[0]}/{shard[1]}: {seen['found'] - seen['other_shard']} of {seen['found']} file(s)")
+    if seen["journaled"]:
+        print(f"Journal: {seen['journaled']} file(s) already done, skipped")
+        skipped += seen["journaled"] * len(ICC_PROFILES)
     
     # Print summary statistics
     print(f"{'='*70}")
@@ -330,18 +746,42 @@ def validate_input_path(input_path):
 
 
 # ============================================================================
-# MAIN EXECUTION BLOCK
+# RUN REPORTING
 # ============================================================================
 
-def main():
+def write_profile_outputs(args, records, batch_wall_s):
     """
-    Main entry point for the script.
+    Write the --report JSON and --metrics-textfile for a finished run.
     
-    Handles command-line argument parsing, validation, and orchestrates
-    the conversion process for either single files or directories.
+    Parameters:
+        args (argparse.Namespace): Parsed command-line arguments
+        records (list): HDR_Profile records collected during the run
+        batch_wall_s (float): Wall time of the whole run in seconds
     """
+    if not HDR_Profile.is_enabled():
+        return
     
-    # --- Command-Line Argument Parsing ---
+    summary = HDR_Profile.summarize(records, batch_wall_s)
+    if args.report:
+        HDR_Profile.write_report(args.report, "HDR_ICC", records, summary)
+        print(f"✓ Run report written to {args.report}")
+    if args.metrics_textfile:
+        HDR_Profile.write_metrics_textfile(args.metrics_textfile, "HDR_ICC", summary)
+        print(f"✓ Metrics written to {args.metrics_textfile}")
+    if args.profile:
+        print(f"Batch: {summary['files']} jobs, {summary['images_per_s']:.2f} jobs/s, "
+              f"p50 {summary['latency_p50_s']:.2f}s, p95 {summary['latency_p95_s']:.2f}s")
+
+
+# ============================================================================
+# MAIN EXECUTION BLOCK
+# ============================================================================
+
+def argument_parser():
+    """
+    Command-line parser of this script; HDR_Server parses the options of
+    submitted jobs with it too.
+    """
     import argparse
     
     parser = argparse.ArgumentParser(
@@ -353,6 +793,96 @@ def main():
         "input_path",
         help="Path to image file or directory of images"
     )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=1,
+        help="Number of magick processes to run in parallel (default: 1)"
+    )
+    parser.add_argument(
+        "--single-decode",
+        action="store_true",
+        help="Decode each image once and write every ICC profile from one magick process"
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print wall/CPU time, I/O and peak RSS of each magick job"
+    )
+    parser.add_argument(
+        "--report",
+        help="Write per-job timings and batch aggregates as JSON to this path"
+    )
+    parser.add_argument(
+        "--metrics-textfile",
+        help="Write batch metrics in Prometheus textfile-collector format"
+    )
+    parser.add_argument(
+        "--pipeline-depth",
+        type=int,
+        default=HDR_Pipeline.DEFAULT_DEPTH,
+        help=f"Source files read ahead of magick in batch runs, 0 disables (default: {HDR_Pipeline.DEFAULT_DEPTH})"
+    )
+    parser.add_argument(
+        "--pipeline-memory-mb",
+        type=float,
+        default=HDR_Pipeline.DEFAULT_MEMORY_MB,
+        help=f"Cap on the bytes of source files read ahead (default: {HDR_Pipeline.DEFAULT_MEMORY_MB:g})"
+    )
+    parser.add_argument(
+        "--shard",
+        type=HDR_Shard.shard_spec,
+        metavar="I/N",
+        help="Multi-node batches: only convert shard I of N (1-based, stable hash of the file name)"
+    )
+    parser.add_argument(
+        "--claim-dir",
+        help="Multi-node batches: claim each job with a lock file in this shared directory before running it"
+    )
+    parser.add_argument(
+        "--claim-ttl",
+        type=float,
+        default=HDR_Shard.DEFAULT_CLAIM_TTL_S,
+        help=f"Seconds without heartbeat after which a crashed node's claim expires (default: {HDR_Shard.DEFAULT_CLAIM_TTL_S:g})"
+    )
+    parser.add_argument(
+        "--recursive",
+        action="store_true",
+        help="Also convert images in subdirectories; outputs mirror the subdirectories"
+    )
+    parser.add_argument(
+        "--largest-first",
+        action="store_true",
+        help="Convert the largest files first for better load balance (lists the whole batch before starting)"
+    )
+    parser.add_argument(
+        "--journal",
+        help="Append each fully converted file to this journal and skip files already in it, to resume a batch"
+    )
+    return parser
+
+
+def argument_error(args):
+    """Message for an invalid combination of parsed options, or None."""
+    if args.jobs < 1:
+        return f"--jobs must be at least 1, got {args.jobs}"
+    if args.pipeline_depth < 0:
+        return f"--pipeline-depth must be 0 or more, got {args.pipeline_depth}"
+    if args.pipeline_memory_mb <= 0:
+        return f"--pipeline-memory-mb must be positive, got {args.pipeline_memory_mb:g}"
+    return None
+
+
+def main():
+    """
+    Main entry point for the script.
+    
+    Handles command-line argument parsing, validation, and orchestrates
+    the conversion process for either single files or directories.
+    """
+    
+    # --- Command-Line Argument Parsing ---
+    parser = argument_parser()
     
     # If no arguments provided, print custom help and exit
     if len(sys.argv) < 2:
@@ -360,9 +890,22 @@ def main():
         print("HDR HEIC Converter with ICC Profile Embedding")
         print("="*70)
         print("\nUsage:")
-        print(f"  python {os.path.basename(__file__)} [-o] <input_file_or_directory>")
+        print(f"  python {os.path.basename(__file__)} [options] <input_file_or_directory>")
         print("\nArguments:")
         print("  input_file_or_directory  Path to image file or directory of images")
+        print("  -j, --jobs N             Run up to N magick processes in parallel")
+        print("  --single-decode          Write all ICC profiles from one decode per image")
+        print("  --profile                Print per-job timing, I/O and peak RSS")
+        print("  --report FILE            Write per-job timings and batch aggregates as JSON")
+        print("  --metrics-textfile FILE  Write batch metrics for a Prometheus textfile collector")
+        print("  --pipeline-depth N       Read N source files ahead of magick in batch runs (0 = off)")
+        print("  --pipeline-memory-mb MB  Cap on the bytes of source files read ahead")
+        print("  --shard I/N              Multi-node batches: convert only shard I of N")
+        print("  --claim-dir DIR          Multi-node batches: claim jobs with lock files in DIR")
+        print("  --claim-ttl S            Expire claims of crashed nodes after S seconds")
+        print("  --recursive              Also convert images in subdirectories")
+        print("  --largest-first          Convert the largest files first")
+        print("  --journal FILE           Record converted files in FILE and skip them on a rerun")
 
         print("\nICC Profiles Used:")
         print("  - HDR_P3_D65_ST2084.icc")
@@ -373,13 +916,20 @@ def main():
         print("  - converted_with_ICC/Src_<filename>_SaveAs_P3_PQ.heic")
         print("\nExamples:")
         print(f"  python {os.path.basename(__file__)} image.tiff")
-        print(f"  python {os.path.basename(__file__)} -o ./images/")
+        print(f"  python {os.path.basename(__file__)} ./images/")
+        print(f"  python {os.path.basename(__file__)} -j 4 --single-decode --recursive ./images/")
+        print(f"  python HDR_Server.py submit icc image.tiff   (through a running HDR_Server)")
         print("="*70 + "\n")
         sys.exit(1)
         
     args = parser.parse_args()
     input_path = args.input_path
 
+    error = argument_error(args)
+    if error is not None:
+        print(f"Error: {error}")
+        sys.exit(1)
+
     
     # --- Validate ICC Profiles ---
     print("\nValidating ICC profiles...")
@@ -393,50 +943,30 @@ def main():
     if path_type is None:
         sys.exit(1)
     
+    # --- Instrumentation ---
+    profiling = bool(args.profile or args.report or args.metrics_textfile)
+    HDR_Profile.enable(profiling)
+    records = []
+    batch_start = time.perf_counter()
+    
     # --- Process Based on Input Type ---
     try:
-        # Get the script directory to locate ICC profiles
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        
-        # Define ICC profiles
-        ICC_PROFILES = [
-            ("HDR_P3_D65_ST2084.icc", "HDR_P3_D65_ST2084"),
-            ("P3_PQ.icc", "P3_PQ"),
-        ]
-        
         if path_type == 'file':
             # Single file conversion
             print(f"\nMode: Single file conversion")
             print(f"Input: {input_path}")
 
             
-            # Get the directory containing the input file
-            input_dir = os.path.dirname(os.path.abspath(input_path))
-            
-            # Create "converted_with_ICC" folder at the same level as the source directory
-            parent_dir = os.path.dirname(input_dir)
-            converted_dir = os.path.join(parent_dir, "converted_with_ICC")
-            os.makedirs(converted_dir, exist_ok=True)
-            
-            # Get base filename without extension
-            base_name = os.path.splitext(os.path.basename(input_path))[0]
+            # One profile record covers every conversion of this file
+            HDR_Profile.start_file(input_path)
+            convert_file(input_path, args.single_decode)
             
-            # Convert with each ICC profile
-            for profile_filename, profile_name in ICC_PROFILES:
-                # Construct ICC profile path
-                icc_profile_path = os.path.join(script_dir, profile_filename)
-                
-                # Generate output filename with profile name appended in converted subfolder
-                # Format: Src_<base_name>_SaveAs_<profile_name>.heic
-                output_path = os.path.join(converted_dir, f"Src_{base_name}_SaveAs_{profile_name}.heic")
-                
-                # Check if output already exists
-                # Overwrite existing files (default behavior)
-                
-                # Perform conversion
-                print(f"Converting with {profile_name}...")
-                convert_to_heif_with_icc(input_path, output_path, icc_profile_path, profile_name)
-                print()
+            record = HDR_Profile.finish_file()
+            if record is not None:
+                records.append(record)
+                if args.profile:
+                    print(HDR_Profile.format_record(record))
+            write_profile_outputs(args, records, time.perf_counter() - batch_start)
             
             print(f"✓ All conversions complete\n")
         
@@ -446,7 +976,12 @@ def main():
             print(f"Input directory: {input_path}")
             
             # Process all images in directory
-            successful, failed, skipped = process_directory(input_path)
+            successful, failed, skipped = process_directory(input_path, args.jobs, args.single_decode,
+                                                            records, args.profile, args.pipeline_depth,
+                                                            args.pipeline_memory_mb, args.shard,
+                                                            args.claim_dir, args.claim_ttl, args.recursive,
+                                                            args.largest_first, args.journal)
+            write_profile_outputs(args, records, time.perf_counter() - batch_start)
             
             # Exit with error code if any conversions failed
             if failed > 0:
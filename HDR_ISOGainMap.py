@@ -1,12 +1,35 @@
 #!/usr/bin/env python3
 
+import csv
+import importlib.util
+import json
 import os
+import re
 import subprocess
 import sys
+import tempfile
+import time
 import numpy as np
 import cv2
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import redirect_stdout
+from io import StringIO
 from scipy.interpolate import RegularGridInterpolator
 
+import HDR_Cache
+import HDR_Pipeline
+import HDR_Profile
+import HDR_Shard
+import HDR_TIFF
+import HDR_UltraHDR
+import HDR_Walk
+from HDR_Profile import stage
+
+LUT_FILENAME = "ACES20_P3D65PQ1000D60_to_sRGBPW.cube"
+LUT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), LUT_FILENAME)
+
 def normalized_pq_to_absolute_nits(image_pq):
     """
     Converts Rec.2100 PQ (0-1 range) to Linear Light (0-10000 nits range).
@@ -27,6 +50,30 @@ def normalized_pq_to_absolute_nits(image_pq):
     linear = (num / den) ** (1.0/m1)
     return linear * 10000.0  # Scale to absolute nits
 
+# A uint16 PQ image can only hold 65,536 distinct codes, so the EOTF is
+# tabulated once and applied by indexing. The table is built with the same
+# float32 arithmetic as the float path, so both give identical nits.
+_PQ_U16_TABLE = None
+
+def pq_u16_table():
+    """65536-entry float32 table: uint16 PQ code → absolute nits (built once)."""
+    global _PQ_U16_TABLE
+    if _PQ_U16_TABLE is None:
+        codes = np.arange(65536, dtype=np.float32) / 65535.0
+        _PQ_U16_TABLE = normalized_pq_to_absolute_nits(codes)
+    return _PQ_U16_TABLE
+
+def pq_u16_to_absolute_nits(image_pq_u16):
+    """
+    Converts uint16 Rec.2100 PQ code values (0-65535) to absolute nits by
+    table lookup. Bit-identical to
+    normalized_pq_to_absolute_nits(image.astype(np.float32) / 65535.0)
+    without the float copy or per-pixel power functions.
+    """
+    if image_pq_u16.dtype != np.uint16:
+        raise TypeError(f"Expected uint16 PQ code values, got {image_pq_u16.dtype}")
+    return pq_u16_table()[image_pq_u16]
+
 def read_cube_lut(lut_path):
     """
     Reads a .cube 3D LUT file.
@@ -69,9 +116,113 @@ def read_cube_lut(lut_path):
     
     return lut_3d
 
-def apply_lut(image, lut_3d):
+# ============================================================================
+# COMPILED LUT CACHE
+# ============================================================================
+# Parsing the 35,940-line .cube text costs ~100 ms per call. The parsed
+# (N, N, N, 3) table is compiled once into a binary .npy sidecar keyed by the
+# SHA-1 of the .cube contents; later runs (and worker processes) memory-map
+# the sidecar, and _LUT_CACHE keeps it loaded for the life of the process.
+
+LUT_CACHE_DIRNAME = ".lut_cache"
+
+_LUT_CACHE = {}
+_LUT_DIGESTS = {}
+
+def _lut_sidecar_dirs(lut_path):
+    """Candidate sidecar directories: next to the .cube, then the temp dir."""
+    return [
+        os.path.join(os.path.dirname(os.path.abspath(lut_path)), LUT_CACHE_DIRNAME),
+        os.path.join(tempfile.gettempdir(), "hdr_exif_lut_cache"),
+    ]
+
+def lut_digest(lut_path):
+    """SHA-1 of the .cube contents, hashed once per process per file version."""
+    st = os.stat(lut_path)
+    key = (os.path.abspath(lut_path), st.st_mtime_ns, st.st_size)
+    if key not in _LUT_DIGESTS:
+        _LUT_DIGESTS[key] = HDR_Cache.file_digest(lut_path)
+    return _LUT_DIGESTS[key]
+
+def _umask():
+    """The process umask (reading it means setting it, so it is set back)."""
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+def compile_cube_lut(lut_path):
+    """
+    Returns the path of the binary sidecar for lut_path, compiling it on first use.
+    The sidecar is written to a temp name and renamed into place, so concurrent
+    workers never observe a partial file.
+    """
+    digest = lut_digest(lut_path)
+    sidecar_name = f"{os.path.splitext(os.path.basename(lut_path))[0]}.{digest[:16]}.npy"
+
+    for cache_dir in _lut_sidecar_dirs(lut_path):
+        sidecar_path = os.path.join(cache_dir, sidecar_name)
+        if os.path.isfile(sidecar_path):
+            return sidecar_path
+
+    lut_3d = np.ascontiguousarray(read_cube_lut(lut_path))
+
+    for cache_dir in _lut_sidecar_dirs(lut_path):
+        sidecar_path = os.path.join(cache_dir, sidecar_name)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".npy.tmp")
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, lut_3d)
+            # mkstemp creates 0600; other users sharing the cache must read it
+            os.chmod(tmp_path, 0o644 & ~_umask())
+            os.replace(tmp_path, sidecar_path)
+            return sidecar_path
+        except OSError:
+            continue
+
+    raise OSError(f"Could not write LUT cache for {lut_path}")
+
+def load_cube_lut(lut_path):
     """
-    Applies a 3D LUT to an image using trilinear interpolation.
+    Returns the (N, N, N, 3) float32 LUT for lut_path as a read-only memory map
+    of its compiled sidecar. Repeated calls in the same process are free.
+    """
+    st = os.stat(lut_path)
+    key = (os.path.abspath(lut_path), st.st_mtime_ns, st.st_size)
+
+    lut_3d = _LUT_CACHE.get(key)
+    if lut_3d is None:
+        try:
+            lut_3d = np.load(compile_cube_lut(lut_path), mmap_mode='r')
+        except (OSError, ValueError):
+            # Unwritable or corrupt cache: fall back to the text parser
+            lut_3d = np.ascontiguousarray(read_cube_lut(lut_path))
+        _LUT_CACHE[key] = lut_3d
+
+    return lut_3d
+
+# ============================================================================
+# 3D LUT INTERPOLATION ENGINE
+# ============================================================================
+# Specialised for cube LUTs on a uniform [0, 1] grid: works in float32 on
+# chunks of LUT_CHUNK_PIXELS pixels, so the only full-size array is the output.
+# Matches apply_lut_reference (scipy RegularGridInterpolator) to within
+# LUT_ENGINE_TOLERANCE for trilinear (test_HDR_LUT.py). Tetrahedral is a
+# different (and smoother along the neutral axis) interpolant with the same
+# grid values and is not held to that tolerance: inside the cells of the
+# shipped ACES LUT where neighbouring nodes jump (gamut-mapping
+# discontinuities) it differs from trilinear by up to about 0.2-0.25.
+
+LUT_METHODS = ("trilinear", "tetrahedral")
+LUT_CHUNK_PIXELS = 1 << 16
+
+# Largest absolute difference of trilinear apply_lut vs apply_lut_reference
+LUT_ENGINE_TOLERANCE = 1e-5
+
+def apply_lut_reference(image, lut_3d):
+    """
+    Applies a 3D LUT to an image using scipy's trilinear interpolation.
+    Reference implementation kept for accuracy checks and benchmarks.
     image: (H, W, 3) float32, range 0-1
     lut_3d: (N, N, N, 3) float32
 
@@ -97,20 +248,309 @@ def apply_lut(image, lut_3d):
     # Reshape back to image
     return result.reshape(image.shape)
 
+def _lut_cell_coords(points, size):
+    """
+    Splits (M, 3) points in 0-1 (or uint16 codes 0-65535) into flat base
+    indices into the (N*N*N, 3) LUT and per-axis fractional offsets, both
+    computed in float32 / int32. Inputs outside 0-1 are clamped to the LUT domain.
+    """
+    if points.dtype == np.uint16:
+        scaled = points.astype(np.float32)
+        scaled *= np.float32((size - 1) / 65535.0)
+    else:
+        scaled = np.clip(points, 0.0, 1.0, dtype=np.float32)
+        scaled *= np.float32(size - 1)
+    base = np.minimum(scaled.astype(np.int32), size - 2)
+    scaled -= base
+    index = (base[:, 0] * size + base[:, 1]) * size + base[:, 2]
+    return index, scaled
+
+def _interp_trilinear(lut_flat, size, points):
+    index, frac = _lut_cell_coords(points, size)
+    s0, s1 = size * size, size
+    fx, fy, fz = frac[:, 0:1], frac[:, 1:2], frac[:, 2:3]
 
-def export_gain_map_png(img_hdr_linear_absolute_nits, img_sdr_linear_absolute_nits, estimated_headroom, output_path):
+    # Interpolate along the fastest axis first, then collapse the other two
+    c00 = lut_flat[index];           c00 += (lut_flat[index + 1] - c00) * fz
+    c01 = lut_flat[index + s1];      c01 += (lut_flat[index + s1 + 1] - c01) * fz
+    c10 = lut_flat[index + s0];      c10 += (lut_flat[index + s0 + 1] - c10) * fz
+    c11 = lut_flat[index + s0 + s1]; c11 += (lut_flat[index + s0 + s1 + 1] - c11) * fz
+    c00 += (c01 - c00) * fy
+    c10 += (c11 - c10) * fy
+    c00 += (c10 - c00) * fx
+    return c00
 
-    """    
+def _interp_tetrahedral(lut_flat, size, points):
+    index, frac = _lut_cell_coords(points, size)
+    strides = np.array([size * size, size, 1], dtype=np.int32)
+
+    # Walk from the cell origin to the far corner along axes sorted by fraction
+    order = np.argsort(-frac, axis=1, kind='stable')
+    f = np.take_along_axis(frac, order, axis=1)
+    v1 = index + strides[order[:, 0]]
+    v2 = v1 + strides[order[:, 1]]
+    v3 = index + strides.sum()
+
+    out = lut_flat[index] * (1.0 - f[:, 0:1])
+    out += lut_flat[v1] * (f[:, 0:1] - f[:, 1:2])
+    out += lut_flat[v2] * (f[:, 1:2] - f[:, 2:3])
+    out += lut_flat[v3] * f[:, 2:3]
+    return out
+
+def apply_lut(image, lut_3d, method="trilinear", chunk_pixels=LUT_CHUNK_PIXELS, out=None):
+    """
+    Applies a 3D LUT to an image.
+    image: (..., 3) float in range 0-1 or uint16 codes, channel order matching the LUT axes
+    lut_3d: (N, N, N, 3) float32
+    method: 'trilinear' (within LUT_ENGINE_TOLERANCE of apply_lut_reference)
+            or 'tetrahedral' (not held to that tolerance, see above)
+    out: optional contiguous array shaped like image; each chunk is clipped
+         to 0-1 and stored in out's dtype (see store_sdr), so no full-size
+         float32 result is allocated
+    Returns a float32 array with the same shape as image, or out.
+    """
+    if method not in LUT_METHODS:
+        raise ValueError(f"Unknown LUT interpolation method: {method}")
+    interp = _interp_trilinear if method == "trilinear" else _interp_tetrahedral
+
+    size = lut_3d.shape[0]
+    lut_flat = np.ascontiguousarray(lut_3d, dtype=np.float32).reshape(-1, 3)
+
+    points = image.reshape(-1, 3)
+    if out is not None:
+        result = out.reshape(-1, 3)
+        for start in range(0, len(points), chunk_pixels):
+            stop = start + chunk_pixels
+            store_sdr(result[start:stop], interp(lut_flat, size, points[start:stop]))
+        return out
+
+    result = np.empty(points.shape, dtype=np.float32)
+    for start in range(0, len(points), chunk_pixels):
+        stop = start + chunk_pixels
+        result[start:stop] = interp(lut_flat, size, points[start:stop])
+
+    return result.reshape(image.shape)
+
+
+# ============================================================================
+# PER-STRIP PIPELINE STAGES
+# ============================================================================
+# Every stage below works on any horizontal strip of the image, so the same
+# code serves whole-image and streaming (--tile-budget-mb) conversions.
+
+SDR_WHITE_NITS = 203.0
+
+# Rough working-set estimate per pixel of a strip: HDR nits, LUT output,
+# sRGB linear nits and the luminance / ratio planes plus numpy temporaries.
+STRIP_BYTES_PER_PIXEL = 96
+
+def strip_rows_for_budget(height, width, tile_budget_mb=None):
+    """
+    Returns how many image rows fit in tile_budget_mb of intermediates.
+    None means no budget: the whole image is processed as one strip.
+    """
+    if tile_budget_mb is None:
+        return height
+    rows = int(tile_budget_mb * 1024 * 1024) // (width * STRIP_BYTES_PER_PIXEL)
+    return max(1, min(height, rows))
+
+def image_strips(height, width, tile_budget_mb=None, align=1):
+    """
+    (top, bottom) row ranges covering the image within the tile budget.
+    Strip heights are multiples of align (except the last), so per-strip
+    downsampling by align matches downsampling the whole image.
+    """
+    strip_rows = strip_rows_for_budget(height, width, tile_budget_mb)
+    if strip_rows < height:
+        strip_rows = max(align, strip_rows - strip_rows % align)
+    return [(top, min(top + strip_rows, height)) for top in range(0, height, strip_rows)]
+
+def srgb_to_absolute_nits(img_srgb_normalized):
+    """
+    Decodes sRGB (0-1) to linear light with reference white at SDR_WHITE_NITS.
+    Reduced-precision SDR bases are accepted too (see PRECISIONS): float16 is
+    decoded in float32, uint16 fixed-point through srgb_u16_to_absolute_nits.
+    """
+    if img_srgb_normalized.dtype == np.uint16:
+        return srgb_u16_to_absolute_nits(img_srgb_normalized)
+    if img_srgb_normalized.dtype == np.float16:
+        img_srgb_normalized = img_srgb_normalized.astype(np.float32)
+    sdr_linear_display = np.where(img_srgb_normalized <= 0.04045,
+                                  img_srgb_normalized / 12.92,
+                                  ((img_srgb_normalized + 0.055) / 1.055) ** 2.4)
+    return sdr_linear_display * SDR_WHITE_NITS
+
+# ============================================================================
+# REDUCED-PRECISION SDR BASE
+# ============================================================================
+# The SDR base is the largest array kept between the two passes. With
+# --precision it is stored as float16 (half the bytes, ~1e-3 relative
+# error) or as uint16 fixed-point codes (half the bytes, 1/65535 steps,
+# decoded by table like the PQ codes). HDR nits, gain ratios and luminance
+# stay float32: gain ratios overflow float16, and numpy's float16
+# arithmetic is emulated and slower than float32.
+
+PRECISIONS = ("float32", "float16", "fixed16")
+SDR_STORAGE = {"float32": np.float32, "float16": np.float16, "fixed16": np.uint16}
+
+_SRGB_U16_TABLE = None
+
+def srgb_u16_table():
+    """65536-entry float32 table: fixed-point sRGB code → linear nits (built once)."""
+    global _SRGB_U16_TABLE
+    if _SRGB_U16_TABLE is None:
+        codes = np.arange(65536, dtype=np.float64) / 65535.0
+        linear = np.where(codes <= 0.04045, codes / 12.92, ((codes + 0.055) / 1.055) ** 2.4)
+        _SRGB_U16_TABLE = (linear * SDR_WHITE_NITS).astype(np.float32)
+    return _SRGB_U16_TABLE
+
+def srgb_u16_to_absolute_nits(img_srgb_u16):
+    """srgb_to_absolute_nits for uint16 fixed-point codes (0-65535), by table lookup."""
+    return srgb_u16_table()[img_srgb_u16]
+
+# --composite-lut: the transforms after the 3D LUT (sRGB EOTF, SDR white
+# scale) baked into one table over the LUT's 0-1 output, interpolated
+# linearly between nodes. Each SDR channel is decoded on its own, so the
+# luminance and gain ratio stay exact functions of the decoded channels; the
+# table is only off by its interpolation error, below COMPOSITE_TOLERANCE.
+# The fused kernels (--backend numba) use it instead of a per-pixel powf;
+# numpy keeps its SIMD power, which is faster than gathering from a table.
+# Unlike the 3D LUT it has no .npy sidecar: it depends on no input file and
+# builds in a few milliseconds, once per process.
+
+COMPOSITE_TABLE_STEPS = 65536
+
+# Largest relative error of a baked decode vs the float64 sRGB EOTF
+COMPOSITE_TOLERANCE = 2e-6
+
+_COMPOSITE_TABLE = None
+
+def composite_decode_table():
+    """
+    (values, slopes): COMPOSITE_TABLE_STEPS + 1 float32 nodes of sRGB (0-1)
+    → linear nits, and the difference to the next node (built once).
+    """
+    global _COMPOSITE_TABLE
+    if _COMPOSITE_TABLE is None:
+        codes = np.arange(COMPOSITE_TABLE_STEPS + 1, dtype=np.float64) / COMPOSITE_TABLE_STEPS
+        nits = np.where(codes <= 0.04045, codes / 12.92, ((codes + 0.055) / 1.055) ** 2.4) * SDR_WHITE_NITS
+        _COMPOSITE_TABLE = (nits.astype(np.float32), np.diff(nits).astype(np.float32))
+    return _COMPOSITE_TABLE
+
+def store_sdr(out, sdr_srgb):
+    """Writes float sRGB values into out, clipped to 0-1, in out's storage dtype."""
+    if out.dtype == np.uint16:
+        scaled = np.clip(sdr_srgb, 0.0, 1.0)
+        scaled *= np.float32(65535.0)
+        scaled += np.float32(0.5)
+        out[...] = scaled
+    else:
+        out[...] = sdr_srgb
+        np.clip(out, 0, 1, out=out)
+
+def sdr_as_float32(sdr_base):
+    """The SDR base as float32 sRGB 0-1 whatever its storage precision."""
+    if sdr_base.dtype == np.uint16:
+        return sdr_base.astype(np.float32) / np.float32(65535.0)
+    return np.asarray(sdr_base, dtype=np.float32)
+
+def luminance_bgr(img_bgr):
+    """Rec.709 luminance of a (..., 3) image in OpenCV BGR order."""
+    return 0.2126 * img_bgr[..., 2] + 0.7152 * img_bgr[..., 1] + 0.0722 * img_bgr[..., 0]
+
+def max_gain_ratio(img_hdr_linear_absolute_nits, img_sdr_linear_absolute_nits):
+    """Largest HDR / SDR luminance ratio over the given pixels."""
+    lum_hdr = luminance_bgr(img_hdr_linear_absolute_nits)
+    lum_sdr = luminance_bgr(img_sdr_linear_absolute_nits)
+
+    # Prevent division by zero: replace any values < 1e-6 with 1e-6
+    sdr_safe = np.maximum(lum_sdr, 1e-6)
+
+    # Calculate gain ratio per pixel: HDR luminance / SDR luminance
+    gain_ratio = lum_hdr / sdr_safe
+    return float(np.max(gain_ratio))
+
+# Pixels per chunk of the fused headroom reduction; its scratch buffers
+# are (HEADROOM_CHUNK_PIXELS, 3) float32 plus three single-plane buffers.
+HEADROOM_CHUNK_PIXELS = 1 << 16
+
+def fused_max_gain_ratio(img_hdr_linear_absolute_nits, img_sdr_srgb_normalized, histogram=None):
+    """
+    Bit-identical to max_gain_ratio(hdr, srgb_to_absolute_nits(sdr)) for
+    float32, float16 and fixed16 SDR bases (same float32 operations in the
+    same order, per element), computed in one chunked pass with preallocated in-place buffers: sRGB decode, SDR
+    white scaling, luminance weighting, clamp, ratio and max, without the
+    full-size linear, luminance, clamp and ratio planes.
+
+    With histogram (a log_histogram sketch), each chunk's ratios are also
+    added to it for percentile headroom.
+    """
+    hdr = img_hdr_linear_absolute_nits.reshape(-1, 3)
+    sdr = img_sdr_srgb_normalized.reshape(-1, 3)
+    chunk = min(HEADROOM_CHUNK_PIXELS, len(sdr))
+
+    linear = np.empty((chunk, 3), dtype=np.float32)
+    low = np.empty((chunk, 3), dtype=bool)
+    lum_hdr = np.empty(chunk, dtype=np.float32)
+    lum_sdr = np.empty(chunk, dtype=np.float32)
+    term = np.empty(chunk, dtype=np.float32)
+
+    def luminance_into(out, rgb, n):
+        # Same operation order as luminance_bgr, so results are bit-identical
+        np.multiply(rgb[:n, 2], 0.2126, out=out[:n])
+        np.multiply(rgb[:n, 1], 0.7152, out=term[:n])
+        out[:n] += term[:n]
+        np.multiply(rgb[:n, 0], 0.0722, out=term[:n])
+        out[:n] += term[:n]
+
+    max_ratio = 0.0
+    for start in range(0, len(sdr), chunk):
+        sdr_chunk = sdr[start:start + chunk]
+        n = len(sdr_chunk)
+
+        if sdr.dtype == np.uint16:
+            # Fixed-point base: the table already holds the white-scaled nits
+            np.take(srgb_u16_table(), sdr_chunk, out=linear[:n])
+        else:
+            if sdr.dtype != np.float32:
+                sdr_chunk = sdr_chunk.astype(np.float32)
+            # sRGB EOTF: only the pixels on each branch are evaluated
+            np.less_equal(sdr_chunk, 0.04045, out=low[:n])
+            np.add(sdr_chunk, 0.055, out=linear[:n])
+            linear[:n] /= 1.055
+            np.power(linear[:n], 2.4, out=linear[:n], where=~low[:n])
+            np.divide(sdr_chunk, 12.92, out=linear[:n], where=low[:n])
+            linear[:n] *= SDR_WHITE_NITS
+
+        luminance_into(lum_sdr, linear, n)
+        luminance_into(lum_hdr, hdr[start:start + n], n)
+
+        np.maximum(lum_sdr[:n], 1e-6, out=lum_sdr[:n])
+        np.divide(lum_hdr[:n], lum_sdr[:n], out=lum_hdr[:n])
+        max_ratio = max(max_ratio, float(lum_hdr[:n].max()))
+        if histogram is not None:
+            log_histogram_add(histogram, lum_hdr[:n])
+
+    return max_ratio
+
+def gain_ratio(img_hdr_linear_absolute_nits, img_sdr_linear_absolute_nits):
+    """Per-channel HDR / SDR gain, with SDR clamped away from zero."""
+    img_sdr_linear_safe = np.maximum(img_sdr_linear_absolute_nits, 1e-6)
+    return img_hdr_linear_absolute_nits / img_sdr_linear_safe
+
+def encode_gain_map(img_hdr_linear_absolute_nits, img_sdr_linear_absolute_nits, estimated_headroom):
+    """
     Process:
         1. Calculate gain ratio per pixel (HDR / SDR)
         2. Normalize to 0-1 range based on headroom
         3. Apply Rec.709 gamma (2.2) encoding
-        4. Save as 8-bit grayscale PNG for Core Image
+        4. Average channels to an 8-bit grayscale map
     """
-    
-    img_sdr_linear_safe = np.maximum(img_sdr_linear_absolute_nits, 1e-6)
-    gain_map = img_hdr_linear_absolute_nits / img_sdr_linear_safe
-    
+    gain_map = gain_ratio(img_hdr_linear_absolute_nits, img_sdr_linear_absolute_nits)
+    return encode_gain_ratio(gain_map, estimated_headroom)
+
+def encode_gain_ratio(gain_map, estimated_headroom):
+    """Steps 2-4 of encode_gain_map, starting from a precomputed gain ratio."""
     gain_map_normalized = (gain_map - 1.0) / max(estimated_headroom - 1.0, 0.001)
     gain_map_normalized = np.clip(gain_map_normalized, 0, 1)
  
@@ -121,172 +561,1788 @@ def export_gain_map_png(img_hdr_linear_absolute_nits, img_sdr_linear_absolute_ni
     else:
         gain_map_gray = gain_map_gamma
     
-    gain_map_uint8 = (gain_map_gray * 255).astype(np.uint8)
+    return (gain_map_gray * 255).astype(np.uint8)
+
+
+def export_gain_map_png(img_hdr_linear_absolute_nits, img_sdr_linear_absolute_nits, estimated_headroom, output_path):
+
+    """    
+    Encodes the gain map (see encode_gain_map) and saves it as an 8-bit
+    grayscale PNG for Core Image.
+    """
+    
+    gain_map_uint8 = encode_gain_map(img_hdr_linear_absolute_nits, img_sdr_linear_absolute_nits, estimated_headroom)
     cv2.imwrite(output_path, gain_map_uint8)
     
     print(f"  ✓ tmp gain map saved for visual check: {output_path}")
 
 
-def convert_to_avif_gainmap(input_file, output_file):
-    
-    str_filepath_sdr_srgb_from_LUT = f"temp_sdr_{os.getpid()}.tif"
+# ============================================================================
+# STREAMING QUANTILE SKETCH
+# ============================================================================
+# A fixed-bin log2 histogram (LOG_HISTOGRAM_BINS_PER_STOP bins per stop over
+# LOG_HISTOGRAM_RANGE) of positive values. Filling it is one linear pass in
+# constant memory, and sketches are plain int64 arrays, so strips, images or
+# worker processes merge by addition. Quantiles are accurate to one bin
+# (~1.1% relative) and never exceed the exactly tracked maximum, so the
+# 100th percentile reproduces the plain max.
 
-    try:
-        # ====================================================================
-        # DATA FLOW: Image Loading and Transformation Pipeline
-        # ====================================================================
-        # input_file (string: file path to 16-bit TIFF)
-        #     ↓ cv2.imread(IMREAD_UNCHANGED)
-        # img_p3_pq (uint16: 0-65535, "unsigned quantized")
-        #     ↓ astype(float32) / 65535.0
-        # img_P3_linear_absolute_nits (float32: 0-10000, "P3 D65 absolute luminance")
-        # ====================================================================
-        
-        img_p3_pq_U16 = cv2.imread(input_file, cv2.IMREAD_UNCHANGED)
-        if img_p3_pq_U16 is None:
-            raise ValueError(f"Could not read converted image: {input_file}")
+LOG_HISTOGRAM_RANGE = (-24.0, 40.0)
+LOG_HISTOGRAM_BINS_PER_STOP = 64
+LOG_HISTOGRAM_BINS = int((LOG_HISTOGRAM_RANGE[1] - LOG_HISTOGRAM_RANGE[0]) * LOG_HISTOGRAM_BINS_PER_STOP)
+
+def log_histogram():
+    """An empty sketch."""
+    return np.zeros(LOG_HISTOGRAM_BINS, dtype=np.int64)
+
+def log_histogram_add(histogram, values, weights=None):
+    """
+    Adds values (any shape) to histogram in place. weights, if given, are
+    per-value counts, e.g. a bincount of uint16 codes against a value table.
+    Zero and out-of-range values land in the first/last bin.
+    """
+    with np.errstate(divide='ignore'):
+        position = np.log2(np.asarray(values, dtype=np.float32)).ravel()
+    position -= np.float32(LOG_HISTOGRAM_RANGE[0])
+    position *= np.float32(LOG_HISTOGRAM_BINS_PER_STOP)
+    np.clip(position, 0, LOG_HISTOGRAM_BINS - 1, out=position)
+    counts = np.bincount(position.astype(np.intp), weights, minlength=LOG_HISTOGRAM_BINS)
+    histogram += counts.astype(np.int64)
+    return histogram
+
+def log_histogram_quantile(histogram, q, exact_max):
+    """
+    Value at quantile q (0-1) of the sketch: the upper edge of the bin holding
+    that rank, capped at exact_max.
+    """
+    total = int(histogram.sum())
+    if total == 0 or q >= 1.0:
+        return exact_max
+    rank = max(1, int(np.ceil(q * total)))
+    index = int(np.searchsorted(np.cumsum(histogram), rank))
+    upper_edge = 2.0 ** (LOG_HISTOGRAM_RANGE[0] + (index + 1) / LOG_HISTOGRAM_BINS_PER_STOP)
+    return min(upper_edge, exact_max)
+
+def add_pq_code_histogram(histogram, image_pq_u16):
+    """
+    Adds the absolute nits of uint16 PQ codes via a code bincount and the PQ
+    table. The count ignores channel order, so a channel-reversed view
+    (HDR_TIFF.map_bgr) is flattened in stored order, without a copy.
+    """
+    if image_pq_u16.strides[-1] < 0:
+        image_pq_u16 = image_pq_u16[..., ::-1]
+    codes = np.bincount(image_pq_u16.ravel(), minlength=65536)
+    return log_histogram_add(histogram, pq_u16_table(), codes)
+
+
+# ============================================================================
+# ULTRA HDR GAIN MAP
+# ============================================================================
+# The visual-check PNG above is linear in gain; the Ultra HDR / ISO gain map
+# is log2-encoded luminance gain between GainMapMin and GainMapMax, with the
+# standard 1/64 offsets (SDR white = 1.0) keeping black pixels finite.
+
+CONTAINERS = ("none", "ultrahdr")
+ULTRAHDR_OFFSET = 1.0 / 64.0
+ULTRAHDR_GAMMA = 1.0
+
+def output_extension(container):
+    """File extension of the deliverable written for a --container choice."""
+    return ".jpg" if container == "ultrahdr" else ".avif"
+
+def conversion_done(output_file, container="none"):
+    """
+    Whether the conversion to output_file already happened: its Ultra HDR
+    JPEG, or without a container its gain map PNG (the .avif name only
+    names the outputs). Writes are atomic (HDR_Shard.partial_path), so a
+    file that exists is complete.
+    """
+    if container == "ultrahdr":
+        return os.path.exists(output_file)
+    root = os.path.splitext(output_file)[0]
+    return os.path.exists(f"{root}_gainmap.png")
+
+def log_gain(lum_hdr_absolute_nits, lum_sdr_absolute_nits):
+    """log2 luminance gain HDR / SDR with the Ultra HDR offsets, as float32."""
+    scale = np.float32(1.0 / SDR_WHITE_NITS)
+    hdr = lum_hdr_absolute_nits * scale + np.float32(ULTRAHDR_OFFSET)
+    sdr = lum_sdr_absolute_nits * scale + np.float32(ULTRAHDR_OFFSET)
+    return np.log2(hdr / sdr, dtype=np.float32)
+
+def encode_log_gain(log_gain_plane, gain_map_min, gain_map_max, gamma=ULTRAHDR_GAMMA):
+    """Normalizes log2 gain to [GainMapMin, GainMapMax] and quantizes to uint8."""
+    recovery = (log_gain_plane - gain_map_min) / max(gain_map_max - gain_map_min, 1e-6)
+    recovery = np.clip(recovery, 0, 1)
+    if gamma != 1.0:
+        recovery = np.power(recovery, gamma)
+    return (recovery * 255 + 0.5).astype(np.uint8)
+
+def ultrahdr_metadata(gain_map_min, gain_map_max):
+    """hdrgm metadata for HDR_UltraHDR (log2 values)."""
+    return {
+        "gain_map_min": gain_map_min,
+        "gain_map_max": gain_map_max,
+        "gamma": ULTRAHDR_GAMMA,
+        "offset_sdr": ULTRAHDR_OFFSET,
+        "offset_hdr": ULTRAHDR_OFFSET,
+        "hdr_capacity_min": 0.0,
+        "hdr_capacity_max": max(gain_map_max, 0.0),
+    }
+
+
+# ============================================================================
+# REDUCED-RESOLUTION GAIN MAP
+# ============================================================================
+# With --gainmap-scale N the HDR and SDR linear light is area-averaged over
+# N x N blocks and the headroom, ratio, normalization, gamma and encoding run
+# on that 1/N^2 grid. Decoders upsample the map to the base image size.
+
+GAINMAP_SCALES = (1, 2, 4, 8)
+
+def downsample_area(image, scale):
+    """
+    Area-averaged downsampling of (H, W[, C]) float32 by an integer factor:
+    each output pixel is the mean of a scale x scale block. Partial blocks at
+    the right/bottom edges are completed by replicating the last row/column.
+    """
+    if scale == 1:
+        return image
+    image = np.asarray(image, dtype=np.float32)
+    height, width = image.shape[:2]
+    pad_h, pad_w = -height % scale, -width % scale
+    if pad_h or pad_w:
+        image = cv2.copyMakeBorder(image, 0, pad_h, 0, pad_w, cv2.BORDER_REPLICATE)
+    # INTER_AREA with an integer factor is an exact block mean
+    return cv2.resize(image, ((width + pad_w) // scale, (height + pad_h) // scale),
+                      interpolation=cv2.INTER_AREA)
+
+def reduced_shape(height, width, scale):
+    """Gain map grid size for an image of height x width at --gainmap-scale."""
+    return -(-height // scale), -(-width // scale)
+
+def gain_map_error(full_map, reduced_map):
+    """
+    Error of a reduced-resolution gain map against the full-resolution one,
+    after bilinear upsampling back to full size (as a decoder would).
+
+    Returns:
+        dict: mean_abs, p99_abs and max_abs in 8-bit code values, psnr_db
+    """
+    height, width = full_map.shape[:2]
+    upsampled = cv2.resize(reduced_map, (width, height), interpolation=cv2.INTER_LINEAR)
+    diff = np.abs(upsampled.astype(np.float32) - full_map.astype(np.float32))
+    mse = float(np.mean(diff ** 2))
+    return {
+        "mean_abs": float(diff.mean()),
+        "p99_abs": float(np.percentile(diff, 99)),
+        "max_abs": float(diff.max()),
+        "psnr_db": float(10 * np.log10(255.0 ** 2 / mse)) if mse > 0 else float("inf"),
+    }
+
+
+# ============================================================================
+# COMPUTE BACKENDS
+# ============================================================================
+# --backend numpy runs the strip stages above and is the reference.
+# --backend numba runs pass 1 and the full-resolution pass 2 of each strip
+# as one fused, parallel per-pixel loop (HDR_Backend), imported only then
+# so numba stays optional. The kernels cover uint16 sources with a float32
+# or fixed16 SDR base; the artifact cache, float16 storage and
+# reduced-resolution gain maps run on numpy.
+
+BACKENDS = ("numpy", "numba")
+
+# Threads per kernel launch in -j worker processes (set by _init_worker)
+_BACKEND_THREADS = None
+
+def load_backend(backend):
+    """The kernel module for a --backend choice, or None for numpy."""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown compute backend: {backend}")
+    if backend == "numpy":
+        return None
+    import HDR_Backend
+    if _BACKEND_THREADS is not None:
+        HDR_Backend.set_threads(_BACKEND_THREADS)
+    return HDR_Backend
+
+def backend_fallback(image, precision, staging_dir):
+    """Why the fused kernels cannot run pass 1 of this conversion, or None."""
+    if image.dtype != np.uint16:
+        return f"{image.dtype} source"
+    if precision == "float16":
+        return "float16 SDR storage"
+    if staging_dir is not None:
+        return "artifact cache"
+    return None
+
+
+# ============================================================================
+# INTERMEDIATE ARTIFACT CACHE
+# ============================================================================
+# With a cache directory, pass 1 writes its intermediates into a
+# content-addressed HDR_Cache entry: the LUT-mapped SDR base, the per-channel
+# gain ratio the gain map is encoded from, both luminance planes and the
+# headroom statistics. A later run with the same input bytes, LUT and LUT
+# parameters skips decode and LUT application entirely.
+
+# Bump when the meaning or layout of cached intermediates changes
+ARTIFACT_VERSION = 2
+
+DEFAULT_CACHE_MAX_GB = 20.0
+
+def artifact_key(input_file, lut_method, precision="float32"):
+    """Cache key: input content hash + LUT hash + pipeline parameters."""
+    # Default options add nothing, so keys cached before they existed stay valid
+    options = [] if precision == "float32" else [precision]
+    return HDR_Cache.cache_key(
+        ARTIFACT_VERSION,
+        HDR_Cache.file_digest(input_file),
+        lut_digest(LUT_PATH),
+        lut_method,
+        *options,
+    )
+
+def read_source_image(input_file, mmap_input=False):
+    """
+    Decodes the 16-bit source image, raising if it cannot be read. With
+    mmap_input an uncompressed 16-bit RGB TIFF is not decoded but mapped
+    (HDR_TIFF.map_bgr): a read-only BGR view whose rows are read from the
+    file as the strips use them. Other files still go through cv2.
+    """
+    if mmap_input:
+        image = HDR_TIFF.map_bgr(input_file)
+        if image is not None:
+            return image
+    image = cv2.imread(input_file, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise ValueError(f"Could not read converted image: {input_file}")
+    return image
+
+def write_image(output_path, image):
+    """cv2.imwrite that raises instead of returning False, via a temp name and rename."""
+    partial_path = HDR_Shard.partial_path(output_path)
+    if not cv2.imwrite(partial_path, image):
+        HDR_Shard.discard(partial_path)
+        raise OSError(f"Could not write image: {output_path}")
+    os.replace(partial_path, output_path)
+
+def write_output(write, stage_name, func, output_path, *args, nbytes=0):
+    """
+    Runs func(output_path, *args) now, timed as stage_name, or queues it on
+    the write-behind thread when write is given (see HDR_Pipeline).
+
+    Returns:
+        Future or None: The queued write, or None if it already ran
+    """
+    if write is not None:
+        return write(func, output_path, *args, nbytes=nbytes)
+    with stage(stage_name):
+        func(output_path, *args)
+        HDR_Profile.record_io(written=HDR_Profile.file_size(output_path))
+    return None
+
+def spill_array(shape, dtype):
+    """
+    Writable array backed by an unlinked temp file (in TMPDIR), so the OS
+    can write its pages back and evict them instead of holding the whole
+    array in RAM.
+    """
+    with tempfile.TemporaryFile() as f:
+        return np.memmap(f, dtype=dtype, mode="w+", shape=tuple(shape))
+
+def reuse_buffer(buffers, name, shape, dtype, spill=False):
+    """
+    np.empty(shape, dtype), or spill_array(shape, dtype) with spill set, or
+    the array kept under name in buffers (a dict owned by the caller) when
+    its shape and dtype match, so a run of same-sized images reuses its
+    arrays instead of faulting in new ones.
+    """
+    allocate = spill_array if spill else np.empty
+    if buffers is None:
+        return allocate(shape, dtype=dtype)
+    array = buffers.get(name)
+    if array is None or array.shape != tuple(shape) or array.dtype != dtype:
+        array = buffers[name] = allocate(shape, dtype=dtype)
+    return array
+
+def compute_intermediates(input_file, lut_method="trilinear", tile_budget_mb=None, staging_dir=None, image=None,
+                          buffers=None, precision="float32", mmap_input=False,
+                          backend="numpy", composite_lut=False):
+    """
+    Pass 1: decode, linearize and apply the LUT strip by strip, carrying
+    the global reductions (HDR max nits, max gain ratio) across strips, and
+    the 'nits_histogram' / 'ratio_histogram' sketches for percentile modes.
+
+    Returns (arrays, stats). arrays always holds 'sdr_base' and both sketches; when staging_dir
+    is given it also holds 'gain_ratio', 'lum_hdr' and 'lum_sdr', all written
+    as memory-mapped .npy files for the artifact cache. Otherwise it holds
+    'hdr_pq' and the 'pq_to_nits' function so pass 2 can recompute the HDR
+    strips instead of keeping them.
+
+    image, if given, is the already decoded source (read-ahead pipeline);
+    buffers, if given, supplies a reusable 'sdr_base' (see reuse_buffer).
+    With tile_budget_mb set, 'sdr_base' is a spill_array, so the full-size
+    SDR base does not count against the strips' budget.
+    precision selects the storage of 'sdr_base' (see PRECISIONS). mmap_input
+    maps uncompressed TIFF sources instead of decoding them (see read_source_image).
+    backend "numba" runs each strip through HDR_Backend.pass1 where it can
+    (see backend_fallback) and leaves the kernels in arrays['kernels'] for
+    pass 2; composite_lut makes both kernels decode a float32 SDR base with
+    composite_decode_table, left in arrays['srgb_decode'].
+    """
+    if image is not None:
+        img_p3_pq_U16 = image
+    else:
+        with stage("decode"):
+            img_p3_pq_U16 = read_source_image(input_file, mmap_input)
+            HDR_Profile.record_io(read=HDR_Profile.file_size(input_file))
+    if img_p3_pq_U16.dtype == np.uint16:
+        # apply_lut normalizes uint16 codes chunk by chunk
+        img_p3_pq_normalized_float = img_p3_pq_U16
+        pq_to_nits = pq_u16_to_absolute_nits
+    else:
         img_p3_pq_normalized_float = img_p3_pq_U16.astype(np.float32) / 65535.0
-        img_P3_linear_absolute_nits = normalized_pq_to_absolute_nits(img_p3_pq_normalized_float)
-        hdr_max_nits = np.max(img_P3_linear_absolute_nits)
-        print(f"  HDR Max Nits: {hdr_max_nits:.2f}")
+        pq_to_nits = normalized_pq_to_absolute_nits
+
+    height, width = img_p3_pq_U16.shape[:2]
+    strips = image_strips(height, width, tile_budget_mb)
+    if len(strips) > 1:
+        print(f"  Streaming {len(strips)} strips of {strips[0][1]} rows")
+
+    print(f"  Applying LUT for SDR base: {LUT_FILENAME}")
+    with stage("lut_load"):
+        lut_3d = load_cube_lut(LUT_PATH)
+
+    sdr_dtype = SDR_STORAGE[precision]
+    if precision != "float32":
+        print(f"  SDR base storage: {precision}")
+    if staging_dir is None:
+        arrays = {
+            "sdr_base": reuse_buffer(buffers, "sdr_base", img_p3_pq_U16.shape, sdr_dtype,
+                                     spill=tile_budget_mb is not None),
+            "hdr_pq": img_p3_pq_normalized_float,
+            "pq_to_nits": pq_to_nits,
+        }
+    else:
+        arrays = {
+            "sdr_base": HDR_Cache.stage_array(staging_dir, "sdr_base", img_p3_pq_U16.shape, sdr_dtype),
+            "gain_ratio": HDR_Cache.stage_array(staging_dir, "gain_ratio", img_p3_pq_U16.shape, np.float32),
+            "lum_hdr": HDR_Cache.stage_array(staging_dir, "lum_hdr", (height, width), np.float32),
+            "lum_sdr": HDR_Cache.stage_array(staging_dir, "lum_sdr", (height, width), np.float32),
+        }
+
+    kernels = load_backend(backend)
+    if kernels is not None:
+        fallback = backend_fallback(img_p3_pq_U16, precision, staging_dir)
+        if fallback is not None:
+            print(f"  Backend {backend}: not used with {fallback}, running numpy")
+            kernels = None
+
+    # LUT (P3 PQ → sRGB gamma) plus global maxima and their sketches
+    hdr_max_nits = 0.0
+    max_ratio = 0.0
+    nits_histogram = log_histogram()
+    ratio_histogram = log_histogram()
+    if kernels is not None:
+        # Fused: PQ decode, LUT, SDR store and headroom in one loop per strip
+        arrays["kernels"] = kernels
+        if composite_lut and precision == "float32":
+            arrays["srgb_decode"] = composite_decode_table()
+        pq_table = pq_u16_table()
+        code_counts = np.zeros(65536, dtype=np.int64)
+        with stage("fused_pass1"):
+            for top, bottom in strips:
+                counts, ratio = kernels.pass1(img_p3_pq_U16[top:bottom], pq_table, srgb_u16_table(), lut_3d,
+                                              lut_method == "tetrahedral", arrays["sdr_base"][top:bottom],
+                                              ratio_histogram, LOG_HISTOGRAM_RANGE[0], LOG_HISTOGRAM_BINS_PER_STOP,
+                                              arrays.get("srgb_decode"))
+                code_counts += counts
+                max_ratio = max(max_ratio, ratio)
+            hdr_max_nits = float(pq_table[np.flatnonzero(code_counts)].max())
+            log_histogram_add(nits_histogram, pq_table, code_counts)
+    else:
+        for top, bottom in strips:
+            with stage("pq_linearize"):
+                img_P3_linear_absolute_nits = pq_to_nits(img_p3_pq_normalized_float[top:bottom])
+                hdr_max_nits = max(hdr_max_nits, float(np.max(img_P3_linear_absolute_nits)))
+                if img_p3_pq_normalized_float.dtype == np.uint16:
+                    add_pq_code_histogram(nits_histogram, img_p3_pq_normalized_float[top:bottom])
+                else:
+                    log_histogram_add(nits_histogram, img_P3_linear_absolute_nits)
+
+            with stage("lut"):
+                sdr_strip = arrays["sdr_base"][top:bottom]
+                apply_lut(img_p3_pq_normalized_float[top:bottom], lut_3d, lut_method, out=sdr_strip)
+
+            with stage("headroom"):
+                if staging_dir is None:
+                    ratio = fused_max_gain_ratio(img_P3_linear_absolute_nits, sdr_strip, ratio_histogram)
+                    max_ratio = max(max_ratio, ratio)
+                else:
+                    img_sRGB_linear_absolute_nits = srgb_to_absolute_nits(sdr_strip)
+                    lum_hdr = arrays["lum_hdr"][top:bottom]
+                    lum_sdr = arrays["lum_sdr"][top:bottom]
+                    lum_hdr[...] = luminance_bgr(img_P3_linear_absolute_nits)
+                    lum_sdr[...] = luminance_bgr(img_sRGB_linear_absolute_nits)
+                    ratio = lum_hdr / np.maximum(lum_sdr, 1e-6)
+                    max_ratio = max(max_ratio, float(np.max(ratio)))
+                    log_histogram_add(ratio_histogram, ratio)
+
+            if staging_dir is not None:
+                with stage("cache_store"):
+                    arrays["gain_ratio"][top:bottom] = gain_ratio(img_P3_linear_absolute_nits, img_sRGB_linear_absolute_nits)
+
+    for name, histogram in (("nits_histogram", nits_histogram), ("ratio_histogram", ratio_histogram)):
+        if staging_dir is None:
+            arrays[name] = histogram
+        else:
+            arrays[name] = HDR_Cache.stage_array(staging_dir, name, histogram.shape, histogram.dtype)
+            arrays[name][...] = histogram
+
+    stats = {
+        "hdr_max_nits": hdr_max_nits,
+        "max_gain_ratio": max_ratio,
+        "shape": list(img_p3_pq_U16.shape),
+    }
+    return arrays, stats
+
+
+def encode_full_resolution(arrays, stats, estimated_headroom, tile_budget_mb=None, with_log_gain=False,
+                           buffers=None):
+    """
+    Pass 2 at source resolution, strip by strip, into arrays from buffers
+    when given (see reuse_buffer), spilled to temp files with tile_budget_mb
+    set; by HDR_Backend.pass2 when pass 1 left its 'kernels' in arrays.
+
+    Returns:
+        tuple: (gain_map_uint8, log_gain_plane or None)
+    """
+    height, width = stats["shape"][:2]
+    spill = tile_budget_mb is not None
+    gain_map_uint8 = reuse_buffer(buffers, "gain_map", (height, width), np.uint8, spill)
+    log_gain_plane = reuse_buffer(buffers, "log_gain", (height, width), np.float32, spill) if with_log_gain else None
+    for top, bottom in image_strips(height, width, tile_budget_mb):
+        if "gain_ratio" in arrays:
+            gain_map_uint8[top:bottom] = encode_gain_ratio(arrays["gain_ratio"][top:bottom], estimated_headroom)
+            if log_gain_plane is not None:
+                log_gain_plane[top:bottom] = log_gain(arrays["lum_hdr"][top:bottom], arrays["lum_sdr"][top:bottom])
+        elif "kernels" in arrays:
+            arrays["kernels"].pass2(arrays["hdr_pq"][top:bottom], pq_u16_table(), srgb_u16_table(),
+                                    arrays["sdr_base"][top:bottom], estimated_headroom, gain_map_uint8[top:bottom],
+                                    None if log_gain_plane is None else log_gain_plane[top:bottom],
+                                    1.0 / SDR_WHITE_NITS, ULTRAHDR_OFFSET, arrays.get("srgb_decode"))
+        else:
+            img_P3_linear_absolute_nits = arrays["pq_to_nits"](arrays["hdr_pq"][top:bottom])
+            img_sRGB_linear_absolute_nits = srgb_to_absolute_nits(arrays["sdr_base"][top:bottom])
+            gain_map_uint8[top:bottom] = encode_gain_map(img_P3_linear_absolute_nits, img_sRGB_linear_absolute_nits, estimated_headroom)
+            if log_gain_plane is not None:
+                log_gain_plane[top:bottom] = log_gain(luminance_bgr(img_P3_linear_absolute_nits),
+                                                      luminance_bgr(img_sRGB_linear_absolute_nits))
+    return gain_map_uint8, log_gain_plane
+
+def _strip_linear_nits(arrays, top, bottom):
+    """HDR and SDR linear nits of one strip, from cached or recomputed pass 1 data."""
+    img_sRGB_linear_absolute_nits = srgb_to_absolute_nits(arrays["sdr_base"][top:bottom])
+    if "gain_ratio" in arrays:
+        img_P3_linear_absolute_nits = arrays["gain_ratio"][top:bottom] * np.maximum(img_sRGB_linear_absolute_nits, 1e-6)
+    else:
+        img_P3_linear_absolute_nits = arrays["pq_to_nits"](arrays["hdr_pq"][top:bottom])
+    return img_P3_linear_absolute_nits, img_sRGB_linear_absolute_nits
+
+def reduced_grids(arrays, stats, scale, tile_budget_mb=None):
+    """
+    HDR and SDR linear light area-averaged strip by strip into 1/scale grids.
+
+    Returns:
+        tuple: (hdr_small, sdr_small), float32 absolute nits
+    """
+    height, width = stats["shape"][:2]
+    small_shape = reduced_shape(height, width, scale) + (3,)
+    hdr_small = np.empty(small_shape, dtype=np.float32)
+    sdr_small = np.empty(small_shape, dtype=np.float32)
+    for top, bottom in image_strips(height, width, tile_budget_mb, align=scale):
+        img_P3_linear_absolute_nits, img_sRGB_linear_absolute_nits = _strip_linear_nits(arrays, top, bottom)
+        rows = slice(top // scale, -(-bottom // scale))
+        hdr_small[rows] = downsample_area(img_P3_linear_absolute_nits, scale)
+        sdr_small[rows] = downsample_area(img_sRGB_linear_absolute_nits, scale)
+    return hdr_small, sdr_small
+
+def reduced_ratio_stats(grids):
+    """
+    The gain ratio sketch and maximum over reduced_grids' output, the
+    reduced-grid counterparts of pass 1's ratio_histogram and max_gain_ratio.
+
+    Returns:
+        tuple: (ratio_histogram, max_gain_ratio)
+    """
+    hdr_small, sdr_small = grids
+    ratio = luminance_bgr(hdr_small) / np.maximum(luminance_bgr(sdr_small), 1e-6)
+    return log_histogram_add(log_histogram(), ratio), float(ratio.max())
+
+def encode_reduced_resolution(arrays, stats, scale, tile_budget_mb=None, with_log_gain=False,
+                              headroom_percentile=100.0, headroom=None, grids=None):
+    """
+    Pass 2 at 1/scale resolution: HDR and SDR linear light are area-averaged
+    strip by strip into small grids (reduced_grids, unless grids are given),
+    then the headroom (at headroom_percentile of the grid's ratios, unless a
+    fixed headroom is given), ratio, normalization, gamma and encoding all
+    run on those grids.
+
+    Returns:
+        tuple: (gain_map_uint8, log_gain_plane or None, estimated_headroom)
+    """
+    if grids is None:
+        grids = reduced_grids(arrays, stats, scale, tile_budget_mb)
+    hdr_small, sdr_small = grids
+
+    if headroom is None:
+        ratio_histogram, max_gain_ratio = reduced_ratio_stats(grids)
+        estimated_headroom = max(log_histogram_quantile(ratio_histogram, headroom_percentile / 100.0, max_gain_ratio), 1.0)
+    else:
+        estimated_headroom = headroom
+    gain_map_uint8 = encode_gain_map(hdr_small, sdr_small, estimated_headroom)
+    log_gain_plane = log_gain(luminance_bgr(hdr_small), luminance_bgr(sdr_small)) if with_log_gain else None
+    return gain_map_uint8, log_gain_plane, estimated_headroom
+
+
+def load_intermediates(input_file, lut_method="trilinear", tile_budget_mb=None, cache_dir=None,
+                       cache_max_gb=DEFAULT_CACHE_MAX_GB, image=None, buffers=None, precision="float32",
+                       mmap_input=False, backend="numpy", composite_lut=False):
+    """
+    Pass 1 of convert_to_avif_gainmap: compute_intermediates, or with
+    cache_dir set a lookup in / store to the artifact cache, which is
+    trimmed to cache_max_gb afterwards.
+
+    Returns:
+        tuple: (arrays, stats) as from compute_intermediates
+    """
+    # Generate SDR using ACES LUT 
+    if not os.path.exists(LUT_PATH):
+        raise FileNotFoundError(f"LUT not found: {LUT_FILENAME}")
+
+    cached = None
+    if cache_dir is not None:
+        with stage("cache_lookup"):
+            key = artifact_key(input_file, lut_method, precision)
+            cached = HDR_Cache.cache_lookup(cache_dir, key)
+
+    if cached is not None:
+        print(f"  Using cached intermediates: {key[:16]}")
+        return cached
+    if cache_dir is None:
+        return compute_intermediates(input_file, lut_method, tile_budget_mb, image=image, buffers=buffers,
+                                     precision=precision, mmap_input=mmap_input,
+                                     backend=backend, composite_lut=composite_lut)
+
+    staging_dir = HDR_Cache.cache_stage(cache_dir)
+    try:
+        arrays, stats = compute_intermediates(input_file, lut_method, tile_budget_mb, staging_dir, image,
+                                              precision=precision, mmap_input=mmap_input, backend=backend,
+                                              composite_lut=composite_lut)
+        for array in arrays.values():
+            array.flush()
+    except BaseException:
+        HDR_Cache.cache_abort(staging_dir)
+        raise
+    with stage("cache_store"):
+        HDR_Cache.cache_commit(cache_dir, key, staging_dir, stats)
+        HDR_Cache.cache_evict(cache_dir, int(cache_max_gb * 1024 ** 3))
+    return arrays, stats
+
+
+def convert_to_avif_gainmap(input_file, output_file, lut_method="trilinear", tile_budget_mb=None,
+                            cache_dir=None, cache_max_gb=DEFAULT_CACHE_MAX_GB, intermediates_dir=None,
+                            container="none", gainmap_scale=1, gainmap_error=False,
+                            headroom_percentile=100.0, image=None, write=None,
+                            intermediates=None, window_stats=None, buffers=None, precision="float32",
+                            mmap_input=False, backend="numpy", composite_lut=False, grids=None):
+    """
+    Generates the LUT-based SDR base and the gain map for one HDR image.
+
+    With tile_budget_mb set, the image is processed in horizontal strips so the
+    float intermediates stay within that budget whatever the resolution, and
+    the full-size SDR base and gain map are spilled to memory-mapped temp
+    files (spill_array). The decoded source (unless mmap_input maps it) and
+    the output encoders still hold whole images. Pass 1
+    (compute_intermediates) applies the LUT and carries the global reductions
+    across strips; pass 2 encodes the gain map, which needs the final headroom.
+
+    With cache_dir set, pass 1 results are looked up in / stored to the
+    artifact cache, which is trimmed to cache_max_gb afterwards
+    (load_intermediates).
+
+    The SDR base is handed to the encode stage in memory, via the returned
+    dict: sdr_base (BGR 0-1 in the --precision storage: float32, float16 or
+    uint16 fixed-point), gain_map (uint8), hdr_max_nits and
+    estimated_headroom. With intermediates_dir set (--keep-intermediates) the
+    SDR base is also written there as <name>_sdr.tif for debugging.
+
+    With container="ultrahdr", output_file is written as an Ultra HDR JPEG
+    (HDR_UltraHDR) and the dict also carries its ultrahdr_metadata.
+
+    With gainmap_scale N > 1 the gain maps and their headroom are computed on
+    an area-averaged 1/N grid (encode_reduced_resolution); gainmap_error also
+    encodes the full-resolution map and reports the difference.
+
+    headroom_percentile below 100 takes the headroom, the reported HDR nits
+    and the Ultra HDR gain range from the streaming sketches at that
+    percentile instead of the plain max, so isolated hot pixels are ignored.
+
+    image and write come from the batch pipeline: image is the source already
+    decoded by the read-ahead thread, and write queues the output files on
+    the write-behind thread; their futures are returned under 'writes'.
+
+    intermediates, window_stats, buffers and grids come from sequence mode
+    (process_sequence): intermediates is the frame's (arrays, stats) from an
+    earlier load_intermediates call, window_stats replaces the frame's own
+    maxima and sketches with those of its temporal window (so the headroom,
+    reported nits and Ultra HDR GainMapMax follow the window, and a reduced
+    grid uses the window headroom), buffers lends pass 2 its arrays, and
+    grids are the frame's reduced_grids when gainmap_scale > 1, whose ratio
+    statistics the window was built from.
+
+    precision stores the SDR base as float16 or uint16 fixed-point instead of
+    float32 (see PRECISIONS); HDR_Benchmark --precision reports the error
+    against the default. mmap_input
+    maps uncompressed 16-bit TIFF sources instead of decoding them (HDR_TIFF).
+
+    backend selects the compute backend (see BACKENDS): "numba" runs both
+    passes as fused per-pixel kernels where they apply (HDR_Backend);
+    HDR_Benchmark --backend checks them against the numpy reference.
+    composite_lut has the kernels decode a float32 SDR base from a baked
+    table (see composite_decode_table; no effect on numpy).
+
+    Raises on any failure so batch callers can record it and carry on.
+    """
+
+    # ====================================================================
+    # DATA FLOW: Image Loading and Transformation Pipeline
+    # ====================================================================
+    # input_file (string: file path to 16-bit TIFF)
+    #     ↓ cv2.imread(IMREAD_UNCHANGED), or a memory map of an uncompressed TIFF (mmap_input)
+    # img_p3_pq (uint16: 0-65535, "unsigned quantized")
+    #     ↓ per strip: pq_u16_table() lookup (float path: astype(float32) / 65535.0)
+    # img_P3_linear_absolute_nits (float32: 0-10000, "P3 D65 absolute luminance")
+    # ====================================================================
     
-        
-        # Generate SDR using ACES LUT 
-        lut_filename = "ACES20_P3D65PQ1000D60_to_sRGBPW.cube"
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        lut_path = os.path.join(script_dir, lut_filename)
-        
-        if os.path.exists(lut_path):
-            print(f"  Applying LUT for SDR base: {lut_filename}")
-            lut_3d = read_cube_lut(lut_path)
-                
-            # Apply LUT (P3 PQ → sRGB gamma), convert to float32, and clip
-            img_sdr_srgb_normalized_float = np.clip(apply_lut(img_p3_pq_normalized_float, lut_3d).astype(np.float32), 0, 1)
-
-            # Save SDR temp file for Swift conversion
-            cv2.imwrite(str_filepath_sdr_srgb_from_LUT, img_sdr_srgb_normalized_float)
-                
-            # Calculate Headroom
-            sdr_linear_display = np.where(img_sdr_srgb_normalized_float <= 0.04045,
-                                     img_sdr_srgb_normalized_float / 12.92,
-                                     ((img_sdr_srgb_normalized_float + 0.055) / 1.055) ** 2.4)
-            sdr_white_nits = 203.0
-            img_sRGB_linear_absolute_nits = sdr_linear_display * sdr_white_nits
-        
-            # Calculate HDR luminance per pixel (BGR order in OpenCV)
-            lum_hdr = 0.2126 * img_P3_linear_absolute_nits[:,:,2] + 0.7152 * img_P3_linear_absolute_nits[:,:,1] + 0.0722 * img_P3_linear_absolute_nits[:,:,0]
-        
-            # Calculate SDR luminance per pixel (BGR order in OpenCV)
-            lum_sdr = 0.2126 * img_sRGB_linear_absolute_nits[:,:,2] + 0.7152 * img_sRGB_linear_absolute_nits[:,:,1] + 0.0722 * img_sRGB_linear_absolute_nits[:,:,0]
-        
-            # Prevent division by zero: replace any values < 1e-6 with 1e-6
-            sdr_safe = np.maximum(lum_sdr, 1e-6)
-        
-            # Calculate gain ratio per pixel: HDR luminance / SDR luminance
-            # Result is a 2D array where each element is the gain ratio for that pixel
-            gain_ratio = lum_hdr / sdr_safe
-        
-            # Find the maximum gain ratio across ***ALL pixels***
-            # This represents the worst-case gain needed anywhere in the image
-            estimated_headroom = np.max(gain_ratio)
-            estimated_headroom = max(estimated_headroom, 1.0)
-        
-            print(f"  Estimated Headroom: {estimated_headroom:.2f} ({np.log2(estimated_headroom):.2f} stops)")
+    if intermediates is None:
+        intermediates = load_intermediates(input_file, lut_method, tile_budget_mb, cache_dir, cache_max_gb,
+                                           image, buffers, precision, mmap_input, backend,
+                                           composite_lut)
+    arrays, stats = intermediates
+
+    # Headroom statistics: the frame's own, or its temporal window's
+    if window_stats is None:
+        window_stats = {
+            "hdr_max_nits": stats["hdr_max_nits"],
+            "max_gain_ratio": stats["max_gain_ratio"],
+            "nits_histogram": arrays["nits_histogram"],
+            "ratio_histogram": arrays["ratio_histogram"],
+            "frames": 1,
+        }
+    elif window_stats["frames"] > 1:
+        print(f"  Temporal window: {window_stats['frames']} frames")
+
+    quantile = headroom_percentile / 100.0
+    hdr_max_nits = log_histogram_quantile(window_stats["nits_histogram"], quantile, window_stats["hdr_max_nits"])
+    if quantile < 1.0:
+        print(f"  HDR P{headroom_percentile:g} Nits: {hdr_max_nits:.2f} (max {window_stats['hdr_max_nits']:.2f})")
+    else:
+        print(f"  HDR Max Nits: {hdr_max_nits:.2f}")
+
+    output_dir = os.path.dirname(output_file)
+    output_basename = os.path.splitext(os.path.basename(output_file))[0]
+    written = "saved" if write is None else "queued"
+    writes = []
 
-            # Export gain map as PNG for visualization (LUT version only)
-            output_dir = os.path.dirname(output_file)
-            output_basename = os.path.splitext(os.path.basename(output_file))[0]
-            gainmap_png_path = os.path.join(output_dir, f"{output_basename}_gainmap.png")
-            export_gain_map_png(img_P3_linear_absolute_nits, img_sRGB_linear_absolute_nits, estimated_headroom, gainmap_png_path)
+    # Debug copy of the SDR base; the pipeline itself never reads it back
+    img_sdr_srgb_normalized_float = arrays["sdr_base"]
+    if intermediates_dir is not None:
+        sdr_debug_path = os.path.join(intermediates_dir, f"{output_basename}_sdr.tif")
+        writes.append(write_output(write, "sdr_write", write_image, sdr_debug_path,
+                                   sdr_as_float32(img_sdr_srgb_normalized_float),
+                                   nbytes=img_sdr_srgb_normalized_float.nbytes))
+        print(f"  ✓ SDR intermediate {written}: {sdr_debug_path}")
 
+    # The maximum gain ratio across ***ALL pixels*** represents the
+    # worst-case gain needed anywhere in the image; a percentile below 100
+    # reads it from the ratio sketch instead. A reduced-resolution map
+    # replaces it with the same statistic over its own grid in pass 2.
+    estimated_headroom = max(log_histogram_quantile(window_stats["ratio_histogram"], quantile,
+                                                    window_stats["max_gain_ratio"]), 1.0)
+    if gainmap_scale == 1:
+        print(f"  Estimated Headroom: {estimated_headroom:.2f} ({np.log2(estimated_headroom):.2f} stops)")
+
+    # Pass 2: gain map, normalized by the now-known headroom. For a container
+    # the log2 luminance gain plane is collected in the same loop.
+    height, width = stats["shape"][:2]
+    with_log_gain = container == "ultrahdr"
+    with stage("gainmap_encode"):
+        if gainmap_scale == 1:
+            gain_map_uint8, log_gain_plane = encode_full_resolution(
+                arrays, stats, estimated_headroom, tile_budget_mb, with_log_gain, buffers)
         else:
-            print(f"  ⚠ LUT not found: {lut_filename}.")
-            exit(1)
+            gain_map_uint8, log_gain_plane, estimated_headroom = encode_reduced_resolution(
+                arrays, stats, gainmap_scale, tile_budget_mb, with_log_gain, headroom_percentile,
+                estimated_headroom if window_stats["frames"] > 1 else None, grids)
+    if gainmap_scale != 1:
+        print(f"  Gain map at 1/{gainmap_scale}: {gain_map_uint8.shape[1]}x{gain_map_uint8.shape[0]}, "
+              f"headroom {estimated_headroom:.2f} ({np.log2(estimated_headroom):.2f} stops)")
 
-    except Exception as e:
-        print(f"Error: {e}")
-        sys.exit(1)
+    result = {
+        "sdr_base": img_sdr_srgb_normalized_float,
+        "gain_map": gain_map_uint8,
+        "hdr_max_nits": hdr_max_nits,
+        "estimated_headroom": estimated_headroom,
+    }
+
+    # Reference: the full-resolution map with the same headroom, so only the
+    # loss from the reduced grid is measured
+    if gainmap_error and gainmap_scale != 1:
+        with stage("gainmap_error"):
+            full_map, _ = encode_full_resolution(arrays, stats, estimated_headroom, tile_budget_mb, False)
+            error = gain_map_error(full_map, gain_map_uint8)
+        print(f"  Gain map error vs full resolution: mean {error['mean_abs']:.2f}, "
+              f"p99 {error['p99_abs']:.0f}, max {error['max_abs']:.0f} codes, PSNR {error['psnr_db']:.1f} dB "
+              f"(full-res max headroom {max(stats['max_gain_ratio'], 1.0):.2f})")
+        result["gainmap_error"] = error
+
+    # Ultra HDR JPEG assembled in-process from the in-memory arrays
+    if log_gain_plane is not None:
+        with stage("gainmap_encode"):
+            gain_map_min = float(log_gain_plane.min())
+            gain_map_max = float(log_gain_plane.max())
+            if quantile < 1.0:
+                gain_sketch = log_histogram_add(log_histogram(), np.exp2(log_gain_plane))
+                gain_map_min = float(np.log2(log_histogram_quantile(gain_sketch, 1.0 - quantile, 2.0 ** gain_map_max)))
+                gain_map_max = float(np.log2(log_histogram_quantile(gain_sketch, quantile, 2.0 ** gain_map_max)))
+            if window_stats["frames"] > 1:
+                # The window headroom bounds every frame's offset log gain
+                gain_map_max = max(float(np.log2(estimated_headroom)), gain_map_min)
+            metadata = ultrahdr_metadata(gain_map_min, gain_map_max)
+            ultrahdr_gain_map = encode_log_gain(log_gain_plane, gain_map_min, gain_map_max)
+        writes.append(write_output(write, "container_write", HDR_UltraHDR.write_ultrahdr_jpeg, output_file,
+                                   img_sdr_srgb_normalized_float, ultrahdr_gain_map, metadata,
+                                   nbytes=img_sdr_srgb_normalized_float.nbytes + ultrahdr_gain_map.nbytes))
+        print(f"  ✓ Ultra HDR JPEG {written}: {output_file} "
+              f"(gain {gain_map_min:.2f} to {gain_map_max:.2f} stops)")
+        result["ultrahdr_metadata"] = metadata
+
+    # Export gain map as PNG for visualization (LUT version only)
+    gainmap_png_path = os.path.join(output_dir, f"{output_basename}_gainmap.png")
+    writes.append(write_output(write, "png_write", write_image, gainmap_png_path, gain_map_uint8,
+                               nbytes=gain_map_uint8.nbytes))
+    print(f"  ✓ tmp gain map {written} for visual check: {gainmap_png_path}")
+
+    result["writes"] = [future for future in writes if future is not None]
+    return result
 
 # ============================================================================
 # BATCH PROCESSING FUNCTION
 # ============================================================================
 
-def process_directory(directory):
-    script_dir = os.path.dirname(os.path.abspath(__file__))
+SUPPORTED_EXTENSIONS = (".tif", ".tiff", ".jpg", ".jpeg", ".png")
+
+def _init_worker(profiling=False, backend_threads=None):
+    """
+    Pool initializer: load the LUT and PQ table once per worker process, and
+    share the cores between the workers' backend kernels (see load_backend).
+    """
+    global _BACKEND_THREADS
+    _BACKEND_THREADS = backend_threads
+    HDR_Profile.enable(profiling)
+    if os.path.exists(LUT_PATH):
+        load_cube_lut(LUT_PATH)
+    pq_u16_table()
+
+def run_conversion(file_path, output, convert_options):
+    """
+    Runs one conversion inside an HDR_Profile file record.
+    Returns (error or None, profile record or None).
+    """
+    HDR_Profile.start_file(file_path)
+    error = None
+    try:
+        convert_to_avif_gainmap(file_path, output, **convert_options)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    record = HDR_Profile.finish_file("ok" if error is None else "failed", error)
+    return error, record
+
+def _convert_task(file_path, output, convert_options):
+    """
+    Runs one conversion in a worker with its output captured, so the parent
+    can print logs in submission order. Returns (log, error or None, record).
+    """
+    log = StringIO()
+    with redirect_stdout(log):
+        error, record = run_conversion(file_path, output, convert_options)
+    return log.getvalue(), error, record
+
+def _claimed_convert_task(name, file_path, output, convert_options, claim_dir, claim_ttl):
+    """
+    _convert_task under a claim on the batch item name (see
+    HDR_Shard.run_claimed). A claim left by a worker of this batch that died
+    on the item (see process_directory) is released first.
+    """
+    HDR_Shard.break_dead_claim(claim_dir, name)
+    return HDR_Shard.run_claimed(claim_dir, name,
+                                 lambda: _convert_task(file_path, output, convert_options),
+                                 lambda: conversion_done(output, convert_options.get("container")), claim_ttl)
+
+def _load_source(file_path, mmap_input=False):
+    """Read-ahead loader: the decoded (or mapped) source."""
+    return read_source_image(file_path, mmap_input)
+
+def _source_nbytes(file_path, mmap_input=False):
+    """
+    Read budget charge of a source, known before it is decoded: its decoded
+    size from the TIFF header, or its file size for other formats. A mapped
+    source costs nothing: its pages are page cache the kernel can drop, read
+    when pass 1 reaches them.
+    """
+    if mmap_input and HDR_TIFF.source_layout(file_path) is not None:
+        return 0
+    nbytes = HDR_TIFF.decoded_nbytes(file_path)
+    return nbytes if nbytes is not None else HDR_Profile.file_size(file_path)
+
+def settle_writes(pending_writes, block, settled=None):
+    """
+    Settles queued writes in file order: pops (filename, converted, futures)
+    entries off pending_writes while their futures are done, or all of them
+    with block. A failed write of a converted file is reported; settled, if
+    given, is called with each converted file whose writes all succeeded.
+
+    Returns:
+        int: Converted files whose writes failed
+    """
+    failed_writes = 0
+    while pending_writes and (block or all(f.done() for f in pending_writes[0][2])):
+        filename, converted, futures = pending_writes.pop(0)
+        errors = [e for e in (f.exception() for f in futures) if e is not None]
+        if errors and converted:
+            print(f"  ✗ Write failed for {filename}: {type(errors[0]).__name__}: {errors[0]}")
+            failed_writes += 1
+        elif converted and settled is not None:
+            settled(filename)
+    return failed_writes
+
+def batch_output(converted_dir, relative_path, extension):
+    """Output of a batch file below converted_dir, in the same subdirectory as its source."""
+    output = os.path.join(converted_dir, os.path.splitext(relative_path)[0] + extension)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    return output
+
+def process_directory(directory, jobs=1, records=None, show_profile=False,
+                      pipeline_depth=0, pipeline_memory_mb=HDR_Pipeline.DEFAULT_MEMORY_MB,
+                      sequence=False, temporal_window=1, shard=None, claim_dir=None,
+                      claim_ttl=HDR_Shard.DEFAULT_CLAIM_TTL_S, recursive=False, largest_first=False,
+                      journal=None, **convert_options):
+    """
+    Converts every supported image in directory, and with recursive in its
+    subdirectories too (outputs mirror the subdirectories). Files are
+    streamed from the directory walk (HDR_Walk) into the loop below, so the
+    first conversion starts without listing the whole tree; largest_first
+    and sequence need every name first and list it up front.
+
+    With jobs > 1 the files are spread over a process pool, started a few
+    files ahead of the one being reported; logs are still printed in file
+    order and a failing file is reported without stopping the batch.
+
+    With jobs == 1 and pipeline_depth > 0 the batch is pipelined
+    (HDR_Pipeline): a reader thread decodes up to pipeline_depth images
+    ahead and a writer thread writes the outputs behind compute, within
+    pipeline_memory_mb of queued images. Decode and write time then leave
+    the per-file stage tables, and a failed write is reported when it
+    surfaces, turning that file into a failure.
+
+    With sequence, numbered frames are grouped (detect_sequences) and each
+    sequence is converted after the other files by process_sequence, in this
+    process and with the given temporal_window.
+
+    When HDR_Profile is enabled, each file's record is appended to records
+    and, with show_profile, printed after the file's log.
+
+    For batches split over several nodes (HDR_Shard): shard (i, N) keeps
+    only this node's share of the files, sequences going whole to one
+    shard; with claim_dir each file or sequence is claimed right before it
+    is converted, and items claimed or finished by another node are skipped.
+
+    With journal, each file (or sequence) is appended to that journal file
+    once converted and written, and items already in it are skipped, so an
+    interrupted batch resumes where it stopped.
+
+    Returns:
+        tuple: (successful_count, failed_count, skipped_count)
+    """
     parent_dir = os.path.dirname(os.path.abspath(directory))
     converted_dir = os.path.join(parent_dir, "converted_gainmap")
     os.makedirs(converted_dir, exist_ok=True)
-    
-    SUPPORTED_EXTENSIONS = (".tif", ".tiff", ".jpg", ".jpeg", ".png")
-    
+    container = convert_options.get("container")
+    extension = output_extension(container)
+
     try:
-        files = os.listdir(directory)
+        entries = HDR_Walk.walk_images(directory, SUPPORTED_EXTENSIONS, recursive, ordered=not largest_first)
     except PermissionError:
         print(f"✗ Error: Permission denied: {directory}")
-        return
-    
-    image_files = [f for f in files if f.lower().endswith(SUPPORTED_EXTENSIONS)]
-    
-    if not image_files:
+        return (0, 0, 0)
+
+    sequences = []
+    if largest_first:
+        entries = HDR_Walk.largest_first(entries)
+    if sequence:
+        entries = list(entries)
+        sequences, others = detect_sequences([path for path, _ in entries])
+        others = set(others)
+        entries = [entry for entry in entries if entry[0] in others]
+
+    done = set()
+    record_done = None
+    if journal is not None:
+        done, record_done = HDR_Walk.open_journal(journal)
+        print(f"Journal {journal}: {len(done)} item(s) already done")
+
+    seen = {"found": 0, "other_shard": 0, "journaled": 0}
+    def keep(name):
+        seen["found"] += 1
+        if not HDR_Shard.in_shard(name, shard):
+            seen["other_shard"] += 1
+            return False
+        if name in done:
+            seen["journaled"] += 1
+            return False
+        return True
+
+    def walk_tasks():
+        for path, _ in entries:
+            if keep(path):
+                output = batch_output(converted_dir, path, extension)
+                yield path, os.path.join(directory, path), output, conversion_done(output, container)
+
+    sequences = [(label, frames) for label, frames in sequences if keep(label)]
+    tasks = walk_tasks()
+    if isinstance(entries, list):
+        tasks = list(tasks)
+        frame_count = sum(len(frames) for _, frames in sequences)
+        print(f"Found {len(tasks) + frame_count} images. Generating LUT and Swift versions for each.\n")
+    else:
+        where = " and its subdirectories" if recursive else ""
+        print(f"Streaming images from {directory}{where}. Generating LUT and Swift versions for each.\n")
+
+    if claim_dir is not None:
+        print(f"Claiming items in {claim_dir} (stale after {claim_ttl:g}s)\n")
+
+    for label, frames in sequences:
+        print(f"Sequence {label}: {len(frames)} frames")
+    if sequences:
+        print()
+
+    successful = 0
+    failed = 0
+    skipped = 0
+
+    # Conversions are started `ahead` files before the loop reports them
+    ahead = 0
+    executor = None
+    worker_args = (HDR_Profile.is_enabled(), max(1, (os.cpu_count() or 1) // jobs))
+    def start_workers(max_workers):
+        # Forked workers must not inherit (and later re-flush) buffered output
+        sys.stdout.flush()
+        return ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=worker_args)
+    if jobs > 1:
+        print(f"Using {jobs} worker processes\n")
+        # The pool is replaced when a dying worker breaks it (see worker_result)
+        executor = {"pool": start_workers(jobs), "slots": []}
+        # Enough queued work that a slow file does not idle the other workers
+        ahead = 4 * jobs
+
+    reader = writer = None
+    pending_writes = []
+    if executor is None and pipeline_depth > 0:
+        print(f"Pipelining: read-ahead/write-behind depth {pipeline_depth}, {pipeline_memory_mb:g} MB\n")
+        read_budget, write_budget = HDR_Pipeline.split_memory_cap(pipeline_depth, pipeline_memory_mb)
+        mmap_input = convert_options.get("mmap_input", False)
+        reader, read = HDR_Pipeline.start_reader(lambda path: _load_source(path, mmap_input), read_budget,
+                                                 lambda path: _source_nbytes(path, mmap_input))
+        writer, write = HDR_Pipeline.start_writer(write_budget)
+        ahead = pipeline_depth
+
+    def submit_job(pool, task):
+        filename, file_path, output, _ = task
+        if claim_dir is None:
+            return pool.submit(_convert_task, file_path, output, convert_options)
+        # Claimed in the worker when it starts the file, not here
+        return pool.submit(_claimed_convert_task, filename, file_path, output, convert_options,
+                           claim_dir, claim_ttl)
+
+    def restart_workers():
+        print("  ⚠ A worker process died, restarting the pool")
+        executor["pool"].shutdown(wait=False)
+        executor["pool"] = start_workers(jobs)
+
+    def submit_slot(slot):
+        # slot: {"task", "pool", "future"} of one file in flight on the pool
+        try:
+            slot["future"] = submit_job(executor["pool"], slot["task"])
+        except BrokenProcessPool:
+            restart_workers()
+            slot["future"] = submit_job(executor["pool"], slot["task"])
+        slot["pool"] = executor["pool"]
+
+    def worker_result(slot):
+        """
+        (log, error, record) of a file run on the pool. A dying worker (killed
+        for memory, crashed) breaks the pool and fails every file in flight
+        with BrokenProcessPool, whichever file killed it. The pool is then
+        replaced and the other broken files resubmitted to it, while this
+        file is rerun alone in a one-worker pool: only a file that kills
+        its worker there fails. Each round isolates one file, so a file
+        that always crashes cannot take the batch down with it.
+        """
+        executor["slots"].remove(slot)
+        try:
+            return slot["future"].result()
+        except BrokenProcessPool:
+            pass
+        broken = slot["pool"]
+        if broken is executor["pool"]:
+            restart_workers()
+        for other in executor["slots"]:
+            if other["pool"] is broken and isinstance(other["future"].exception(), BrokenProcessPool):
+                submit_slot(other)
+        print("  ⚠ Worker died during this file, retrying it alone")
+        with start_workers(1) as solo:
+            return submit_job(solo, slot["task"]).result()
+
+    def start(task):
+        filename, file_path, output, exists = task
+        if exists:
+            return None
+        if executor is not None:
+            slot = {"task": task}
+            submit_slot(slot)
+            executor["slots"].append(slot)
+            return slot
+        if reader is not None:
+            return read(file_path)
+        return None
+
+    def check_writes(block):
+        # Settle queued writes in file order; a failed write fails its file
+        nonlocal successful, failed
+        failed_writes = settle_writes(pending_writes, block, record_done)
+        successful -= failed_writes
+        failed += failed_writes
+
+    try:
+        for idx, ((filename, file_path, output, exists), started) in enumerate(
+                HDR_Pipeline.prefetch(tasks, start, ahead), 1):
+            progress = f"{idx}/{len(tasks)}" if isinstance(tasks, list) else f"{idx}"
+            print(f"[{progress}] Processing: {filename}")
+
+            if exists:
+                print("  Skipping (exists)")
+                skipped += 1
+                print()
+                continue
+
+            file_writes = []
+            try:
+                if reader is not None:
+                    def write_for_file(func, *args, nbytes=0):
+                        future = write(func, *args, nbytes=nbytes)
+                        file_writes.append(future)
+                        return future
+                    try:
+                        image, nbytes = started.result()
+                    except Exception as e:
+                        error, record = f"{type(e).__name__}: {e}", None
+                    else:
+                        def convert():
+                            result = run_conversion(file_path, output,
+                                                    dict(convert_options, image=image, write=write_for_file))
+                            if claim_dir is not None:
+                                # Hold the claim until the outputs are written;
+                                # failures are still reported by check_writes
+                                for future in file_writes:
+                                    future.exception()
+                            return result
+                        try:
+                            if claim_dir is None:
+                                error, record = convert()
+                            else:
+                                error, record = HDR_Shard.run_claimed(claim_dir, filename, convert,
+                                                                      lambda: conversion_done(output, container),
+                                                                      claim_ttl)
+                        finally:
+                            del image
+                            read_budget[1](nbytes)
+                elif executor is None:
+                    if claim_dir is None:
+                        error, record = run_conversion(file_path, output, convert_options)
+                    else:
+                        error, record = HDR_Shard.run_claimed(
+                            claim_dir, filename, lambda: run_conversion(file_path, output, convert_options),
+                            lambda: conversion_done(output, container), claim_ttl)
+                else:
+                    try:
+                        log, error, record = worker_result(started)
+                    except HDR_Shard.ClaimSkipped:
+                        raise
+                    except Exception as e:
+                        # The file killed its worker even when run alone
+                        log, error, record = "", f"{type(e).__name__}: {e}", None
+                    print(log, end="")
+            except HDR_Shard.ClaimSkipped as e:
+                print(f"  Skipping ({e})")
+                skipped += 1
+                print()
+                continue
+            pending_writes.append((filename, error is None, file_writes))
+
+            if record is not None:
+                if records is not None:
+                    records.append(record)
+                if show_profile:
+                    print(HDR_Profile.format_record(record))
+
+            if error is None:
+                successful += 1
+            else:
+                print(f"  ✗ Error: {error}")
+                failed += 1
+            print()
+            check_writes(block=False)
+        check_writes(block=True)
+    finally:
+        if executor is not None:
+            executor["pool"].shutdown(cancel_futures=True)
+        if reader is not None:
+            HDR_Pipeline.shutdown(reader, read_budget, wait=False)
+            HDR_Pipeline.shutdown(writer, write_budget)
+
+    for label, frames in sequences:
+        convert = lambda: process_sequence(directory, label, frames, converted_dir, temporal_window, records,
+                                           show_profile, pipeline_depth, pipeline_memory_mb, **convert_options)
+        if claim_dir is None:
+            counts = convert()
+        else:
+            try:
+                counts = HDR_Shard.run_claimed(claim_dir, label, convert, ttl=claim_ttl)
+            except HDR_Shard.ClaimSkipped as e:
+                print(f"Sequence {label}: skipping ({e})\n")
+                skipped += len(frames)
+                continue
+        successful += counts[0]
+        failed += counts[1]
+        skipped += counts[2]
+        if record_done is not None and counts[1] == 0:
+            record_done(label, frames=len(frames))
+
+    if seen["found"] == 0:
         print(f"⚠ No supported images found in {directory}")
-        return
-    
-    print(f"Found {len(image_files)} images. Generating LUT and Swift versions for each.\n")
-    
-    for idx, filename in enumerate(image_files, 1):
-        file_path = os.path.join(directory, filename)
-        base_name = os.path.splitext(filename)[0]
-        
-        print(f"[{idx}/{len(image_files)}] Processing: {filename}")
-        
-        output = os.path.join(converted_dir, f"{base_name}.avif")
-        if not os.path.exists(output):
-            convert_to_avif_gainmap(file_path, output)
+        return (0, 0, 0)
+    if shard is not None:
+        print(f"Shard {shard[0]}/{shard[1]}: {seen['found'] - seen['other_shard']} of {seen['found']} items")
+    if seen["journaled"]:
+        print(f"Journal: {seen['journaled']} item(s) already done, skipped")
+        skipped += seen["journaled"]
+    print(f"Processing complete: {successful} successful, {failed} failed, {skipped} skipped")
+    return (successful, failed, skipped)
+
+
+# ============================================================================
+# IMAGE SEQUENCES
+# ============================================================================
+# With --sequence, numbered frames (shot_0001.tif, shot_0002.tif, ...) are
+# grouped by FRAME_PATTERN and converted in frame order in this process with
+# warm state: the compiled LUT and PQ table stay loaded, and each frame's SDR
+# base and gain map planes come from a small pool of buffer sets of the
+# sequence's shape (reuse_buffer). With --temporal-window N each frame's
+# headroom is taken over the N frames around it, from window statistics that
+# are updated incrementally as frames enter and leave, so the visible
+# headroom follows the shot instead of jumping from frame to frame.
+
+FRAME_PATTERN = re.compile(r"^(?P<prefix>.*?)(?P<number>\d+)(?P<ext>\.[^.]+)$")
+
+# convert_to_avif_gainmap options that belong to pass 1 (load_intermediates)
+PASS1_OPTIONS = ("lut_method", "tile_budget_mb", "cache_dir", "cache_max_gb", "precision", "mmap_input",
+                 "backend", "composite_lut")
+
+def detect_sequences(filenames, min_frames=2):
+    """
+    Groups numbered filenames that share a prefix and extension.
+
+    Returns:
+        tuple: (sequences, others) where sequences is a list of
+            (label, filenames in frame order) with labels like
+            'shot_####.tif', and others are the remaining filenames
+    """
+    groups = {}
+    others = []
+    for filename in filenames:
+        match = FRAME_PATTERN.match(filename)
+        if match is None:
+            others.append(filename)
+            continue
+        key = (match["prefix"], match["ext"])
+        groups.setdefault(key, []).append((int(match["number"]), len(match["number"]), filename))
+
+    sequences = []
+    for (prefix, ext), frames in sorted(groups.items()):
+        if len(frames) < min_frames:
+            others.extend(filename for _, _, filename in frames)
+            continue
+        frames.sort()
+        sequences.append((f"{prefix}{'#' * frames[0][1]}{ext}", [filename for _, _, filename in frames]))
+    return sequences, others
+
+def temporal_window_stats():
+    """
+    Sliding-window headroom statistics over consecutive frames.
+
+    Frames enter with push(index, arrays, stats) in increasing index order
+    and leave with drop_before(index). The sketches are running sums (added
+    on entry, subtracted on exit) and the maxima monotonic deques, so each
+    update costs the same whatever the window length.
+
+    push's optional ratio_stats, from reduced_ratio_stats, replaces the
+    frame's full-resolution ratio_histogram and max_gain_ratio, so a
+    reduced-grid gain map gets the headroom it would get on its own.
+
+    Returns:
+        tuple: (push, drop_before, snapshot) where snapshot() is the window's
+            hdr_max_nits, max_gain_ratio, nits_histogram, ratio_histogram and
+            frame count, in the form of convert_to_avif_gainmap's window_stats
+    """
+    frames = deque()
+    sums = {"nits_histogram": log_histogram(), "ratio_histogram": log_histogram()}
+    maxima = {"hdr_max_nits": deque(), "max_gain_ratio": deque()}
+
+    def push(index, arrays, stats, ratio_stats=None):
+        # Copies, since cached sketches are memory maps of the cache entry
+        sketches = {name: np.array(arrays[name]) for name in sums}
+        values = {name: stats[name] for name in maxima}
+        if ratio_stats is not None:
+            sketches["ratio_histogram"], values["max_gain_ratio"] = ratio_stats
+        for name, total in sums.items():
+            total += sketches[name]
+        for name, candidates in maxima.items():
+            while candidates and candidates[-1][1] <= values[name]:
+                candidates.pop()
+            candidates.append((index, values[name]))
+        frames.append((index, sketches))
+
+    def drop_before(index):
+        while frames and frames[0][0] < index:
+            oldest, sketches = frames.popleft()
+            for name, total in sums.items():
+                total -= sketches[name]
+            for candidates in maxima.values():
+                if candidates and candidates[0][0] <= oldest:
+                    candidates.popleft()
+
+    def snapshot():
+        window = {name: candidates[0][1] if candidates else 0.0 for name, candidates in maxima.items()}
+        window.update({name: total.copy() for name, total in sums.items()})
+        window["frames"] = len(frames)
+        return window
+
+    return push, drop_before, snapshot
+
+def process_sequence(directory, label, filenames, converted_dir, temporal_window=1, records=None,
+                     show_profile=False, pipeline_depth=0, pipeline_memory_mb=HDR_Pipeline.DEFAULT_MEMORY_MB,
+                     **convert_options):
+    """
+    Converts one image sequence in frame order and reports its frames/s.
+
+    Pass 1 (load_intermediates) runs as each frame arrives; pass 2 and the
+    writes of frame i run once frame i + temporal_window // 2 has been
+    through pass 1, with the headroom of frames
+    i - (temporal_window - 1) // 2 ... i + temporal_window // 2. Up to
+    temporal_window // 2 + 1 frames' intermediates are therefore held at
+    once, outside the pipeline's read budget. Each frame's log is printed in
+    one piece when it finishes.
+
+    With gainmap_scale > 1 pass 1 also builds the frame's reduced grids and
+    the window takes their ratio statistics, so each frame is normalized by
+    the same reduced-grid headroom it would get as a standalone file.
+
+    An output that already exists is not rewritten; its frame still goes
+    through pass 1 when it falls in the window of a frame to convert.
+
+    Returns:
+        tuple: (successful_count, failed_count, skipped_count)
+    """
+    ahead = temporal_window // 2
+    behind = temporal_window - 1 - ahead
+    gainmap_scale = convert_options.get("gainmap_scale", 1)
+    load_options = {name: convert_options[name] for name in PASS1_OPTIONS if name in convert_options}
+    extension = output_extension(convert_options.get("container"))
+
+    frames = []
+    for filename in filenames:
+        output = batch_output(converted_dir, filename, extension)
+        frames.append({"filename": filename, "path": os.path.join(directory, filename), "output": output,
+                       "exists": conversion_done(output, convert_options.get("container"))})
+
+    # Pass 1 is needed for every frame inside the window of a frame to convert
+    for index, frame in enumerate(frames):
+        neighbours = frames[max(0, index - ahead):index + behind + 1]
+        frame["analyze"] = any(not neighbour["exists"] for neighbour in neighbours)
+
+    print(f"Sequence {label}: {len(frames)} frames, temporal window {temporal_window}\n")
+    push, drop_before, snapshot = temporal_window_stats()
+
+    # Buffer sets: one per frame between pass 1 and the end of its writes
+    pool = []
+    def take_buffers():
+        for entry in pool:
+            if not entry["in_use"] and all(f.done() for f in entry["writes"]):
+                break
         else:
+            entry = {"buffers": {}}
+            pool.append(entry)
+        entry["in_use"] = True
+        entry["writes"] = []
+        return entry
+
+    reader = writer = write = None
+    reads = None
+    if pipeline_depth > 0:
+        read_budget, write_budget = HDR_Pipeline.split_memory_cap(pipeline_depth, pipeline_memory_mb)
+        mmap_input = convert_options.get("mmap_input", False)
+        reader, read = HDR_Pipeline.start_reader(lambda path: _load_source(path, mmap_input), read_budget,
+                                                 lambda path: _source_nbytes(path, mmap_input))
+        reads = iter([read(frame["path"]) for frame in frames if frame["analyze"]])
+        writer, write = HDR_Pipeline.start_writer(write_budget)
+
+    def pass1(index, frame):
+        frame["log"] = StringIO()
+        if not frame["analyze"]:
+            return
+        if not frame["exists"]:
+            HDR_Profile.start_file(frame["path"])
+        frame["pool"] = take_buffers()
+        image = None
+        try:
+            with redirect_stdout(frame["log"]):
+                if reads is not None:
+                    image, nbytes = next(reads).result()
+                frame["intermediates"] = load_intermediates(frame["path"], image=image,
+                                                            buffers=frame["pool"]["buffers"], **load_options)
+                if gainmap_scale != 1:
+                    frame["grids"] = reduced_grids(*frame["intermediates"], gainmap_scale,
+                                                   load_options.get("tile_budget_mb"))
+            push(index, *frame["intermediates"],
+                 reduced_ratio_stats(frame["grids"]) if "grids" in frame else None)
+        except Exception as e:
+            frame["error"] = f"{type(e).__name__}: {e}"
+        finally:
+            if image is not None:
+                read_budget[1](nbytes)
+        frame["record"] = HDR_Profile.suspend_file()
+
+    def finish(index, frame):
+        nonlocal successful, failed, skipped
+        print(f"[{index + 1}/{len(frames)}] Processing: {frame['filename']}")
+        if frame["exists"]:
             print("  Skipping (exists)")
+        elif "error" not in frame:
+            drop_before(index - behind)
+            HDR_Profile.resume_file(frame["record"])
+            file_writes = []
+            def write_for_file(func, *args, nbytes=0):
+                future = write(func, *args, nbytes=nbytes)
+                file_writes.append(future)
+                return future
+            try:
+                with redirect_stdout(frame["log"]):
+                    convert_to_avif_gainmap(frame["path"], frame["output"], **dict(
+                        convert_options, write=None if write is None else write_for_file,
+                        intermediates=frame["intermediates"], window_stats=snapshot(),
+                        buffers=frame["pool"]["buffers"], grids=frame.get("grids")))
+            except Exception as e:
+                frame["error"] = f"{type(e).__name__}: {e}"
+            frame["record"] = HDR_Profile.finish_file("ok" if "error" not in frame else "failed",
+                                                      frame.get("error"))
+            frame["pool"]["writes"] = file_writes
+            pending_writes.append((frame["filename"], "error" not in frame, file_writes))
+        else:
+            HDR_Profile.resume_file(frame["record"])
+            frame["record"] = HDR_Profile.finish_file("failed", frame["error"])
+        print(frame["log"].getvalue(), end="")
+
+        if frame.get("record") is not None:
+            if records is not None:
+                records.append(frame["record"])
+            if show_profile:
+                print(HDR_Profile.format_record(frame["record"]))
+
+        if frame["exists"]:
+            skipped += 1
+        elif "error" not in frame:
+            successful += 1
+        else:
+            print(f"  ✗ Error: {frame['error']}")
+            failed += 1
         print()
 
+        # Release the frame's intermediates and lend its buffers out again
+        frame.pop("intermediates", None)
+        frame.pop("grids", None)
+        if "pool" in frame:
+            frame.pop("pool")["in_use"] = False
+
+    successful = 0
+    failed = 0
+    skipped = 0
+    pending_writes = []
+    start = time.perf_counter()
+    try:
+        waiting = deque()
+        for index, frame in enumerate(frames):
+            pass1(index, frame)
+            waiting.append(index)
+            while waiting and waiting[0] + ahead <= index:
+                finished = waiting.popleft()
+                finish(finished, frames[finished])
+            failed_writes = settle_writes(pending_writes, block=False)
+            successful -= failed_writes
+            failed += failed_writes
+        while waiting:
+            finished = waiting.popleft()
+            finish(finished, frames[finished])
+        failed_writes = settle_writes(pending_writes, block=True)
+        successful -= failed_writes
+        failed += failed_writes
+    finally:
+        if reader is not None:
+            HDR_Pipeline.shutdown(reader, read_budget, wait=False)
+            HDR_Pipeline.shutdown(writer, write_budget)
+    elapsed = time.perf_counter() - start
+
+    converted = successful + failed
+    frames_per_s = converted / elapsed if elapsed > 0 else 0.0
+    print(f"Sequence {label}: {converted} frames in {elapsed:.2f}s ({frames_per_s:.2f} frames/s)\n")
+    return (successful, failed, skipped)
+
+
+# ============================================================================
+# LIBRARY ANALYSIS
+# ============================================================================
+# --analyze computes only the statistics behind grading decisions (HDR nits,
+# gain ratio percentiles, estimated headroom): no gain map, no outputs.
+# By default every --sample-stride'th pixel of every --sample-stride'th row
+# is analyzed, which skips all but 1/stride² of the LUT and headroom work;
+# the maxima of a sample can only underestimate, so --sample-stride 1
+# gives the exact figures a conversion would print. The source is never
+# held at full resolution (see read_analysis_sample).
+
+ANALYSIS_STRIDE = 4
+ANALYSIS_PERCENTILES = (50.0, 99.0, 99.9)
+ANALYSIS_FIELDS = (
+    ["file", "width", "height", "sample_stride", "samples", "hdr_max_nits"]
+    + [f"hdr_p{p:g}_nits" for p in ANALYSIS_PERCENTILES]
+    + ["max_gain_ratio"]
+    + [f"ratio_p{p:g}" for p in ANALYSIS_PERCENTILES]
+    + ["estimated_headroom", "headroom_stops", "seconds", "error"]
+)
+
+# cv2.imread flags decoding at 1/scale, keeping 16 bits per channel
+REDUCED_DECODE_FLAGS = {
+    2: cv2.IMREAD_REDUCED_COLOR_2 | cv2.IMREAD_ANYDEPTH,
+    4: cv2.IMREAD_REDUCED_COLOR_4 | cv2.IMREAD_ANYDEPTH,
+    8: cv2.IMREAD_REDUCED_COLOR_8 | cv2.IMREAD_ANYDEPTH,
+}
+
+def read_analysis_sample(input_file, sample_stride):
+    """
+    The strided pixel sample of one image for analyze_image, and the
+    image's (height, width), without a full-resolution decode:
+
+    - A TIFF that HDR_TIFF can map is mapped whether or not --mmap-input is
+      given, and only the sampled rows are read from the file.
+    - Anything else is decoded by cv2 at the largest reduced scale (1/2,
+      1/4 or 1/8, IMREAD_REDUCED_*) that divides sample_stride, then
+      sampled at the rest of the stride. A reduced pixel is the average of
+      its block rather than one source pixel, so maxima and high
+      percentiles read lower than on a mapped source. JPEG is decoded at
+      the reduced scale; OpenCV decodes TIFF and PNG in full and shrinks
+      them before returning, so only that transient buffer is full size.
+      Without such a scale (odd strides, 1) the full decode is sampled and
+      dropped. Sizes of non-TIFF files are known only to within the scale.
+    """
+    image = HDR_TIFF.map_bgr(input_file)
+    if image is not None:
+        return image[::sample_stride, ::sample_stride], image.shape[:2]
+
+    scale = next((scale for scale in sorted(REDUCED_DECODE_FLAGS, reverse=True) if sample_stride % scale == 0), 1)
+    image = cv2.imread(input_file, REDUCED_DECODE_FLAGS[scale] if scale > 1 else cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise ValueError(f"Could not read converted image: {input_file}")
+    size = HDR_TIFF.image_size(input_file) or (image.shape[0] * scale, image.shape[1] * scale)
+    rest = sample_stride // scale
+    return np.ascontiguousarray(image[::rest, ::rest]), size
+
+def analyze_image(input_file, lut_method="trilinear", sample_stride=ANALYSIS_STRIDE, headroom_percentile=100.0,
+                  tile_budget_mb=None):
+    """
+    Pass 1 statistics of one image on a strided pixel sample (see
+    read_analysis_sample), without keeping the SDR base or writing anything.
+
+    Returns:
+        dict: One ANALYSIS_FIELDS row (without 'error')
+    """
+    start = time.perf_counter()
+    sample, (height, width) = read_analysis_sample(input_file, sample_stride)
+    if sample.dtype == np.uint16:
+        pq_to_nits = pq_u16_to_absolute_nits
+    else:
+        sample = sample.astype(np.float32) / 65535.0
+        pq_to_nits = normalized_pq_to_absolute_nits
+    lut_3d = load_cube_lut(LUT_PATH)
+
+    hdr_max_nits = 0.0
+    max_ratio = 0.0
+    nits_histogram = log_histogram()
+    ratio_histogram = log_histogram()
+    for top, bottom in image_strips(sample.shape[0], sample.shape[1], tile_budget_mb):
+        strip = np.ascontiguousarray(sample[top:bottom])
+        img_P3_linear_absolute_nits = pq_to_nits(strip)
+        hdr_max_nits = max(hdr_max_nits, float(np.max(img_P3_linear_absolute_nits)))
+        if strip.dtype == np.uint16:
+            add_pq_code_histogram(nits_histogram, strip)
+        else:
+            log_histogram_add(nits_histogram, img_P3_linear_absolute_nits)
+
+        sdr_strip = np.empty(strip.shape, dtype=np.float32)
+        apply_lut(strip, lut_3d, lut_method, out=sdr_strip)
+        max_ratio = max(max_ratio, fused_max_gain_ratio(img_P3_linear_absolute_nits, sdr_strip, ratio_histogram))
+
+    estimated_headroom = max(log_histogram_quantile(ratio_histogram, headroom_percentile / 100.0, max_ratio), 1.0)
+    row = {
+        "file": input_file,
+        "width": width,
+        "height": height,
+        "sample_stride": sample_stride,
+        "samples": sample.shape[0] * sample.shape[1],
+        "hdr_max_nits": hdr_max_nits,
+    }
+    for p in ANALYSIS_PERCENTILES:
+        row[f"hdr_p{p:g}_nits"] = log_histogram_quantile(nits_histogram, p / 100.0, hdr_max_nits)
+    row["max_gain_ratio"] = max_ratio
+    for p in ANALYSIS_PERCENTILES:
+        row[f"ratio_p{p:g}"] = log_histogram_quantile(ratio_histogram, p / 100.0, max_ratio)
+    row["estimated_headroom"] = estimated_headroom
+    row["headroom_stops"] = float(np.log2(estimated_headroom))
+    row["seconds"] = time.perf_counter() - start
+    return row
+
+def _analyze_task(file_path, analyze_options):
+    """analyze_image for a worker: the row, or a row carrying the error."""
+    try:
+        return analyze_image(file_path, **analyze_options)
+    except Exception as e:
+        return {"file": file_path, "error": f"{type(e).__name__}: {e}"}
+
+def analyze_files(file_paths, jobs=1, **analyze_options):
+    """
+    Analyzes file_paths (over a process pool with jobs > 1), printing one
+    line per file in order.
+
+    Returns:
+        list: ANALYSIS_FIELDS rows in file order; failed files carry 'error'
+    """
+    executor = None
+    if jobs > 1:
+        print(f"Using {jobs} worker processes\n")
+        sys.stdout.flush()
+        executor = ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker)
+        pending = [executor.submit(_analyze_task, file_path, analyze_options) for file_path in file_paths]
+
+    rows = []
+    start = time.perf_counter()
+    try:
+        for idx, file_path in enumerate(file_paths, 1):
+            row = pending[idx - 1].result() if executor is not None else _analyze_task(file_path, analyze_options)
+            rows.append(row)
+            name = os.path.basename(file_path)
+            if "error" in row:
+                print(f"[{idx}/{len(file_paths)}] ✗ {name}: {row['error']}")
+            else:
+                print(f"[{idx}/{len(file_paths)}] {name}: max {row['hdr_max_nits']:.2f} nits, "
+                      f"headroom {row['estimated_headroom']:.2f} ({row['headroom_stops']:.2f} stops)")
+    finally:
+        if executor is not None:
+            executor["pool"].shutdown(cancel_futures=True)
+
+    elapsed = time.perf_counter() - start
+    rate = len(rows) / elapsed if elapsed > 0 else 0.0
+    print(f"\nAnalyzed {len(rows)} files in {elapsed:.2f}s ({rate:.2f} files/s)")
+    return rows
+
+def write_analysis(output_path, rows):
+    """Writes analysis rows as JSON (.json) or CSV (anything else)."""
+    if output_path.lower().endswith(".json"):
+        with open(output_path, 'w') as f:
+            json.dump(rows, f, indent=2)
+        return
+    with open(output_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=ANALYSIS_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+def analysis_inputs(input_path, recursive=False):
+    """The file itself, or the supported images of a directory in walk order (HDR_Walk)."""
+    if os.path.isfile(input_path):
+        return [input_path]
+    return [os.path.join(input_path, path)
+            for path, _ in HDR_Walk.walk_images(input_path, SUPPORTED_EXTENSIONS, recursive)]
+
 
 # ============================================================================
 # MAIN EXECUTION BLOCK
 # ============================================================================
 
-def main():
-    if len(sys.argv) < 2:
-        print(f"Usage: python {os.path.basename(__file__)} <input_file_or_directory>")
-        sys.exit(1)
-    
-    input_path = sys.argv[1]
+def conversion_options(args):
+    """Keyword arguments for convert_to_avif_gainmap from the parsed CLI."""
+    return {
+        "lut_method": args.lut_method,
+        "tile_budget_mb": args.tile_budget_mb,
+        "cache_dir": args.cache_dir,
+        "cache_max_gb": args.cache_max_gb,
+        "intermediates_dir": args.intermediates_dir,
+        "container": args.container,
+        "gainmap_scale": args.gainmap_scale,
+        "gainmap_error": args.gainmap_error,
+        "headroom_percentile": args.headroom_percentile,
+        "precision": args.precision,
+        "mmap_input": args.mmap_input,
+        "backend": args.backend,
+        "composite_lut": args.composite_lut,
+    }
+
+def single_file_output(input_path, container="none"):
+    """Output path of a single-file conversion, in converted_gainmap/ beside the input's folder."""
+    input_dir = os.path.dirname(os.path.abspath(input_path))
+    parent_dir = os.path.dirname(input_dir)
+    converted_dir = os.path.join(parent_dir, "converted_gainmap")
+    os.makedirs(converted_dir, exist_ok=True)
+
+    base_name = os.path.splitext(os.path.basename(input_path))[0]
+    return os.path.join(converted_dir, base_name + output_extension(container))
+
+def write_profile_outputs(args, records, batch_wall_s):
+    """Write the --report JSON and --metrics-textfile for a finished run."""
+    summary = HDR_Profile.summarize(records, batch_wall_s)
+    if args.report:
+        HDR_Profile.write_report(args.report, "HDR_ISOGainMap", records, summary)
+        print(f"✓ Run report written to {args.report}")
+    if args.metrics_textfile:
+        HDR_Profile.write_metrics_textfile(args.metrics_textfile, "HDR_ISOGainMap", summary)
+        print(f"✓ Metrics written to {args.metrics_textfile}")
+    if args.profile:
+        print(f"Batch: {summary['files']} images, {summary['images_per_s']:.2f} images/s, "
+              f"p50 {summary['latency_p50_s']:.2f}s, p95 {summary['latency_p95_s']:.2f}s")
+
+def argument_error(args):
+    """Message for an invalid combination of parsed options, or None."""
+    if args.jobs < 1:
+        return f"--jobs must be at least 1, got {args.jobs}"
+    if args.pipeline_depth < 0:
+        return f"--pipeline-depth must be 0 or more, got {args.pipeline_depth}"
+    if args.pipeline_memory_mb <= 0:
+        return f"--pipeline-memory-mb must be positive, got {args.pipeline_memory_mb:g}"
+    if not 0.0 < args.headroom_percentile <= 100.0:
+        return f"--headroom-percentile must be in (0, 100], got {args.headroom_percentile:g}"
+    if args.temporal_window < 1:
+        return f"--temporal-window must be at least 1, got {args.temporal_window}"
+    if args.sample_stride < 1:
+        return f"--sample-stride must be at least 1, got {args.sample_stride}"
+    if args.claim_ttl <= 0:
+        return f"--claim-ttl must be positive, got {args.claim_ttl:g}"
+    if args.tile_budget_mb is not None and args.tile_budget_mb <= 0:
+        return f"--tile-budget-mb must be positive, got {args.tile_budget_mb:g}"
+    if args.cache_max_gb <= 0:
+        return f"--cache-max-gb must be positive, got {args.cache_max_gb:g}"
+    if args.backend == "numba" and importlib.util.find_spec("numba") is None:
+        return "--backend numba needs the numba package (pip install numba)"
+    if args.composite_lut and args.backend != "numba":
+        return "--composite-lut applies to --backend numba only"
+    return None
+
+def main(args):
+    input_path = args.input_path
     
     if not os.path.exists(input_path):
         print(f"Error: Path not found: {input_path}")
         sys.exit(1)
+
+    error = argument_error(args)
+    if error is not None:
+        print(f"Error: {error}")
+        sys.exit(1)
+
+    # Statistics only: no conversion and no outputs besides the table
+    if args.analyze:
+        print(f"\nMode: Analysis (sample stride {args.sample_stride})\n")
+        rows = analyze_files(analysis_inputs(input_path, args.recursive), args.jobs, lut_method=args.lut_method,
+                             sample_stride=args.sample_stride, headroom_percentile=args.headroom_percentile,
+                             tile_budget_mb=args.tile_budget_mb)
+        write_analysis(args.analyze, rows)
+        print(f"✓ Analysis written to {args.analyze}")
+        if any("error" in row for row in rows):
+            sys.exit(1)
+        return
+
+    if args.keep_intermediates:
+        args.intermediates_dir = tempfile.mkdtemp(prefix="hdr_exif_intermediates_")
+        print(f"Keeping intermediates in {args.intermediates_dir}")
+    else:
+        args.intermediates_dir = None
+
+    profiling = args.profile or args.report or args.metrics_textfile
+    HDR_Profile.enable(bool(profiling))
+    records = []
+    batch_start = time.perf_counter()
     
     # single file conversion
     if os.path.isfile(input_path):
         print(f"\nMode: Single file conversion")
         print(f"Input: {input_path}\n")
         
-        input_dir = os.path.dirname(os.path.abspath(input_path))
-        parent_dir = os.path.dirname(input_dir)
-        converted_dir = os.path.join(parent_dir, "converted_gainmap")
-        os.makedirs(converted_dir, exist_ok=True)
-        
-        # single file conversion
-        base_name = os.path.splitext(os.path.basename(input_path))[0]
-        
         # LUT Version
-        output_lut = os.path.join(converted_dir, f"{base_name}.avif")
-        convert_to_avif_gainmap(input_path, output_lut)
+        output_lut = single_file_output(input_path, args.container)
+        error, record = run_conversion(input_path, output_lut, conversion_options(args))
+        if record is not None:
+            records.append(record)
+            if args.profile:
+                print(HDR_Profile.format_record(record))
+        if profiling:
+            write_profile_outputs(args, records, time.perf_counter() - batch_start)
+        if error is not None:
+            print(f"Error: {error}")
+            sys.exit(1)
         print("\n✓ Done")
     
     # directory conversion 
     elif os.path.isdir(input_path):
         print(f"\nMode: Batch directory processing")
-        process_directory(input_path)
+        successful, failed, skipped = process_directory(input_path, args.jobs, records, args.profile,
+                                                        args.pipeline_depth, args.pipeline_memory_mb,
+                                                        args.sequence, args.temporal_window,
+                                                        args.shard, args.claim_dir, args.claim_ttl,
+                                                        args.recursive, args.largest_first, args.journal,
+                                                        **conversion_options(args))
+        if profiling:
+            write_profile_outputs(args, records, time.perf_counter() - batch_start)
+        if failed > 0:
+            sys.exit(1)
 
-def parse_arguments():
-    """Parse command-line arguments."""
+def parse_arguments(argv=None):
+    """Parse command-line arguments (argv, default sys.argv[1:]); HDR_Server parses job options with it."""
     import argparse
     
     parser = argparse.ArgumentParser(
@@ -296,8 +2352,179 @@ def parse_arguments():
         'input_path',
         help='Path to HDR image file or directory'
     )
-    return parser.parse_args()
+    parser.add_argument(
+        '--lut-method',
+        choices=LUT_METHODS,
+        default='trilinear',
+        help='3D LUT interpolation (default: trilinear)'
+    )
+    parser.add_argument(
+        '--tile-budget-mb',
+        type=float,
+        default=None,
+        help='Stream the image in strips using at most this many MB of intermediates; '
+             'the full-size SDR base and gain map spill to temp files, while a decoded '
+             '(not memory-mapped) source and the output encoders still take whole images'
+    )
+    parser.add_argument(
+        '--cache-dir',
+        default=None,
+        help='Reuse decode/LUT intermediates from this content-addressed cache'
+    )
+    parser.add_argument(
+        '--cache-max-gb',
+        type=float,
+        default=DEFAULT_CACHE_MAX_GB,
+        help=f'Evict least recently used cache entries above this size (default: {DEFAULT_CACHE_MAX_GB:g})'
+    )
+    parser.add_argument(
+        '--keep-intermediates',
+        action='store_true',
+        help='Debug: also write each SDR base as a TIFF in a fresh temp directory'
+    )
+    parser.add_argument(
+        '--container',
+        choices=CONTAINERS,
+        default='none',
+        help='Also write the SDR base and gain map as one file; ultrahdr: <name>.jpg (default: none)'
+    )
+    parser.add_argument(
+        '--gainmap-scale',
+        type=int,
+        choices=GAINMAP_SCALES,
+        default=1,
+        help='Compute and store the gain map at 1/N resolution (default: 1)'
+    )
+    parser.add_argument(
+        '--gainmap-error',
+        action='store_true',
+        help='With --gainmap-scale > 1, also report the error against the full-resolution map'
+    )
+    parser.add_argument(
+        '--headroom-percentile',
+        type=float,
+        default=100.0,
+        help='Headroom and HDR nits percentile, e.g. 99.9 to ignore hot pixels (default: 100 = max)'
+    )
+    parser.add_argument(
+        '--precision',
+        choices=PRECISIONS,
+        default='float32',
+        help='SDR base storage; float16 / fixed16 (uint16 codes) halve its memory '
+             '(default: float32, see HDR_Benchmark.py --precision for the error)'
+    )
+    parser.add_argument(
+        '--mmap-input',
+        action='store_true',
+        help='Memory-map the pixels of uncompressed 16-bit RGB TIFFs instead of decoding them '
+             'with OpenCV (other files are still decoded; --analyze always maps them)'
+    )
+    parser.add_argument(
+        '--backend',
+        choices=BACKENDS,
+        default='numpy',
+        help='Compute backend; numba fuses each pass into one parallel per-pixel kernel (optional '
+             'dependency; default: numpy, see HDR_Benchmark.py --backend for the cross-check)'
+    )
+    parser.add_argument(
+        '--composite-lut',
+        action='store_true',
+        help='With --backend numba, decode a float32 SDR base through a baked sRGB EOTF table instead of '
+             'a per-pixel power (relative error below 2e-6; gain map within 1 code)'
+    )
+    parser.add_argument(
+        '--shard',
+        type=HDR_Shard.shard_spec,
+        default=None,
+        metavar='I/N',
+        help='Multi-node batches: only convert shard I of N (1-based, stable hash of the file name)'
+    )
+    parser.add_argument(
+        '--claim-dir',
+        default=None,
+        help='Multi-node batches: claim each file with a lock file in this shared directory before converting it'
+    )
+    parser.add_argument(
+        '--claim-ttl',
+        type=float,
+        default=HDR_Shard.DEFAULT_CLAIM_TTL_S,
+        help=f'Seconds without heartbeat after which a claim from a crashed node expires '
+             f'(default: {HDR_Shard.DEFAULT_CLAIM_TTL_S:g})'
+    )
+    parser.add_argument(
+        '--recursive',
+        action='store_true',
+        help='Also convert the images in subdirectories; outputs mirror the subdirectories'
+    )
+    parser.add_argument(
+        '--largest-first',
+        action='store_true',
+        help='Convert the largest files first for better load balance (lists the whole batch before starting)'
+    )
+    parser.add_argument(
+        '--journal',
+        default=None,
+        help='Append each converted file to this journal and skip the files already in it, to resume a batch'
+    )
+    parser.add_argument(
+        '--analyze',
+        metavar='OUTPUT',
+        default=None,
+        help='Only compute per-file HDR nits and headroom statistics and write them to OUTPUT (.csv or .json)'
+    )
+    parser.add_argument(
+        '--sample-stride',
+        type=int,
+        default=ANALYSIS_STRIDE,
+        help=f'With --analyze, sample every Nth pixel of every Nth row; 1 is exact (default: {ANALYSIS_STRIDE})'
+    )
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='Print per-stage wall/CPU time, I/O and peak RSS for each file'
+    )
+    parser.add_argument(
+        '--report',
+        default=None,
+        help='Write per-file stage timings and batch aggregates as JSON'
+    )
+    parser.add_argument(
+        '--metrics-textfile',
+        default=None,
+        help='Write batch metrics in Prometheus textfile-collector format'
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help='Worker processes for directory batches (default: 1)'
+    )
+    parser.add_argument(
+        '--pipeline-depth',
+        type=int,
+        default=HDR_Pipeline.DEFAULT_DEPTH,
+        help='With -j 1, decode this many images ahead and write outputs behind compute; 0 disables '
+             f'(default: {HDR_Pipeline.DEFAULT_DEPTH})'
+    )
+    parser.add_argument(
+        '--pipeline-memory-mb',
+        type=float,
+        default=HDR_Pipeline.DEFAULT_MEMORY_MB,
+        help=f'Memory cap for images queued in the pipeline (default: {HDR_Pipeline.DEFAULT_MEMORY_MB:g})'
+    )
+    parser.add_argument(
+        '--sequence',
+        action='store_true',
+        help='Treat numbered files (shot_0001.tif, ...) as image sequences: frame order, warm buffers, frames/s'
+    )
+    parser.add_argument(
+        '--temporal-window',
+        type=int,
+        default=1,
+        help='With --sequence, take each frame\'s headroom over this many neighbouring frames (default: 1)'
+    )
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
     args = parse_arguments()
-    main()
+    main(args)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+"""
+Read-Ahead / Write-Behind Batch Pipeline
+========================================
+
+Bounded reader and writer threads shared by the process_directory loops of
+HDR_ISOGainMap.py and HDR_ICC.py (--pipeline-depth / --pipeline-memory-mb).
+
+MODEL:
+------
+  reader thread  →  compute (as today)  →  writer thread
+  load(item) in order,                     func(*args) in submission order
+  up to `depth` items / half the           up to `depth` writes / half the
+  memory cap ahead of compute              memory cap behind compute
+
+A *budget* admits at most `depth` items and `limit_bytes` bytes at once; an
+item larger than the whole budget is still admitted when nothing else is
+held, so the pipeline never stalls. Reads and writes use separate budgets:
+the writer never waits on the reader, so compute can always make progress.
+A read is charged its estimated size before it loads, so a decoded image
+never lands outside the cap.
+
+HDR_ICC.py runs the reader only, with the whole cap: magick opens and
+writes its files itself, so its read-ahead pulls the next sources into the
+page cache and is charged their file sizes.
+
+Both stages run on single-thread executors and hand back ordinary futures;
+exceptions raised by load() or a write surface from future.result().
+
+Work items may come from a generator (HDR_Walk): prefetch() starts each
+item's read or job a fixed number of items ahead of the consumer, so
+nothing has to list the whole batch first.
+"""
+
+# ============================================================================
+# IMPORTS
+# ============================================================================
+
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+DEFAULT_DEPTH = 2
+DEFAULT_MEMORY_MB = 1024.0
+
+
+# ============================================================================
+# BUDGETS
+# ============================================================================
+
+def pipeline_budget(depth, limit_bytes):
+    """
+    Returns (acquire, release, close) over one item/byte budget.
+
+    acquire(nbytes) blocks until the item fits; release(nbytes) returns it;
+    close() wakes every waiter and admits everything from then on, so
+    threads blocked in acquire can finish when a batch is torn down.
+    """
+    condition = threading.Condition()
+    state = {"items": 0, "bytes": 0, "closed": False}
+
+    def fits(nbytes):
+        return (state["closed"] or state["items"] == 0
+                or (state["items"] < depth and state["bytes"] + nbytes <= limit_bytes))
+
+    def acquire(nbytes):
+        with condition:
+            condition.wait_for(lambda: fits(nbytes))
+            state["items"] += 1
+            state["bytes"] += nbytes
+
+    def release(nbytes):
+        with condition:
+            state["items"] -= 1
+            state["bytes"] -= nbytes
+            condition.notify_all()
+
+    def close():
+        with condition:
+            state["closed"] = True
+            condition.notify_all()
+
+    return acquire, release, close
+
+
+def split_memory_cap(depth, memory_mb):
+    """(read budget, write budget), each with depth items and half of memory_mb."""
+    limit_bytes = int(memory_mb * 1024 * 1024) // 2
+    return pipeline_budget(depth, limit_bytes), pipeline_budget(depth, limit_bytes)
+
+
+# ============================================================================
+# STAGES
+# ============================================================================
+
+def start_reader(load, budget, estimate):
+    """
+    Start the read-ahead thread.
+
+    estimate(item) is the memory load(item) will take, known before it runs
+    (e.g. from the file header or size). The reader charges it to budget
+    before each load, so the cap holds while an item is being read and the
+    reader runs ahead of the consumer only as far as the budget allows; the
+    consumer calls budget's release(nbytes) once it is done with the result.
+    A failed load releases its charge itself.
+
+    Returns:
+        tuple: (executor, read) where read(item) queues load(item) on the
+            reader thread and returns its future of (result, nbytes)
+    """
+    acquire, release, _ = budget
+
+    def run(item):
+        nbytes = estimate(item)
+        acquire(nbytes)
+        try:
+            return load(item), nbytes
+        except BaseException:
+            release(nbytes)
+            raise
+
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="read_ahead")
+    return executor, lambda item: executor.submit(run, item)
+
+
+def start_writer(budget):
+    """
+    Start the write-behind thread.
+
+    Returns:
+        tuple: (executor, write) where write(func, *args, nbytes=0) blocks
+            until nbytes fit in budget, queues func(*args) on the writer
+            thread and returns its future
+    """
+    acquire, release, _ = budget
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="write_behind")
+
+    def run(func, args, nbytes):
+        try:
+            return func(*args)
+        finally:
+            release(nbytes)
+
+    def write(func, *args, nbytes=0):
+        acquire(nbytes)
+        return executor.submit(run, func, args, nbytes)
+
+    return executor, write
+
+
+def shutdown(executor, budget, wait=True):
+    """Stop a stage: close its budget so blocked threads return, then shut down."""
+    if executor is None:
+        return
+    budget[2]()
+    executor.shutdown(wait=wait, cancel_futures=not wait)
+
+
+# ============================================================================
+# STREAMING
+# ============================================================================
+
+def prefetch(items, start, ahead):
+    """
+    Yield (item, start(item)) for every item of an iterable, in order,
+    calling start up to `ahead` items before the consumer reaches them.
+    Only those items are held, however long items is.
+    """
+    window = deque()
+    for item in items:
+        window.append((item, start(item)))
+        if len(window) > ahead:
+            yield window.popleft()
+    while window:
+        yield window.popleft()
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+"""
+Per-Stage Run Instrumentation
+=============================
+
+Lightweight timing and memory instrumentation shared by HDR_ISOGainMap.py
+and HDR_ICC.py, behind their --profile / --report / --metrics-textfile
+options.
+
+MODEL:
+------
+- A *file record* covers one conversion (start_file ... finish_file). When
+  a file's work is split around other files' (sequence frames waiting for
+  their temporal window), suspend_file / resume_file pause its clocks.
+- Inside it, code marks *stages* with `with stage("lut"):`. Re-entering a
+  stage name (e.g. once per strip) accumulates into the same entry.
+- Each stage records wall time, CPU time (this process plus any child
+  processes such as magick), bytes read/written as reported by the caller
+  via record_io(), and the peak RSS high-water mark at stage end.
+- summarize() turns file records into batch aggregates (images/s,
+  p50/p95 latency, per-stage totals); write_report() stores everything as
+  JSON and write_metrics_textfile() emits Prometheus textfile metrics.
+
+Records are thread-local, so concurrent conversion threads each fill their
+own record. CPU and child-process figures are process-wide and therefore
+shared between concurrent jobs. When instrumentation is disabled every
+call is a cheap no-op.
+"""
+
+# ============================================================================
+# IMPORTS
+# ============================================================================
+
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+_enabled = False
+_local = threading.local()
+
+# ru_maxrss is kilobytes on Linux and bytes on macOS
+_MAXRSS_SCALE = 1 if sys.platform == "darwin" else 1024
+
+
+def enable(on=True):
+    """Turn instrumentation on (or off) for this process."""
+    global _enabled
+    _enabled = on
+
+
+def is_enabled():
+    return _enabled
+
+
+# ============================================================================
+# MEASUREMENT
+# ============================================================================
+
+def _cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process or its largest child so far."""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) * _MAXRSS_SCALE
+
+
+def start_file(name):
+    """Begin a file record for the current thread."""
+    if not _enabled:
+        return
+    _local.record = {
+        "file": name,
+        "stages": {},
+        "_wall": time.perf_counter(),
+        "_cpu": _cpu_seconds(),
+    }
+    _local.stage = None
+
+
+def finish_file(status="ok", error=None):
+    """
+    Close the current thread's file record.
+
+    Returns:
+        dict: The finished record, or None when instrumentation is disabled
+    """
+    record = getattr(_local, "record", None)
+    if record is None:
+        return None
+    _local.record = None
+
+    record["status"] = status
+    if error is not None:
+        record["error"] = str(error)
+    record["wall_s"] = time.perf_counter() - record.pop("_wall")
+    record["cpu_s"] = _cpu_seconds() - record.pop("_cpu")
+    record["peak_rss_bytes"] = peak_rss_bytes()
+    record["bytes_read"] = sum(s["bytes_read"] for s in record["stages"].values())
+    record["bytes_written"] = sum(s["bytes_written"] for s in record["stages"].values())
+    return record
+
+
+def suspend_file():
+    """
+    Detach the current thread's file record so another file can be recorded
+    meanwhile (e.g. frames waiting for their temporal window). Wall and CPU
+    time stop accumulating until resume_file.
+
+    Returns:
+        dict: The suspended record, or None when instrumentation is disabled
+    """
+    record = getattr(_local, "record", None)
+    if record is None:
+        return None
+    _local.record = None
+    _local.stage = None
+    record["_wall"] = time.perf_counter() - record["_wall"]
+    record["_cpu"] = _cpu_seconds() - record["_cpu"]
+    return record
+
+
+def resume_file(record):
+    """Make a record returned by suspend_file current again."""
+    if record is None:
+        return
+    record["_wall"] = time.perf_counter() - record["_wall"]
+    record["_cpu"] = _cpu_seconds() - record["_cpu"]
+    _local.record = record
+    _local.stage = None
+
+
+@contextmanager
+def stage(name):
+    """Time the enclosed block as stage `name` of the current file record."""
+    record = getattr(_local, "record", None)
+    if record is None:
+        yield
+        return
+
+    entry = record["stages"].setdefault(name, {
+        "wall_s": 0.0, "cpu_s": 0.0, "bytes_read": 0, "bytes_written": 0, "calls": 0,
+    })
+    outer = _local.stage
+    _local.stage = entry
+    wall = time.perf_counter()
+    cpu = _cpu_seconds()
+    try:
+        yield
+    finally:
+        entry["wall_s"] += time.perf_counter() - wall
+        entry["cpu_s"] += _cpu_seconds() - cpu
+        entry["calls"] += 1
+        entry["peak_rss_bytes"] = peak_rss_bytes()
+        _local.stage = outer
+
+
+def record_io(read=0, written=0):
+    """Attribute bytes read/written to the innermost active stage."""
+    entry = getattr(_local, "stage", None)
+    if entry is not None:
+        entry["bytes_read"] += read
+        entry["bytes_written"] += written
+
+
+def file_size(path):
+    """Size of path in bytes, or 0 if it does not exist."""
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+# ============================================================================
+# REPORTING
+# ============================================================================
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = (len(sorted_values) - 1) * q
+    lower = int(index)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (index - lower)
+
+
+def summarize(records, batch_wall_s):
+    """
+    Batch aggregates over finished file records.
+
+    Parameters:
+        records (list): Dicts returned by finish_file
+        batch_wall_s (float): Wall time of the whole batch
+    """
+    latencies = sorted(r["wall_s"] for r in records)
+    stages = {}
+    for record in records:
+        for name, entry in record["stages"].items():
+            total = stages.setdefault(name, {"wall_s": 0.0, "cpu_s": 0.0, "bytes_read": 0, "bytes_written": 0})
+            for field in total:
+                total[field] += entry[field]
+
+    return {
+        "files": len(records),
+        "failed": sum(1 for r in records if r["status"] != "ok"),
+        "wall_s": batch_wall_s,
+        "images_per_s": len(records) / batch_wall_s if batch_wall_s > 0 else 0.0,
+        "latency_p50_s": _percentile(latencies, 0.50),
+        "latency_p95_s": _percentile(latencies, 0.95),
+        "bytes_read": sum(r["bytes_read"] for r in records),
+        "bytes_written": sum(r["bytes_written"] for r in records),
+        "peak_rss_bytes": max([r["peak_rss_bytes"] for r in records], default=0),
+        "stages": stages,
+    }
+
+
+def format_record(record):
+    """Human-readable per-stage table for --profile."""
+    lines = [f"  {'stage':<16}{'wall':>9}{'cpu':>9}{'read MB':>10}{'write MB':>10}{'peak RSS MB':>13}"]
+    for name, entry in record["stages"].items():
+        lines.append(
+            f"  {name:<16}{entry['wall_s']:>8.3f}s{entry['cpu_s']:>8.3f}s"
+            f"{entry['bytes_read'] / 1e6:>10.1f}{entry['bytes_written'] / 1e6:>10.1f}"
+            f"{entry['peak_rss_bytes'] / 1e6:>13.1f}"
+        )
+    lines.append(f"  {'total':<16}{record['wall_s']:>8.3f}s{record['cpu_s']:>8.3f}s"
+                 f"{record['bytes_read'] / 1e6:>10.1f}{record['bytes_written'] / 1e6:>10.1f}"
+                 f"{record['peak_rss_bytes'] / 1e6:>13.1f}")
+    return "\n".join(lines)
+
+
+def write_report(path, tool, records, summary):
+    """Write file records and batch aggregates as JSON."""
+    report = {
+        "tool": tool,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "summary": summary,
+        "files": records,
+    }
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+def write_metrics_textfile(path, tool, summary):
+    """
+    Write batch aggregates in Prometheus textfile-collector format.
+
+    The file is written to a temp name and renamed, as the collector requires.
+    """
+    prefix = "hdr_exif"
+    label = f'tool="{tool}"'
+    lines = [
+        f"# HELP {prefix}_images_total Images processed in the last run.",
+        f"# TYPE {prefix}_images_total gauge",
+        f"{prefix}_images_total{{{label}}} {summary['files']}",
+        f"# HELP {prefix}_images_failed Images that failed in the last run.",
+        f"# TYPE {prefix}_images_failed gauge",
+        f"{prefix}_images_failed{{{label}}} {summary['failed']}",
+        f"# HELP {prefix}_images_per_second Batch throughput of the last run.",
+        f"# TYPE {prefix}_images_per_second gauge",
+        f"{prefix}_images_per_second{{{label}}} {summary['images_per_s']:.6f}",
+        f"# HELP {prefix}_latency_seconds Per-image latency quantiles of the last run.",
+        f"# TYPE {prefix}_latency_seconds gauge",
+        f'{prefix}_latency_seconds{{{label},quantile="0.5"}} {summary["latency_p50_s"]:.6f}',
+        f'{prefix}_latency_seconds{{{label},quantile="0.95"}} {summary["latency_p95_s"]:.6f}',
+        f"# HELP {prefix}_bytes_read Bytes read by the last run.",
+        f"# TYPE {prefix}_bytes_read gauge",
+        f"{prefix}_bytes_read{{{label}}} {summary['bytes_read']}",
+        f"# HELP {prefix}_bytes_written Bytes written by the last run.",
+        f"# TYPE {prefix}_bytes_written gauge",
+        f"{prefix}_bytes_written{{{label}}} {summary['bytes_written']}",
+        f"# HELP {prefix}_peak_rss_bytes Peak resident set size of the last run.",
+        f"# TYPE {prefix}_peak_rss_bytes gauge",
+        f"{prefix}_peak_rss_bytes{{{label}}} {summary['peak_rss_bytes']}",
+        f"# HELP {prefix}_stage_seconds Wall time per pipeline stage in the last run.",
+        f"# TYPE {prefix}_stage_seconds gauge",
+    ]
+    for name, totals in summary["stages"].items():
+        lines.append(f'{prefix}_stage_seconds{{{label},stage="{name}"}} {totals["wall_s"]:.6f}')
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, path)
@@ -0,0 +1,495 @@
+#!/usr/bin/env python3
+
+"""
+Resident Conversion Server
+==========================
+
+Keeps HDR_ISOGainMap.py and HDR_ICC.py warm between conversions, so single
+files submitted by an asset system no longer pay Python startup, the numpy /
+scipy / cv2 imports and the LUT load each time.
+
+Usage:
+    python HDR_Server.py serve [-j N]
+    python HDR_Server.py submit gainmap shot.tif [--container ultrahdr ...]
+    python HDR_Server.py submit icc shot.tif [--single-decode]
+    python HDR_Server.py status JOB_ID [--wait]
+    python HDR_Server.py ping | stop
+
+All commands take --socket PATH (default: DEFAULT_SOCKET). submit's own
+flags (--no-wait, --profile) go before the mode; everything after the input
+path belongs to the job.
+
+SERVER:
+-------
+- Listens on a Unix domain socket readable by its owner only.
+- gainmap jobs run on a process pool whose workers load the LUT and PQ
+  table once when they start (HDR_ISOGainMap._init_worker); icc jobs run on
+  a thread pool driving magick, with the ICC profiles validated once.
+- A gain map worker that dies (e.g. killed for memory) breaks its pool: the
+  jobs it held fail, and the next submit starts a fresh pool.
+- Every job gets an id and moves queued → running → ok / failed; the last
+  JOB_HISTORY jobs stay available to status queries, with their log, wall
+  time split into queue and run time, and the HDR_Profile stage table.
+
+PROTOCOL:
+---------
+One JSON request per connection, answered with one JSON line:
+    {"op": "submit", "mode": "gainmap" | "icc", "input": path, "args": [...], "wait": bool}
+    {"op": "status", "job": id, "wait": bool}
+    {"op": "ping"}
+    {"op": "stop"}
+"args" are the command-line options of the script, parsed with its own
+parser, so a job does what `python HDR_ISOGainMap.py <input> <args>` would.
+Paths inside the options are resolved by the server; pass absolute ones.
+
+CLIENT:
+-------
+submit sends the job when a server answers on the socket and otherwise
+runs the script locally with the same arguments. Only a failed connect
+falls back: once the server has accepted the request it may have queued
+the job, so a lost connection is an error. The client only imports
+the standard library and HDR_Profile, so it starts quickly.
+"""
+
+# ============================================================================
+# IMPORTS
+# ============================================================================
+
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import redirect_stderr
+from io import StringIO
+
+import HDR_Profile
+
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), f"hdr_exif-{os.getuid()}.sock")
+
+# Job mode → script run locally when no server answers
+MODES = {
+    "gainmap": os.path.join(SCRIPT_DIR, "HDR_ISOGainMap.py"),
+    "icc": os.path.join(SCRIPT_DIR, "HDR_ICC.py"),
+}
+
+JOB_HISTORY = 1000
+
+
+# ============================================================================
+# WIRE FORMAT
+# ============================================================================
+
+def send_message(conn, message):
+    conn.sendall(json.dumps(message).encode() + b"\n")
+
+
+def receive_message(conn):
+    """One JSON line from conn, or None if the peer closed the connection."""
+    line = conn.makefile("rb").readline()
+    return json.loads(line) if line else None
+
+
+class NoServer(OSError):
+    """Nothing accepts connections on the socket path."""
+
+
+def request(socket_path, message):
+    """
+    Send one request and return the server's reply.
+
+    Raises:
+        NoServer: If no server is listening on socket_path
+        OSError: If the connection fails once the server has accepted it
+            (the request may already have been acted on)
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        try:
+            conn.connect(socket_path)
+        except OSError as e:
+            raise NoServer(f"No server on {socket_path}") from e
+        send_message(conn, message)
+        reply = receive_message(conn)
+    if reply is None:
+        raise ConnectionError(f"Server on {socket_path} closed the connection")
+    return reply
+
+
+# ============================================================================
+# JOBS
+# ============================================================================
+
+def _gainmap_task(input_path, output, convert_options):
+    """Process-pool task: one gain map conversion, with its start time."""
+    import HDR_ISOGainMap
+    started = time.time()
+    log, error, record = HDR_ISOGainMap._convert_task(input_path, output, convert_options)
+    return started, log, error, record
+
+
+def _icc_task(input_path, single_decode, env):
+    """Thread-pool task: every ICC profile for one file, with its start time."""
+    import HDR_ICC
+    started = time.time()
+    lines = []
+    error = None
+    HDR_Profile.start_file(input_path)
+    try:
+        HDR_ICC.convert_file(input_path, single_decode, env=env, log=lines.append)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    record = HDR_Profile.finish_file("ok" if error is None else "failed", error)
+    return started, "".join(line + "\n" for line in lines), error, record
+
+
+def parse_job_arguments(parse, input_path, args):
+    """
+    Parse a job's options with a script's own parser.
+
+    Returns:
+        tuple: (namespace, None) or (None, error message)
+    """
+    stderr = StringIO()
+    try:
+        with redirect_stderr(stderr):
+            return parse([input_path] + list(args)), None
+    except SystemExit:
+        lines = stderr.getvalue().strip().splitlines()
+        return None, lines[-1] if lines else "invalid options"
+
+
+# ============================================================================
+# SERVER
+# ============================================================================
+
+def job_queue(jobs):
+    """
+    Start the warm worker pools and return (submit, status, summary, close).
+
+    submit(mode, input_path, args) validates and queues one job and returns
+    its public dict (or raises ValueError); status(job_id, wait) returns it
+    again, blocking until it finishes with wait; summary() describes the
+    server; close() waits for queued jobs and stops the pools.
+    """
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+    import HDR_ICC
+    import HDR_ISOGainMap
+
+    HDR_Profile.enable(True)
+
+    def start_gainmap_pool():
+        sys.stdout.flush()
+        return ProcessPoolExecutor(max_workers=jobs, initializer=HDR_ISOGainMap._init_worker,
+                                   initargs=(True,))
+
+    # Warm state: LUT and PQ table in every worker, ICC profiles checked once
+    pools = {"gainmap": start_gainmap_pool()}
+    for future in [pools["gainmap"].submit(os.getpid) for _ in range(jobs)]:
+        future.result()
+    if not HDR_ICC.validate_icc_profiles():
+        print("⚠ ICC profiles missing: icc jobs will fail")
+    pools["icc"] = ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="icc_job")
+    icc_env = HDR_ICC.magick_environment(jobs)
+
+    condition = threading.Condition()
+    table = OrderedDict()
+    counter = {"next": 1, "ok": 0, "failed": 0}
+
+    def public(job):
+        state = {key: value for key, value in job.items() if key != "future"}
+        if state["status"] == "queued" and job["future"].running():
+            state["status"] = "running"
+        return state
+
+    def finish(job, future):
+        finished = time.time()
+        try:
+            started, log, error, record = future.result()
+        except Exception as e:
+            # Worker crashed (e.g. killed for memory) rather than raising
+            started, log, error, record = finished, "", f"{type(e).__name__}: {e}", None
+        with condition:
+            job.update({
+                "status": "ok" if error is None else "failed",
+                "error": error,
+                "log": log,
+                "queued_s": max(0.0, started - job["submitted_at"]),
+                "run_s": finished - started,
+                "total_s": finished - job["submitted_at"],
+                "record": record,
+            })
+            counter["ok" if error is None else "failed"] += 1
+            condition.notify_all()
+        mark = "✓" if error is None else "✗"
+        print(f"{mark} Job {job['id']} {job['mode']} {os.path.basename(job['input'])}: "
+              f"{job['status']} in {job['total_s']:.2f}s (queued {job['queued_s']:.2f}s)")
+
+    def submit(mode, input_path, args):
+        if mode not in MODES:
+            raise ValueError(f"Unknown mode: {mode}")
+        if not os.path.isfile(input_path):
+            raise ValueError(f"Not a file: {input_path}")
+
+        if mode == "gainmap":
+            options, error = parse_job_arguments(HDR_ISOGainMap.parse_arguments, input_path, args)
+            error = error or HDR_ISOGainMap.argument_error(options)
+            if error is not None:
+                raise ValueError(error)
+            options.intermediates_dir = (tempfile.mkdtemp(prefix="hdr_exif_intermediates_")
+                                         if options.keep_intermediates else None)
+            outputs = [HDR_ISOGainMap.single_file_output(input_path, options.container)]
+            task = (_gainmap_task, input_path, outputs[0], HDR_ISOGainMap.conversion_options(options))
+        else:
+            options, error = parse_job_arguments(lambda argv: HDR_ICC.argument_parser().parse_args(argv),
+                                                 input_path, args)
+            if error is not None:
+                raise ValueError(error)
+            outputs = []
+            task = (_icc_task, input_path, options.single_decode, icc_env)
+
+        with condition:
+            job = {"id": counter["next"], "mode": mode, "input": input_path, "args": list(args),
+                   "outputs": outputs, "status": "queued", "submitted_at": time.time()}
+            counter["next"] += 1
+            try:
+                job["future"] = pools[mode].submit(*task)
+            except BrokenProcessPool:
+                # A gain map worker died (e.g. killed for memory) and took the
+                # pool with it: its jobs fail in finish(), later ones get a
+                # fresh pool. A second failure is reported to the client.
+                print("⚠ Gain map workers lost, restarting them")
+                pools["gainmap"].shutdown(wait=False)
+                pools["gainmap"] = start_gainmap_pool()
+                job["future"] = pools[mode].submit(*task)
+            table[job["id"]] = job
+            while len(table) > JOB_HISTORY and next(iter(table.values()))["status"] != "queued":
+                table.popitem(last=False)
+        job["future"].add_done_callback(lambda future: finish(job, future))
+        return public(job)
+
+    def status(job_id, wait=False):
+        with condition:
+            job = table.get(job_id)
+            if job is None:
+                raise ValueError(f"Unknown job: {job_id}")
+            if wait:
+                condition.wait_for(lambda: job["status"] in ("ok", "failed"))
+            return public(job)
+
+    def summary():
+        with condition:
+            active = sum(1 for job in table.values() if job["status"] == "queued")
+            return {"pid": os.getpid(), "jobs": jobs, "active": active,
+                    "ok": counter["ok"], "failed": counter["failed"]}
+
+    def close():
+        for pool in pools.values():
+            pool.shutdown(wait=True)
+
+    return submit, status, summary, close
+
+
+def bind_socket(socket_path):
+    """Listening Unix socket at socket_path, replacing a stale socket file."""
+    if os.path.exists(socket_path):
+        try:
+            request(socket_path, {"op": "ping"})
+        except NoServer:
+            os.unlink(socket_path)
+        else:
+            raise RuntimeError(f"A server is already running on {socket_path}")
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)
+    try:
+        listener.bind(socket_path)
+    finally:
+        os.umask(old_umask)
+    listener.listen()
+    return listener
+
+
+def serve(socket_path=DEFAULT_SOCKET, jobs=1):
+    """Run the server until a stop request or Ctrl+C."""
+    listener = bind_socket(socket_path)
+    print(f"Starting {jobs} warm worker(s)...")
+    submit, status, summary, close = job_queue(jobs)
+    started = time.time()
+    stopping = threading.Event()
+    print(f"✓ Listening on {socket_path}\n")
+
+    def dispatch(message):
+        op = message.get("op")
+        if op == "submit":
+            job = submit(message.get("mode"), message.get("input", ""), message.get("args", []))
+            return status(job["id"], True) if message.get("wait") else job
+        if op == "status":
+            return status(message.get("job"), bool(message.get("wait")))
+        if op == "ping":
+            return dict(summary(), uptime_s=time.time() - started)
+        if op == "stop":
+            return {"stopping": True}
+        raise ValueError(f"Unknown op: {op}")
+
+    def handle(conn):
+        message = None
+        with conn:
+            try:
+                message = receive_message(conn)
+                if message is None:
+                    return
+                reply = {"ok": True, "result": dispatch(message)}
+            except (ValueError, TypeError, KeyError) as e:
+                reply = {"ok": False, "error": str(e)}
+            except RuntimeError as e:
+                # e.g. BrokenProcessPool when restarted workers die at once
+                reply = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+            try:
+                send_message(conn, reply)
+            except OSError:
+                pass
+        if isinstance(message, dict) and message.get("op") == "stop":
+            # Only once the reply is out: the accept loop then closes and
+            # unlinks the socket. Wake it with an empty connection.
+            stopping.set()
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as wake:
+                wake.connect(socket_path)
+
+    try:
+        while not stopping.is_set():
+            conn, _ = listener.accept()
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+    except KeyboardInterrupt:
+        print("\n⚠ Interrupted")
+    finally:
+        listener.close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        print("Waiting for queued jobs...")
+        close()
+        print("✓ Server stopped")
+
+
+# ============================================================================
+# CLIENT
+# ============================================================================
+
+def print_job(job, show_profile=False):
+    """Replay a finished job's log and print its status line."""
+    print(job.get("log", ""), end="")
+    if job.get("record") is not None and show_profile:
+        print(HDR_Profile.format_record(job["record"]))
+    if job["status"] == "ok":
+        print(f"✓ Job {job['id']} ok in {job['total_s']:.2f}s "
+              f"(queued {job['queued_s']:.2f}s, run {job['run_s']:.2f}s)")
+    elif job["status"] == "failed":
+        print(f"✗ Job {job['id']} failed in {job['total_s']:.2f}s: {job['error']}")
+    else:
+        print(f"Job {job['id']}: {job['status']}")
+
+
+def client_request(socket_path, message):
+    """request() that exits with a message on a server-side error."""
+    reply = request(socket_path, message)
+    if not reply["ok"]:
+        print(f"✗ Error: {reply['error']}")
+        sys.exit(1)
+    return reply["result"]
+
+
+def submit_command(args):
+    input_path = os.path.abspath(args.input_path)
+    message = {"op": "submit", "mode": args.mode, "input": input_path, "args": args.args,
+               "wait": not args.no_wait}
+    try:
+        job = client_request(args.socket, message)
+    except NoServer:
+        # No server: same conversion in this process
+        print(f"⚠ No server on {args.socket}, running {os.path.basename(MODES[args.mode])} locally")
+        sys.stdout.flush()
+        script = MODES[args.mode]
+        os.execv(sys.executable, [sys.executable, script, args.input_path] + args.args)
+    except OSError as e:
+        # The server may have queued the job: running it here could convert it twice
+        print(f"✗ Lost connection to the server on {args.socket}: {e}")
+        sys.exit(1)
+
+    if args.no_wait:
+        print(f"Job {job['id']} queued")
+        return
+    print_job(job, args.profile)
+    if job["status"] != "ok":
+        sys.exit(1)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Resident HDR conversion server and client")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, help=f"Unix socket path (default: {DEFAULT_SOCKET})")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = commands.add_parser("serve", help="Run the server in the foreground")
+    serve_parser.add_argument("-j", "--jobs", type=int, default=1,
+                              help="Gain map worker processes and concurrent magick jobs (default: 1)")
+
+    submit_parser = commands.add_parser("submit", help="Convert one file on the server (or locally)")
+    submit_parser.add_argument("mode", choices=sorted(MODES))
+    submit_parser.add_argument("input_path", help="Image file to convert")
+    submit_parser.add_argument("args", nargs=argparse.REMAINDER,
+                               help="Options of HDR_ISOGainMap.py / HDR_ICC.py for this job")
+    submit_parser.add_argument("--no-wait", action="store_true", help="Queue the job and print its id")
+    submit_parser.add_argument("--profile", action="store_true", help="Print the job's stage table")
+
+    status_parser = commands.add_parser("status", help="Show a job")
+    status_parser.add_argument("job", type=int)
+    status_parser.add_argument("--wait", action="store_true", help="Wait for the job to finish")
+    status_parser.add_argument("--profile", action="store_true", help="Print the job's stage table")
+
+    commands.add_parser("ping", help="Show server state")
+    commands.add_parser("stop", help="Stop the server after its queued jobs")
+
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        if args.jobs < 1:
+            print(f"Error: --jobs must be at least 1, got {args.jobs}")
+            sys.exit(1)
+        try:
+            serve(args.socket, args.jobs)
+        except RuntimeError as e:
+            print(f"✗ Error: {e}")
+            sys.exit(1)
+        return
+
+    if args.command == "submit":
+        submit_command(args)
+        return
+
+    try:
+        if args.command == "status":
+            job = client_request(args.socket, {"op": "status", "job": args.job, "wait": args.wait})
+            print_job(job, args.profile)
+        elif args.command == "ping":
+            state = client_request(args.socket, {"op": "ping"})
+            print(f"✓ Server pid {state['pid']} up {state['uptime_s']:.0f}s: {state['jobs']} worker(s), "
+                  f"{state['active']} active, {state['ok']} ok, {state['failed']} failed")
+        elif args.command == "stop":
+            client_request(args.socket, {"op": "stop"})
+            print("✓ Stop requested")
+    except NoServer:
+        print(f"✗ No server on {args.socket}")
+        sys.exit(1)
+    except OSError as e:
+        print(f"✗ Lost connection to the server on {args.socket}: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
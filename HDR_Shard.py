@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+"""
+Multi-Node Batch Partitioning
+=============================
+
+Lets several render nodes share one batch directory (e.g. on NFS) without
+duplicating work or racing on outputs, for the process_directory loops of
+HDR_ISOGainMap.py and HDR_ICC.py (--shard / --claim-dir / --claim-ttl).
+
+MODEL:
+------
+- Static sharding: --shard i/N keeps the files whose stable hash of the
+  file name falls in shard i of N (1-based). Every node computes the same
+  partition from the name alone, so no coordination is needed.
+- Dynamic claiming: with --claim-dir, a node creates <claim-dir>/<item>.claim
+  with O_CREAT | O_EXCL before converting an item, and skips items another
+  node holds. While the item runs, a heartbeat thread touches the claim every
+  ttl / 3; a claim untouched for ttl seconds belongs to a crashed node and is
+  broken by renaming it away (only one node's rename can succeed).
+- Outputs are written to a partial_path() temp name in the output directory
+  and renamed into place, so a file that exists is always complete and the
+  "output exists" checks are safe across nodes.
+
+Claim expiry compares the claim's mtime (set by the file server) with this
+node's clock, so ttl must be well above the clock skew between nodes.
+"""
+
+# ============================================================================
+# IMPORTS
+# ============================================================================
+
+import argparse
+import hashlib
+import os
+import socket
+import threading
+import time
+import uuid
+
+
+DEFAULT_CLAIM_TTL_S = 120.0
+
+
+# ============================================================================
+# STATIC SHARDING
+# ============================================================================
+
+def shard_spec(text):
+    """argparse type for --shard: 'i/N' with 1 <= i <= N, as (i, N)."""
+    try:
+        index, count = (int(part) for part in text.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/N, got {text!r}")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"shard index must be in 1..{count}, got {index}")
+    return index, count
+
+
+def shard_index(name, count):
+    """Stable 0-based shard of name among count: the same on every node and run."""
+    digest = hashlib.sha1(name.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % count
+
+
+def in_shard(name, shard):
+    """Whether name belongs to shard (i, N); every name does when shard is None."""
+    if shard is None:
+        return True
+    index, count = shard
+    return shard_index(name, count) == index - 1
+
+
+# ============================================================================
+# CLAIMS
+# ============================================================================
+
+class ClaimSkipped(Exception):
+    """The item is held by another node, or was finished by one."""
+
+
+def claim_path(claim_dir, name):
+    """Claim file of item name: readable basename plus a hash of the full name."""
+    digest = hashlib.sha1(name.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(claim_dir, f"{os.path.basename(name)}.{digest}.claim")
+
+
+def _break_stale_claim(path, ttl):
+    """
+    Remove path if its claim has expired. Returns True when the caller should
+    retry creating it, False while a live claim holds it.
+    """
+    try:
+        if time.time() - os.stat(path).st_mtime < ttl:
+            return False
+    except FileNotFoundError:
+        return True
+
+    # Rename first: of several nodes breaking the same claim only one wins
+    grave = f"{path}.stale-{uuid.uuid4().hex}"
+    try:
+        os.rename(path, grave)
+    except FileNotFoundError:
+        return True
+    try:
+        # Another node may have re-claimed between our stat and rename;
+        # hand a fresh claim back (link fails if someone claimed since)
+        if time.time() - os.stat(grave).st_mtime < ttl:
+            try:
+                os.link(grave, path)
+            except OSError:
+                pass
+            return False
+        return True
+    finally:
+        try:
+            os.unlink(grave)
+        except OSError:
+            pass
+
+
+def claim(claim_dir, name, ttl=DEFAULT_CLAIM_TTL_S):
+    """
+    Try to claim item name.
+
+    Returns:
+        str or None: The claim file, or None if another node holds a live claim
+    """
+    os.makedirs(claim_dir, exist_ok=True)
+    path = claim_path(claim_dir, name)
+    owner = f"{socket.gethostname()} {os.getpid()} {time.strftime('%Y-%m-%dT%H:%M:%S')}\n"
+    for _ in range(2):
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            if not _break_stale_claim(path, ttl):
+                return None
+            continue
+        with os.fdopen(fd, "w") as f:
+            f.write(owner)
+        return path
+    return None
+
+
+def release(path):
+    """Give up a claim returned by claim()."""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def break_dead_claim(claim_dir, name):
+    """
+    Remove the claim on item name if it was taken on this host by a process
+    that no longer exists (e.g. a pool worker killed mid-item), whose
+    heartbeat would otherwise hold it for the whole ttl.
+    """
+    path = claim_path(claim_dir, name)
+    try:
+        with open(path) as f:
+            host, pid = f.read().split()[:2]
+        pid = int(pid)
+    except (OSError, ValueError):
+        return
+    if host != socket.gethostname() or pid == os.getpid():
+        return
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        release(path)
+    except PermissionError:
+        pass
+
+
+def run_claimed(claim_dir, names, run, done=None, ttl=DEFAULT_CLAIM_TTL_S):
+    """
+    Runs run() while holding the claims on names (one name or a list, all
+    or nothing), with a heartbeat keeping them fresh, and returns its result.
+
+    done, if given, is checked once the claims are held; when it reports the
+    item already finished (by another node) run() is not called.
+
+    Raises:
+        ClaimSkipped: Another node holds one of the claims, or done() was true
+    """
+    paths = []
+    for name in [names] if isinstance(names, str) else names:
+        path = claim(claim_dir, name, ttl)
+        if path is None:
+            for held in paths:
+                release(held)
+            raise ClaimSkipped("claimed by another node")
+        paths.append(path)
+
+    stop = threading.Event()
+    def heartbeat():
+        while not stop.wait(ttl / 3):
+            for path in paths:
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+    beat = threading.Thread(target=heartbeat, name="claim_heartbeat", daemon=True)
+    beat.start()
+    try:
+        if done is not None and done():
+            raise ClaimSkipped("finished by another node")
+        return run()
+    finally:
+        stop.set()
+        beat.join()
+        for path in paths:
+            release(path)
+
+
+# ============================================================================
+# ATOMIC OUTPUTS
+# ============================================================================
+
+def partial_path(path):
+    """
+    Unique temp name next to path for writing it before os.replace. The
+    extension is kept last, so encoders that pick the format from the
+    name (cv2, magick) still do.
+    """
+    root, ext = os.path.splitext(path)
+    return f"{root}.part-{uuid.uuid4().hex[:12]}{ext}"
+
+
+def discard(path):
+    """Remove a partial file left by a failed write, if any."""
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
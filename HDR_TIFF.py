@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+"""
+Zero-Copy TIFF Input
+====================
+
+Maps the pixels of uncompressed 16-bit RGB TIFFs straight from the file for
+read_source_image in HDR_ISOGainMap.py, instead of decoding them with cv2
+(opt-in with --mmap-input). --analyze always maps the files it can, since
+it only reads the sampled rows.
+
+LAYOUT:
+-------
+source_layout() reads the first IFD of a classic or BigTIFF file and
+accepts only images that need no decoding at all:
+- 3 samples per pixel, 16-bit unsigned, chunky (RGBRGB...), RGB photometric
+- no compression, no tiles, no extra samples, default orientation
+- strips stored back to back, so the pixels are one run of H * W * 3 samples
+- this machine's byte order, so no sample has to be swapped
+Anything else returns None and is decoded by cv2 as before.
+
+map_bgr() maps that run read-only with np.memmap and returns it as an
+(H, W, 3) uint16 view with the channel axis reversed: the BGR order
+cv2.imread returns. The map itself copies nothing; pixels stay in the page
+cache, and each strip of the pipeline (--tile-budget-mb) faults in only its
+rows. The reversed axis has a negative stride, so a stage that needs a
+strip's codes contiguous in BGR order copies that strip: the LUT's flat
+view of a strip does not, and the PQ code histogram counts the strip in
+its stored RGB order instead (add_pq_code_histogram).
+"""
+
+# ============================================================================
+# IMPORTS
+# ============================================================================
+
+import struct
+import sys
+
+import numpy as np
+
+
+# Baseline TIFF tags used to recognize a mappable layout
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+PHOTOMETRIC = 262
+STRIP_OFFSETS = 273
+ORIENTATION = 274
+SAMPLES_PER_PIXEL = 277
+STRIP_BYTE_COUNTS = 279
+PLANAR_CONFIGURATION = 284
+TILE_WIDTH = 322
+EXTRA_SAMPLES = 338
+SAMPLE_FORMAT = 339
+
+# Integer field types (BYTE, SHORT, LONG, LONG8) → struct format
+INTEGER_TYPES = {1: "B", 3: "H", 4: "I", 16: "Q"}
+
+NATIVE_BYTE_ORDER = b"II" if sys.byteorder == "little" else b"MM"
+
+
+# ============================================================================
+# HEADER
+# ============================================================================
+
+def _read_ifd(f, endian, bigtiff, offset):
+    """Integer-valued tags of the IFD at offset, as {tag: tuple of values}."""
+    count_format, entry_size, field_size = ("Q", 20, 8) if bigtiff else ("H", 12, 4)
+    f.seek(offset)
+    (entry_count,) = struct.unpack(endian + count_format, f.read(struct.calcsize(count_format)))
+    entries = f.read(entry_count * entry_size)
+
+    tags = {}
+    for start in range(0, len(entries) - entry_size + 1, entry_size):
+        entry = entries[start:start + entry_size]
+        tag, field_type = struct.unpack(endian + "HH", entry[:4])
+        value_format = INTEGER_TYPES.get(field_type)
+        if value_format is None:
+            continue
+        (count,) = struct.unpack(endian + ("Q" if bigtiff else "I"), entry[4:entry_size - field_size])
+        size = count * struct.calcsize(value_format)
+        field = entry[entry_size - field_size:]
+        if size <= field_size:
+            raw = field[:size]
+        else:
+            # Values too large for the entry live at the offset it holds
+            (values_offset,) = struct.unpack(endian + ("Q" if bigtiff else "I"), field)
+            position = f.tell()
+            f.seek(values_offset)
+            raw = f.read(size)
+            f.seek(position)
+        tags[tag] = struct.unpack(f"{endian}{count}{value_format}", raw)
+    return tags
+
+
+def _first_ifd(path):
+    """(byte order mark, tags of the first IFD) of a classic or BigTIFF file, or None."""
+    try:
+        with open(path, "rb") as f:
+            header = f.read(16)
+            if header[:2] not in (b"II", b"MM"):
+                return None
+            endian = "<" if header[:2] == b"II" else ">"
+            (version,) = struct.unpack(endian + "H", header[2:4])
+            if version == 42:
+                (ifd_offset,) = struct.unpack(endian + "I", header[4:8])
+                return header[:2], _read_ifd(f, endian, False, ifd_offset)
+            if version == 43:
+                (ifd_offset,) = struct.unpack(endian + "Q", header[8:16])
+                return header[:2], _read_ifd(f, endian, True, ifd_offset)
+    except (OSError, struct.error):
+        pass
+    return None
+
+
+def image_size(path):
+    """
+    (height, width) of path's first image from its TIFF header (any
+    compression or layout), or None if path is not a readable TIFF.
+    """
+    ifd = _first_ifd(path)
+    if ifd is None or IMAGE_WIDTH not in ifd[1] or IMAGE_LENGTH not in ifd[1]:
+        return None
+    return ifd[1][IMAGE_LENGTH][0], ifd[1][IMAGE_WIDTH][0]
+
+
+def decoded_nbytes(path):
+    """
+    Bytes of path's first image once decoded, from its TIFF header (any
+    compression or layout), or None if path is not a readable TIFF.
+    """
+    ifd = _first_ifd(path)
+    if ifd is None:
+        return None
+    tags = ifd[1]
+    if IMAGE_WIDTH not in tags or IMAGE_LENGTH not in tags:
+        return None
+    samples = tags.get(SAMPLES_PER_PIXEL, (1,))[0]
+    sample_bytes = (tags.get(BITS_PER_SAMPLE, (1,))[0] + 7) // 8
+    return tags[IMAGE_LENGTH][0] * tags[IMAGE_WIDTH][0] * samples * sample_bytes
+
+
+def source_layout(path):
+    """
+    (pixel data offset, height, width) if path is a TIFF whose first image
+    map_bgr can map (see LAYOUT), else None.
+    """
+    ifd = _first_ifd(path)
+    if ifd is None or ifd[0] != NATIVE_BYTE_ORDER:
+        return None
+    tags = ifd[1]
+
+    def value(tag, default=None):
+        return tags.get(tag, (default,))[0]
+
+    width = value(IMAGE_WIDTH)
+    height = value(IMAGE_LENGTH)
+    if width is None or height is None:
+        return None
+    if (value(SAMPLES_PER_PIXEL, 1) != 3 or tags.get(BITS_PER_SAMPLE) != (16, 16, 16)
+            or any(sample_format != 1 for sample_format in tags.get(SAMPLE_FORMAT, (1,)))
+            or value(COMPRESSION, 1) != 1 or value(PHOTOMETRIC) != 2
+            or value(PLANAR_CONFIGURATION, 1) != 1 or value(ORIENTATION, 1) != 1
+            or TILE_WIDTH in tags or EXTRA_SAMPLES in tags):
+        return None
+
+    offsets = tags.get(STRIP_OFFSETS, ())
+    byte_counts = tags.get(STRIP_BYTE_COUNTS, ())
+    if not offsets or len(offsets) != len(byte_counts):
+        return None
+    if any(offset + count != following for offset, count, following in zip(offsets, byte_counts, offsets[1:])):
+        return None
+    if sum(byte_counts) != height * width * 3 * 2:
+        return None
+    return offsets[0], height, width
+
+
+# ============================================================================
+# MAPPING
+# ============================================================================
+
+def map_bgr(path):
+    """
+    Read-only (H, W, 3) uint16 BGR view of the pixels of path, mapped from
+    the file, or None when its layout needs decoding (use cv2 then).
+    """
+    layout = source_layout(path)
+    if layout is None:
+        return None
+    offset, height, width = layout
+    try:
+        rgb = np.memmap(path, dtype=np.uint16, mode="r", offset=offset, shape=(height, width, 3))
+    except (OSError, ValueError):
+        # e.g. a truncated file: let cv2 report it
+        return None
+    return rgb[..., ::-1]
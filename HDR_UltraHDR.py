@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+"""
+Ultra HDR JPEG Writer
+=====================
+
+Assembles an SDR base image and a gain map, both already in memory as numpy
+arrays, into a single Ultra HDR (v1) JPEG, without external tools.
+
+FILE LAYOUT:
+------------
+  Primary JPEG (SDR base)
+    SOI
+    APP0 JFIF                         (from the encoder, if present)
+    APP1 XMP   Container:Directory    lists the Primary and GainMap items
+    APP2 MPF   Multi-Picture index    byte offsets/sizes of both images
+    ... rest of the SDR JPEG ...
+  Gain map JPEG (appended)
+    SOI
+    APP1 XMP   hdrgm:* metadata       min/max boost, gamma, offsets, capacity
+    ... rest of the gain map JPEG ...
+
+The hdrgm metadata follows the Adobe gain map namespace used by Ultra HDR and
+mirrored by ISO 21496-1: a decoder recovers
+    HDR = (SDR + OffsetSDR) * 2^(GainMapMin + (GainMapMax - GainMapMin) * map^(1/Gamma)) - OffsetHDR
+with SDR/HDR in linear light relative to SDR white, and log2 values for
+GainMapMin/Max and HDRCapacityMin/Max.
+"""
+
+# ============================================================================
+# IMPORTS
+# ============================================================================
+
+import os
+import struct
+
+import cv2
+import numpy as np
+
+import HDR_Shard
+
+
+XMP_NAMESPACE = b"http://ns.adobe.com/xap/1.0/\x00"
+MPF_IDENTIFIER = b"MPF\x00"
+
+# MP entry attributes (CIPA DC-007): JPEG format, primary image type
+MP_ATTRIBUTE_PRIMARY = 0x00030000
+MP_ATTRIBUTE_SECONDARY = 0x00000000
+
+
+# ============================================================================
+# METADATA SEGMENTS
+# ============================================================================
+
+def _segment(marker, payload):
+    """One JPEG marker segment: FFxx, 16-bit big-endian length, payload."""
+    if len(payload) + 2 > 0xFFFF:
+        raise ValueError("JPEG marker segment too large")
+    return struct.pack(">BBH", 0xFF, marker, len(payload) + 2) + payload
+
+
+def _primary_xmp(gain_map_length):
+    xmp = (
+        '<x:xmpmeta xmlns:x="adobe:ns:meta/" x:xmptk="HDR_EXIF">'
+        '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+        '<rdf:Description rdf:about=""'
+        ' xmlns:Container="http://ns.google.com/photos/1.0/container/"'
+        ' xmlns:Item="http://ns.google.com/photos/1.0/container/item/"'
+        ' xmlns:hdrgm="http://ns.adobe.com/hdr-gain-map/1.0/"'
+        ' hdrgm:Version="1.0">'
+        '<Container:Directory><rdf:Seq>'
+        '<rdf:li rdf:parseType="Resource">'
+        '<Container:Item Item:Semantic="Primary" Item:Mime="image/jpeg"/>'
+        '</rdf:li>'
+        '<rdf:li rdf:parseType="Resource">'
+        f'<Container:Item Item:Semantic="GainMap" Item:Mime="image/jpeg" Item:Length="{gain_map_length}"/>'
+        '</rdf:li>'
+        '</rdf:Seq></Container:Directory>'
+        '</rdf:Description></rdf:RDF></x:xmpmeta>'
+    )
+    return _segment(0xE1, XMP_NAMESPACE + xmp.encode())
+
+
+def _gain_map_xmp(metadata):
+    xmp = (
+        '<x:xmpmeta xmlns:x="adobe:ns:meta/" x:xmptk="HDR_EXIF">'
+        '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+        '<rdf:Description rdf:about=""'
+        ' xmlns:hdrgm="http://ns.adobe.com/hdr-gain-map/1.0/"'
+        ' hdrgm:Version="1.0"'
+        f' hdrgm:GainMapMin="{metadata["gain_map_min"]:.6f}"'
+        f' hdrgm:GainMapMax="{metadata["gain_map_max"]:.6f}"'
+        f' hdrgm:Gamma="{metadata["gamma"]:.6f}"'
+        f' hdrgm:OffsetSDR="{metadata["offset_sdr"]:.6f}"'
+        f' hdrgm:OffsetHDR="{metadata["offset_hdr"]:.6f}"'
+        f' hdrgm:HDRCapacityMin="{metadata["hdr_capacity_min"]:.6f}"'
+        f' hdrgm:HDRCapacityMax="{metadata["hdr_capacity_max"]:.6f}"'
+        ' hdrgm:BaseRenditionIsHDR="False"/>'
+        '</rdf:RDF></x:xmpmeta>'
+    )
+    return _segment(0xE1, XMP_NAMESPACE + xmp.encode())
+
+
+def _mpf_segment(primary_size, gain_map_size, gain_map_offset):
+    """
+    APP2 MPF index with two entries. Offsets are relative to the MPF TIFF
+    header (the byte after "MPF\\0"), as the Multi-Picture Format requires.
+    """
+    entry_count = 3
+    ifd_size = 2 + entry_count * 12 + 4
+    entries_offset = 8 + ifd_size
+
+    tiff = b"MM\x00\x2A" + struct.pack(">I", 8)
+    tiff += struct.pack(">H", entry_count)
+    tiff += struct.pack(">HHI4s", 0xB000, 7, 4, b"0100")                  # MPFVersion
+    tiff += struct.pack(">HHII", 0xB001, 4, 1, 2)                           # NumberOfImages
+    tiff += struct.pack(">HHII", 0xB002, 7, 2 * 16, entries_offset)         # MPEntry
+    tiff += struct.pack(">I", 0)                                            # no next IFD
+    tiff += struct.pack(">IIIHH", MP_ATTRIBUTE_PRIMARY, primary_size, 0, 0, 0)
+    tiff += struct.pack(">IIIHH", MP_ATTRIBUTE_SECONDARY, gain_map_size, gain_map_offset, 0, 0)
+    return _segment(0xE2, MPF_IDENTIFIER + tiff)
+
+
+def _split_after_app0(jpeg):
+    """Split encoder output into (SOI [+ APP0 JFIF], remaining segments)."""
+    if jpeg[:2] != b"\xFF\xD8":
+        raise ValueError("Encoder output is not a JPEG")
+    position = 2
+    if jpeg[2:4] == b"\xFF\xE0":
+        position += 2 + struct.unpack(">H", jpeg[4:6])[0]
+    return jpeg[:position], jpeg[position:]
+
+
+# ============================================================================
+# WRITER
+# ============================================================================
+
+def encode_ultrahdr_jpeg(sdr_base_bgr, gain_map, metadata, quality=95, gain_map_quality=85):
+    """
+    Build an Ultra HDR JPEG in memory.
+
+    Parameters:
+        sdr_base_bgr (ndarray): (H, W, 3) sRGB-encoded SDR base, float 0-1, uint16
+            fixed-point (0-65535) or uint8, BGR order
+        gain_map (ndarray): (h, w) uint8 log-encoded gain map (any resolution)
+        metadata (dict): gain_map_min, gain_map_max, gamma, offset_sdr,
+            offset_hdr, hdr_capacity_min, hdr_capacity_max (log2 where applicable)
+        quality (int): JPEG quality of the SDR base
+        gain_map_quality (int): JPEG quality of the gain map
+
+    Returns:
+        bytes: The complete file
+    """
+    if sdr_base_bgr.dtype == np.uint16:
+        sdr_base_bgr = ((sdr_base_bgr.astype(np.uint32) * 255 + 32767) // 65535).astype(np.uint8)
+    elif sdr_base_bgr.dtype != np.uint8:
+        sdr_base_bgr = np.asarray(sdr_base_bgr, dtype=np.float32)
+        sdr_base_bgr = (np.clip(sdr_base_bgr, 0.0, 1.0) * 255.0 + 0.5).astype(np.uint8)
+
+    ok, primary = cv2.imencode(".jpg", sdr_base_bgr, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError("Could not encode SDR base as JPEG")
+    ok, secondary = cv2.imencode(".jpg", gain_map, [cv2.IMWRITE_JPEG_QUALITY, gain_map_quality])
+    if not ok:
+        raise ValueError("Could not encode gain map as JPEG")
+
+    head, tail = _split_after_app0(primary.tobytes())
+    gm_head, gm_tail = _split_after_app0(secondary.tobytes())
+    gain_map_jpeg = gm_head + _gain_map_xmp(metadata) + gm_tail
+
+    xmp = _primary_xmp(len(gain_map_jpeg))
+    # The MPF segment has a fixed size, so sizes and offsets can be computed
+    # from a placeholder before the real segment is built
+    mpf_size = len(_mpf_segment(0, 0, 0))
+    primary_size = len(head) + len(xmp) + mpf_size + len(tail)
+    mpf_header_position = len(head) + len(xmp) + 4 + len(MPF_IDENTIFIER)
+    mpf = _mpf_segment(primary_size, len(gain_map_jpeg), primary_size - mpf_header_position)
+
+    return head + xmp + mpf + tail + gain_map_jpeg
+
+
+def write_ultrahdr_jpeg(output_path, sdr_base_bgr, gain_map, metadata, quality=95, gain_map_quality=85):
+    """
+    Encode with encode_ultrahdr_jpeg and write atomically to output_path.
+
+    Returns:
+        int: Bytes written
+    """
+    data = encode_ultrahdr_jpeg(sdr_base_bgr, gain_map, metadata, quality, gain_map_quality)
+    partial_path = HDR_Shard.partial_path(output_path)
+    try:
+        with open(partial_path, 'wb') as f:
+            f.write(data)
+        os.replace(partial_path, output_path)
+    except OSError:
+        HDR_Shard.discard(partial_path)
+        raise
+    return len(data)
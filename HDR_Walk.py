@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+"""
+Batch Input Walking and Resume Journal
+======================================
+
+Feeds the process_directory loops of HDR_ISOGainMap.py and HDR_ICC.py
+(--recursive / --largest-first / --journal).
+
+MODEL:
+------
+- walk_images() yields (relative path, size) for the supported images below
+  a directory, one os.scandir listing at a time, so the batch starts
+  converting as soon as the first file is found. Subdirectories are entered
+  only with recursive; hidden entries and symlinked directories never are.
+- By default each directory is yielded in name order, so batches, logs and
+  sequences run in a stable order. Sorting needs the directory's whole
+  listing first: for one flat directory of a million files, that is every
+  entry in memory before the first yield. ordered=False yields entries as
+  os.scandir returns them instead, for callers that reorder anyway.
+- largest_first() has to see every size before it can yield, so it holds
+  the (path, size) pairs (from an unordered walk, as it sorts them itself).
+  That is still no per-file work, and converting the large files first
+  keeps a worker pool from ending on one big file.
+- A journal is an append-only text file with one JSON line per completed
+  item, keyed by the item's path relative to the batch directory.
+  open_journal() returns the items already done, so a rerun skips them, and
+  appends a flushed line per item, so an interrupted run loses at most the
+  items in flight. A line torn by a crash is ignored.
+
+A journal belongs to one node: several nodes appending to one file on NFS
+may interleave their lines, so give each node its own (see HDR_Shard).
+"""
+
+# ============================================================================
+# IMPORTS
+# ============================================================================
+
+import json
+import os
+import threading
+import time
+
+
+# ============================================================================
+# WALKING
+# ============================================================================
+
+def _entries(path, ordered):
+    """One directory's entries: a list in name order, or the open os.scandir iterator."""
+    listing = os.scandir(path)
+    if not ordered:
+        return listing
+    with listing:
+        return sorted(listing, key=lambda entry: entry.name)
+
+
+def walk_images(directory, extensions, recursive=False, ordered=True):
+    """
+    Iterator of (path relative to directory, size in bytes) over every file
+    whose name ends with one of extensions (lowercase), directory by
+    directory. directory itself is listed right away; the rest as the
+    iterator is consumed. With ordered False, files and subdirectories come
+    in os.scandir order and no directory is listed ahead of its files.
+
+    Raises:
+        PermissionError: If directory cannot be listed; unreadable
+            subdirectories are reported and skipped
+    """
+    root = _entries(directory, ordered)
+
+    def walk():
+        pending = [("", root)]
+        while pending:
+            relative_dir, entries = pending.pop()
+            if entries is None:
+                try:
+                    entries = _entries(os.path.join(directory, relative_dir), ordered)
+                except PermissionError:
+                    print(f"⚠ Skipping unreadable directory: {relative_dir}")
+                    continue
+
+            subdirs = []
+            try:
+                for entry in entries:
+                    if entry.name.startswith("."):
+                        continue
+                    relative_path = os.path.join(relative_dir, entry.name)
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive:
+                            subdirs.append((relative_path, None))
+                    elif entry.name.lower().endswith(extensions) and entry.is_file():
+                        yield relative_path, entry.stat().st_size
+            finally:
+                if not ordered:
+                    entries.close()
+            # Depth first, subdirectories in listing order
+            pending.extend(reversed(subdirs))
+
+    return walk()
+
+
+def largest_first(items):
+    """(path, size) items sorted by size, largest first; ties by path."""
+    return sorted(items, key=lambda item: (-item[1], item[0]))
+
+
+# ============================================================================
+# JOURNAL
+# ============================================================================
+
+def open_journal(path):
+    """
+    Read the journal at path (if any) and prepare appending to it.
+
+    Returns:
+        tuple: (done, record) where done is the set of items already
+            journaled and record(item, **fields) appends one completed item
+    """
+    done = set()
+    torn = False
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            for line in f:
+                torn = not line.endswith(b"\n")
+                try:
+                    done.add(json.loads(line)["item"])
+                except (ValueError, KeyError, TypeError):
+                    continue
+    lock = threading.Lock()
+    # Finish a torn line so the first record starts on its own
+    state = {"prefix": "\n" if torn else ""}
+
+    def record(item, **fields):
+        line = json.dumps(dict(item=item, time=time.strftime("%Y-%m-%dT%H:%M:%S"), **fields))
+        # Opened per record: nothing to close, and every line is on disk
+        # (in the page cache) before the next item is reported
+        with lock, open(path, "a", encoding="utf-8") as journal:
+            journal.write(state["prefix"] + line + "\n")
+            state["prefix"] = ""
+
+    return done, record
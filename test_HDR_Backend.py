@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+"""
+numba Backend Equivalence
+=========================
+
+Runs convert_to_avif_gainmap on a synthetic frame with the numpy and the
+numba backend (HDR_Backend.py) and checks that the outputs are identical.
+
+With a fixed16 SDR base, decoded by the shared sRGB table, the only power
+functions left are the gain map gamma, which both backends take from numpy,
+so the outputs must be identical. The default float32 base is decoded with
+libm powf in the kernels and numpy's SIMD power in the reference, so its
+gain map may differ by one code and its headroom by BACKEND_RTOL.
+--composite-lut decodes a float32 base from a baked table instead (held to
+COMPOSITE_TOLERANCE in test_HDR_LUT.py). Skipped when numba is not installed.
+
+    python -m pytest -q test_HDR_Backend.py
+"""
+
+# ============================================================================
+# IMPORTS
+# ============================================================================
+
+import contextlib
+import io
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+pytest.importorskip("numba")
+
+import HDR_ISOGainMap as gainmap
+from HDR_Benchmark import synthetic_pq_image
+
+
+# Headroom tolerance of the float32 kernels: one float32 rounding of the
+# decoded SDR luminance, with margin
+BACKEND_RTOL = 1e-6
+
+
+def convert(tmp_path, image, lut_method, backend, precision="fixed16", composite_lut=False):
+    output_file = os.path.join(tmp_path, f"{backend}.avif")
+    with contextlib.redirect_stdout(io.StringIO()):
+        return gainmap.convert_to_avif_gainmap("synthetic.tif", output_file, lut_method, image=image,
+                                               precision=precision, backend=backend, composite_lut=composite_lut)
+
+
+@pytest.mark.parametrize("lut_method", gainmap.LUT_METHODS)
+def test_numba_matches_numpy(tmp_path, lut_method):
+    image = synthetic_pq_image(540, 960)
+    reference = convert(tmp_path, image, lut_method, "numpy")
+    fused = convert(tmp_path, image, lut_method, "numba")
+
+    assert np.array_equal(fused["sdr_base"], reference["sdr_base"])
+    assert fused["gain_map"].tobytes() == reference["gain_map"].tobytes()
+    assert fused["estimated_headroom"] == reference["estimated_headroom"]
+
+
+@pytest.mark.parametrize("lut_method", gainmap.LUT_METHODS)
+@pytest.mark.parametrize("seed", [0, 1])
+def test_numba_float32_within_tolerance(tmp_path, lut_method, seed):
+    image = synthetic_pq_image(1080, 1920, seed)
+    reference = convert(tmp_path, image, lut_method, "numpy", "float32")
+    fused = convert(tmp_path, image, lut_method, "numba", "float32")
+
+    assert np.array_equal(fused["sdr_base"], reference["sdr_base"])
+    reference_png = cv2.imread(os.path.join(tmp_path, "numpy_gainmap.png"), cv2.IMREAD_UNCHANGED)
+    fused_png = cv2.imread(os.path.join(tmp_path, "numba_gainmap.png"), cv2.IMREAD_UNCHANGED)
+    assert fused_png.shape == reference_png.shape
+    assert np.abs(fused_png.astype(np.int16) - reference_png).max() <= 1
+    assert fused["estimated_headroom"] == pytest.approx(reference["estimated_headroom"], rel=BACKEND_RTOL)
+
+
+@pytest.mark.parametrize("lut_method", gainmap.LUT_METHODS)
+def test_composite_lut_within_tolerance(tmp_path, lut_method):
+    image = synthetic_pq_image(540, 960, seed=1)
+    reference = convert(tmp_path, image, lut_method, "numpy", "float32")
+    baked = convert(tmp_path, image, lut_method, "numba", "float32", composite_lut=True)
+
+    assert np.array_equal(baked["sdr_base"], reference["sdr_base"])
+    difference = np.abs(baked["gain_map"].astype(np.int16) - reference["gain_map"])
+    assert difference.max() <= 1
+    assert baked["estimated_headroom"] == pytest.approx(reference["estimated_headroom"],
+                                                        rel=gainmap.COMPOSITE_TOLERANCE)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+"""
+Worker Crashes in Batches
+=========================
+
+A worker that dies mid-file (killed for memory, crashed) breaks the whole
+process pool of a --jobs batch. process_directory must replace the pool,
+finish every other file, and report only the file that kills its worker
+as failed. Needs fork-started workers to plant the crash.
+
+The batch runs in a fresh interpreter: forking the pytest process after
+test_HDR_Backend has started numba's TBB threads in it can hang that
+process at exit.
+
+    python -m pytest -q test_HDR_Batch.py
+"""
+
+# ============================================================================
+# IMPORTS
+# ============================================================================
+
+import multiprocessing
+import os
+import subprocess
+import sys
+
+import cv2
+import pytest
+
+from HDR_Benchmark import synthetic_pq_image
+
+
+# Inherited by the forked workers: the worker given frame_05 dies at once
+CRASHING_BATCH = """
+import os
+import sys
+
+import HDR_ISOGainMap as gainmap
+
+run_conversion = gainmap.run_conversion
+def crashing_conversion(file_path, output, convert_options):
+    if os.path.basename(file_path) == "frame_05.tif":
+        os._exit(9)
+    return run_conversion(file_path, output, convert_options)
+gainmap.run_conversion = crashing_conversion
+
+print(gainmap.process_directory(sys.argv[1], jobs=2))
+"""
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != "fork", reason="needs fork-started workers")
+def test_dead_worker_fails_only_its_file(tmp_path):
+    source_dir = tmp_path / "src"
+    source_dir.mkdir()
+    filenames = [f"frame_{index:02d}.tif" for index in range(16)]
+    for index, filename in enumerate(filenames):
+        cv2.imwrite(str(source_dir / filename), synthetic_pq_image(32, 48, seed=index))
+
+    result = subprocess.run([sys.executable, "-c", CRASHING_BATCH, str(source_dir)],
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, timeout=300)
+    assert result.returncode == 0, result.stderr
+    out = result.stdout
+    assert out.splitlines()[-1] == "(15, 1, 0)"
+
+    assert "BrokenProcessPool" in out.split("Processing: frame_05.tif")[1].split("Processing: frame_06.tif")[0]
+    converted = sorted(os.listdir(tmp_path / "converted_gainmap"))
+    assert converted == sorted(f"{filename[:-4]}_gainmap.png" for filename in filenames if filename != "frame_05.tif")
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+"""
+Artifact Cache
+==============
+
+The pass-1 cache (--cache-dir) must key entries on everything that changes
+the intermediates (input bytes, LUT file, LUT method, precision), give the
+same outputs on a hit as on a miss, publish exactly one entry when workers
+race on a key, and evict least recently used entries first.
+
+    python -m pytest -q test_HDR_Cache.py
+"""
+
+# ============================================================================
+# IMPORTS
+# ============================================================================
+
+import contextlib
+import io
+import os
+import shutil
+import threading
+
+import cv2
+import numpy as np
+import pytest
+
+import HDR_Cache
+import HDR_ISOGainMap as gainmap
+from HDR_Benchmark import synthetic_pq_image
+
+
+def test_artifact_key_covers_input_lut_and_parameters(tmp_path, monkeypatch):
+    source = str(tmp_path / "frame.tif")
+    cv2.imwrite(source, synthetic_pq_image(32, 48))
+    key = gainmap.artifact_key(source, "trilinear")
+    assert gainmap.artifact_key(source, "trilinear", "float32") == key
+
+    keys = {
+        "method": gainmap.artifact_key(source, "tetrahedral"),
+        "float16": gainmap.artifact_key(source, "trilinear", "float16"),
+        "fixed16": gainmap.artifact_key(source, "trilinear", "fixed16"),
+    }
+
+    lut_path = str(tmp_path / gainmap.LUT_FILENAME)
+    shutil.copyfile(gainmap.LUT_PATH, lut_path)
+    monkeypatch.setattr(gainmap, "LUT_PATH", lut_path)
+    assert gainmap.artifact_key(source, "trilinear") == key
+    with open(lut_path, "a") as f:
+        f.write("# edited\n")
+    keys["lut"] = gainmap.artifact_key(source, "trilinear")
+    monkeypatch.undo()
+
+    cv2.imwrite(source, synthetic_pq_image(32, 48, seed=1))
+    keys["input"] = gainmap.artifact_key(source, "trilinear")
+
+    assert len(set(keys.values()) | {key}) == len(keys) + 1
+
+
+@pytest.mark.parametrize("container", ["none", "ultrahdr"])
+def test_cache_hit_writes_the_same_outputs_as_a_miss(tmp_path, container):
+    source = str(tmp_path / "frame.tif")
+    cv2.imwrite(source, synthetic_pq_image(64, 80))
+    cache_dir = str(tmp_path / "cache")
+
+    logs = {}
+    for name in ("miss", "hit"):
+        output_dir = tmp_path / name
+        output_dir.mkdir()
+        output_file = str(output_dir / ("frame" + gainmap.output_extension(container)))
+        logs[name] = io.StringIO()
+        with contextlib.redirect_stdout(logs[name]):
+            gainmap.convert_to_avif_gainmap(source, output_file, cache_dir=cache_dir, container=container)
+
+    assert "Using cached intermediates" not in logs["miss"].getvalue()
+    assert "Using cached intermediates" in logs["hit"].getvalue()
+    assert sorted(os.listdir(tmp_path / "hit")) == sorted(os.listdir(tmp_path / "miss"))
+    for filename in os.listdir(tmp_path / "miss"):
+        with open(tmp_path / "miss" / filename, "rb") as miss, open(tmp_path / "hit" / filename, "rb") as hit:
+            assert hit.read() == miss.read(), filename
+
+
+def test_racing_commits_publish_one_entry(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    staging_dirs = []
+    for value in range(4):
+        staging_dir = HDR_Cache.cache_stage(cache_dir)
+        HDR_Cache.stage_array(staging_dir, "plane", (8, 8), np.float32)[:] = value
+        staging_dirs.append(staging_dir)
+
+    barrier = threading.Barrier(len(staging_dirs))
+    def commit(value, staging_dir):
+        barrier.wait()
+        HDR_Cache.cache_commit(cache_dir, "key", staging_dir, {"value": value})
+    threads = [threading.Thread(target=commit, args=item) for item in enumerate(staging_dirs)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert os.listdir(cache_dir) == ["key"]
+    arrays, stats = HDR_Cache.cache_lookup(cache_dir, "key")
+    assert np.all(arrays["plane"] == stats["value"])
+
+
+def test_evict_removes_least_recently_used_first(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    for index, name in enumerate(("old", "middle", "new")):
+        staging_dir = HDR_Cache.cache_stage(cache_dir)
+        HDR_Cache.stage_array(staging_dir, "plane", (64, 64), np.float32)[:] = index
+        HDR_Cache.cache_commit(cache_dir, name, staging_dir, {})
+        os.utime(os.path.join(cache_dir, name, HDR_Cache.STATS_FILENAME), (1000.0 + index, 1000.0 + index))
+    entry_bytes = HDR_Cache._entry_size(os.path.join(cache_dir, "old"))
+
+    assert HDR_Cache.cache_evict(cache_dir, 3 * entry_bytes) == 0
+    assert HDR_Cache.cache_evict(cache_dir, 2 * entry_bytes) == 1
+    assert sorted(os.listdir(cache_dir)) == ["middle", "new"]
+
+    # A hit makes "middle" the most recently used
+    assert HDR_Cache.cache_lookup(cache_dir, "middle") is not None
+    assert HDR_Cache.cache_evict(cache_dir, entry_bytes) == 1
+    assert os.listdir(cache_dir) == ["middle"]
+    assert HDR_Cache.cache_evict(cache_dir, 0) == 1
+    assert os.listdir(cache_dir) == []
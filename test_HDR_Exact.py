@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+"""
+Bit-Exact Fast Paths
+====================
+
+Fast paths whose docstrings promise bit-identical results must deliver
+them: the uint16 PQ table against the per-pixel EOTF on every code, and
+the chunked fused headroom against max_gain_ratio for each SDR storage
+precision.
+
+    python -m pytest -q test_HDR_Exact.py
+"""
+
+# ============================================================================
+# IMPORTS
+# ============================================================================
+
+import numpy as np
+import pytest
+
+import HDR_ISOGainMap as gainmap
+from HDR_Benchmark import synthetic_pq_image
+
+
+def test_pq_table_matches_eotf_on_every_code():
+    codes = np.arange(65536, dtype=np.uint16).reshape(256, 256)
+    table = gainmap.pq_u16_to_absolute_nits(codes)
+    reference = gainmap.normalized_pq_to_absolute_nits(codes.astype(np.float32) / 65535.0)
+    assert table.dtype == reference.dtype == np.float32
+    assert np.array_equal(table, reference)
+
+
+@pytest.mark.parametrize("precision", gainmap.PRECISIONS)
+def test_fused_headroom_matches_max_gain_ratio(precision):
+    # More pixels than one HEADROOM_CHUNK_PIXELS chunk, and a partial last chunk
+    image = synthetic_pq_image(300, 400, hot_fraction=0.01)
+    assert image.shape[0] * image.shape[1] > 1.5 * gainmap.HEADROOM_CHUNK_PIXELS
+    hdr = gainmap.pq_u16_to_absolute_nits(image)
+    sdr = np.empty(image.shape, dtype=gainmap.SDR_STORAGE[precision])
+    gainmap.store_sdr(sdr, gainmap.apply_lut(image, gainmap.load_cube_lut(gainmap.LUT_PATH)))
+
+    histogram = gainmap.log_histogram()
+    fused = gainmap.fused_max_gain_ratio(hdr, sdr, histogram)
+    assert fused == gainmap.max_gain_ratio(hdr, gainmap.srgb_to_absolute_nits(sdr))
+
+    lum_hdr = gainmap.luminance_bgr(hdr)
+    lum_sdr = gainmap.luminance_bgr(gainmap.srgb_to_absolute_nits(sdr))
+    ratio = lum_hdr / np.maximum(lum_sdr, 1e-6)
+    assert np.array_equal(histogram, gainmap.log_histogram_add(gainmap.log_histogram(), ratio))
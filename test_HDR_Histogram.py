@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+"""
+Streaming Quantile Sketch
+=========================
+
+Percentile headroom and nits come from log_histogram sketches. A quantile
+must land within one bin's relative width of np.percentile, sketches of
+strips must add up to the sketch of the whole image, q = 1 must return the
+exact maximum, and empty or all-zero input must not fail.
+
+    python -m pytest -q test_HDR_Histogram.py
+"""
+
+# ============================================================================
+# IMPORTS
+# ============================================================================
+
+import numpy as np
+import pytest
+
+import HDR_ISOGainMap as gainmap
+from HDR_Benchmark import synthetic_pq_image
+
+
+# Relative width of one bin, in stops
+BIN_STOPS = 1.0 / gainmap.LOG_HISTOGRAM_BINS_PER_STOP
+
+
+@pytest.mark.parametrize("q", [1.0, 50.0, 90.0, 99.0, 99.9])
+def test_quantile_is_within_one_bin_of_percentile(q):
+    rng = np.random.default_rng(0)
+    values = np.exp2(rng.normal(3.0, 2.0, 200_000)).astype(np.float32)
+    histogram = gainmap.log_histogram_add(gainmap.log_histogram(), values)
+    exact_max = float(values.max())
+
+    estimate = gainmap.log_histogram_quantile(histogram, q / 100.0, exact_max)
+    reference = float(np.percentile(values, q))
+    # The upper edge of the bin holding the rank: never below it, less than a bin above
+    assert -1e-6 <= np.log2(estimate) - np.log2(reference) <= BIN_STOPS + 1e-6
+
+
+def test_strip_sketches_merge_to_the_whole_image():
+    rng = np.random.default_rng(1)
+    values = np.exp2(rng.uniform(-10.0, 12.0, (300, 400))).astype(np.float32)
+    whole = gainmap.log_histogram_add(gainmap.log_histogram(), values)
+    merged = gainmap.log_histogram()
+    for top in range(0, 300, 37):
+        merged += gainmap.log_histogram_add(gainmap.log_histogram(), values[top:top + 37])
+    assert np.array_equal(merged, whole)
+
+    # The same holds for the sketches pass 1 carries across --tile-budget-mb strips
+    image = synthetic_pq_image(300, 400)
+    assert len(gainmap.image_strips(300, 400, 1.0)) > 1
+    arrays, _ = gainmap.compute_intermediates(None, image=image)
+    streamed, _ = gainmap.compute_intermediates(None, tile_budget_mb=1.0, image=image)
+    for name in ("nits_histogram", "ratio_histogram"):
+        assert np.array_equal(streamed[name], arrays[name]), name
+
+
+def test_full_quantile_returns_the_exact_max():
+    values = np.array([0.5, 3.0, 1234.5678], dtype=np.float32)
+    histogram = gainmap.log_histogram_add(gainmap.log_histogram(), values)
+    assert gainmap.log_histogram_quantile(histogram, 1.0, 1234.5678) == 1234.5678
+    # Lower quantiles are capped at it too, even in the max's own bin
+    assert gainmap.log_histogram_quantile(histogram, 0.999, 1234.5678) == 1234.5678
+
+
+def test_zero_and_empty_input():
+    zeros = gainmap.log_histogram_add(gainmap.log_histogram(), np.zeros((16, 16), dtype=np.float32))
+    assert zeros.sum() == 256 and zeros[0] == 256
+    assert gainmap.log_histogram_quantile(zeros, 0.5, 0.0) == 0.0
+
+    values = np.ones((16, 16), dtype=np.float32)
+    empty = gainmap.log_histogram_add(gainmap.log_histogram(), values[values > 1.0])
+    assert empty.sum() == 0
+    assert gainmap.log_histogram_quantile(empty, 0.5, 0.0) == 0.0
+    assert gainmap.log_histogram_quantile(empty, 0.99, 1.0) == 1.0
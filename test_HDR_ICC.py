@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+"""
+Single-Decode Equivalence
+=========================
+
+Converts one source with every ICC profile both ways, one magick process
+per profile and --single-decode (one process, +clone / -write per profile),
+and checks that every HEIC file is byte-identical. Needs a real
+ImageMagick 7 with HEIC support at HDR_ICC.MAGICK_PATH; skipped otherwise.
+
+    python -m pytest -q test_HDR_ICC.py
+"""
+
+# ============================================================================
+# IMPORTS
+# ============================================================================
+
+import shutil
+import subprocess
+
+import cv2
+import numpy as np
+import pytest
+
+import HDR_ICC
+
+
+def magick_supports_heic():
+    """Whether MAGICK_PATH is an ImageMagick build that can write HEIC."""
+    try:
+        version = subprocess.run([HDR_ICC.MAGICK_PATH, "-version"], capture_output=True, text=True)
+        formats = subprocess.run([HDR_ICC.MAGICK_PATH, "-list", "format"], capture_output=True, text=True)
+    except OSError:
+        return False
+    return ("ImageMagick" in version.stdout
+            and any(line.split()[:1] == ["HEIC*"] and "rw" in line for line in formats.stdout.splitlines()))
+
+
+pytestmark = pytest.mark.skipif(not magick_supports_heic(), reason="needs ImageMagick with HEIC support")
+
+
+def test_single_decode_matches_one_process_per_profile(tmp_path):
+    rng = np.random.default_rng(0)
+    source_dir = tmp_path / "src"
+    source_dir.mkdir()
+    source = source_dir / "frame.tif"
+    cv2.imwrite(str(source), rng.integers(0, 65536, size=(240, 320, 3), dtype=np.uint16))
+
+    outputs = HDR_ICC.convert_file(str(source), log=lambda line: None)
+    assert len(outputs) == len(HDR_ICC.ICC_PROFILES)
+    per_profile = {output: open(output, "rb").read() for output in outputs}
+    shutil.rmtree(tmp_path / "converted_with_ICC")
+
+    assert HDR_ICC.convert_file(str(source), single_decode=True, log=lambda line: None) == outputs
+    for output in outputs:
+        with open(output, "rb") as f:
+            assert f.read() == per_profile[output], output
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+"""
+Memory-Mapped Arrays
+====================
+
+With --tile-budget-mb the full-size SDR base and gain maps live in
+memory-mapped temp files (spill_array) instead of RAM, and the outputs must
+not change: a budgeted conversion is compared with an unbudgeted one. The
+same holds for an opt-in memory-mapped source (--mmap-input). --analyze maps
+the sources it can and samples them without decoding the full frame. Size
+and memory options must be positive. --precision float16 / fixed16 batches
+must stay within their rounding bounds of float32.
+
+    python -m pytest -q test_HDR_ISOGainMap.py
+"""
+
+# ============================================================================
+# IMPORTS
+# ============================================================================
+
+import contextlib
+import importlib.util
+import io
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+import HDR_ISOGainMap as gainmap
+from HDR_Benchmark import synthetic_pq_image
+
+
+BACKENDS = ["numpy"] + (["numba"] if importlib.util.find_spec("numba") else [])
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("container", ["none", "ultrahdr"])
+def test_tile_budget_spills_without_changing_outputs(tmp_path, backend, container):
+    image = synthetic_pq_image(300, 400)
+    results = {}
+    for name, tile_budget_mb in (("whole", None), ("budget", 1.0)):
+        output_dir = tmp_path / name
+        output_dir.mkdir()
+        output_file = str(output_dir / ("frame.jpg" if container == "ultrahdr" else "frame.avif"))
+        with contextlib.redirect_stdout(io.StringIO()):
+            results[name] = gainmap.convert_to_avif_gainmap("frame.tif", output_file, image=image,
+                                                            tile_budget_mb=tile_budget_mb,
+                                                            container=container, backend=backend)
+
+    assert isinstance(results["budget"]["sdr_base"], np.memmap)
+    assert isinstance(results["budget"]["gain_map"], np.memmap)
+    assert not isinstance(results["whole"]["sdr_base"], np.memmap)
+    assert np.array_equal(results["budget"]["sdr_base"], results["whole"]["sdr_base"])
+    assert np.array_equal(results["budget"]["gain_map"], results["whole"]["gain_map"])
+    for filename in os.listdir(tmp_path / "whole"):
+        with open(tmp_path / "whole" / filename, "rb") as whole, open(tmp_path / "budget" / filename, "rb") as budget:
+            assert budget.read() == whole.read(), filename
+
+
+def test_mmap_input_is_opt_in_and_matches_decoding(tmp_path):
+    assert not gainmap.parse_arguments(["frame.tif"]).mmap_input
+    assert gainmap.parse_arguments(["--mmap-input", "frame.tif"]).mmap_input
+
+    source = str(tmp_path / "frame.tif")
+    cv2.imwrite(source, synthetic_pq_image(120, 160), [cv2.IMWRITE_TIFF_COMPRESSION, 1])
+    mapped = gainmap.read_source_image(source, mmap_input=True)
+    assert isinstance(mapped.base, np.memmap)
+    assert not isinstance(gainmap.read_source_image(source).base, np.memmap)
+
+    # The code histogram counts the channel-reversed map in place
+    histogram = gainmap.add_pq_code_histogram(gainmap.log_histogram(), mapped[10:20])
+    expected = gainmap.add_pq_code_histogram(gainmap.log_histogram(), np.array(mapped[10:20]))
+    assert np.array_equal(histogram, expected)
+
+    results = {}
+    for mmap_input in (False, True):
+        with contextlib.redirect_stdout(io.StringIO()):
+            results[mmap_input] = gainmap.convert_to_avif_gainmap(source, str(tmp_path / f"{mmap_input}.avif"),
+                                                                  tile_budget_mb=1.0, mmap_input=mmap_input)
+    assert np.array_equal(results[True]["sdr_base"], results[False]["sdr_base"])
+    assert np.array_equal(results[True]["gain_map"], results[False]["gain_map"])
+
+
+def test_analysis_samples_without_a_full_decode(tmp_path):
+    image = synthetic_pq_image(240, 320)
+    mapped_source = str(tmp_path / "mapped.tif")
+    cv2.imwrite(mapped_source, image, [cv2.IMWRITE_TIFF_COMPRESSION, 1])
+    decoded_source = str(tmp_path / "decoded.tif")
+    cv2.imwrite(decoded_source, image)
+    sample_source = str(tmp_path / "sample.tif")
+    cv2.imwrite(sample_source, np.ascontiguousarray(image[::4, ::4]))
+
+    # A mappable TIFF is sampled from the map, as exactly as stride 1 of the sample
+    sample, size = gainmap.read_analysis_sample(mapped_source, 4)
+    assert isinstance(sample.base, np.memmap)
+    assert size == (240, 320)
+    mapped = gainmap.analyze_image(mapped_source)
+    exact = gainmap.analyze_image(sample_source, sample_stride=1)
+    for field in gainmap.ANALYSIS_FIELDS[5:-2]:
+        assert mapped[field] == exact[field], field
+
+    # Other files are decoded at 1/4 scale: block averages, never above the sampled peak
+    sample, size = gainmap.read_analysis_sample(decoded_source, 4)
+    assert sample.shape == (60, 80, 3) and sample.dtype == np.uint16
+    assert size == (240, 320)
+    decoded = gainmap.analyze_image(decoded_source)
+    assert (decoded["width"], decoded["height"], decoded["samples"]) == (320, 240, 60 * 80)
+    assert decoded["hdr_max_nits"] <= gainmap.analyze_image(decoded_source, sample_stride=1)["hdr_max_nits"]
+
+
+@pytest.mark.parametrize("option", ["--tile-budget-mb", "--cache-max-gb", "--pipeline-memory-mb"])
+@pytest.mark.parametrize("value", ["0", "-1"])
+def test_sizes_must_be_positive(option, value):
+    error = gainmap.argument_error(gainmap.parse_arguments([f"{option}={value}", "frame.tif"]))
+    assert error == f"{option} must be positive, got {value}"
+    assert gainmap.argument_error(gainmap.parse_arguments([f"{option}=1.5", "frame.tif"])) is None
+
+
+def test_reduced_precision_runs_end_to_end_within_bounds(tmp_path):
+    image = synthetic_pq_image(200, 300, hot_fraction=0.01)
+    results, gain_maps = {}, {}
+    for precision in gainmap.PRECISIONS:
+        source_dir = tmp_path / precision / "src"
+        source_dir.mkdir(parents=True)
+        cv2.imwrite(str(source_dir / "frame.tif"), image)
+        with contextlib.redirect_stdout(io.StringIO()):
+            assert gainmap.process_directory(str(source_dir), precision=precision) == (1, 0, 0)
+            results[precision] = gainmap.convert_to_avif_gainmap(str(source_dir / "frame.tif"),
+                                                                 str(tmp_path / f"{precision}.avif"),
+                                                                 precision=precision)
+        assert results[precision]["sdr_base"].dtype == gainmap.SDR_STORAGE[precision]
+        gain_maps[precision] = cv2.imread(str(tmp_path / precision / "converted_gainmap" / "frame_gainmap.png"),
+                                          cv2.IMREAD_UNCHANGED).astype(np.int16)
+
+    reference = results["float32"]
+    # float16 rounds to half an ulp (2^-11 relative, 2^-25 absolute below the normal range);
+    # fixed16 to half a 1/65535 step
+    bounds = {"float16": (2.0 ** -11, 2.0 ** -25), "fixed16": (0.0, 0.5 / 65535.0 + 1e-7)}
+    for precision, (rtol, atol) in bounds.items():
+        sdr_base = gainmap.sdr_as_float32(results[precision]["sdr_base"])
+        np.testing.assert_allclose(sdr_base, reference["sdr_base"], rtol=rtol, atol=atol)
+        assert results[precision]["estimated_headroom"] == pytest.approx(reference["estimated_headroom"], rel=1e-3)
+        # Only the darkest SDR pixels, whose gain the rounding moves most, change at all
+        error = np.abs(gain_maps[precision] - gain_maps["float32"])
+        assert error.max() <= 2 and error.mean() < 0.01, precision
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+"""
+3D LUT Engine Accuracy
+======================
+
+apply_lut's trilinear path must stay within LUT_ENGINE_TOLERANCE of the
+scipy reference (apply_lut_reference) on the shipped ACES LUT, for float
+inputs and for uint16 codes. Tetrahedral is a different interpolant and is
+not held to that tolerance. The --composite-lut decode table must stay
+within COMPOSITE_TOLERANCE of the float64 sRGB EOTF. The compiled .npy
+sidecar must be readable by other users and reused until the .cube changes.
+
+    python -m pytest -q test_HDR_LUT.py
+"""
+
+# ============================================================================
+# IMPORTS
+# ============================================================================
+
+import os
+import shutil
+import stat
+import tempfile
+
+import numpy as np
+import pytest
+
+import HDR_ISOGainMap as gainmap
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.uint16])
+def test_trilinear_matches_reference(dtype):
+    lut_3d = gainmap.read_cube_lut(gainmap.LUT_PATH)
+    rng = np.random.default_rng(0)
+    codes = rng.integers(0, 65536, size=(256, 256, 3), dtype=np.uint16)
+    # Grid nodes and cell edges too, where the cell index is clamped
+    codes[0, :8] = [[0, 0, 0], [65535, 65535, 65535], [0, 65535, 0], [65535, 0, 32768],
+                    [1, 1, 1], [65534, 65534, 65534], [32768, 32768, 32768], [0, 0, 65535]]
+    image = codes if dtype == np.uint16 else codes.astype(np.float32) / np.float32(65535.0)
+
+    result = gainmap.apply_lut(image, lut_3d, "trilinear")
+    reference = gainmap.apply_lut_reference(codes.astype(np.float64) / 65535.0, lut_3d)
+    assert result.dtype == np.float32
+    assert np.max(np.abs(result - reference)) <= gainmap.LUT_ENGINE_TOLERANCE
+
+
+def test_composite_decode_table_tolerance():
+    values, slopes = gainmap.composite_decode_table()
+    srgb = np.linspace(0.0, 1.0, 1_000_001, dtype=np.float32)
+    position = srgb * np.float32(len(slopes))
+    index = np.minimum(position.astype(np.intp), len(slopes) - 1)
+    baked = values[index] + slopes[index] * (position - index.astype(np.float32))
+
+    exact = srgb.astype(np.float64)
+    exact = np.where(exact <= 0.04045, exact / 12.92, ((exact + 0.055) / 1.055) ** 2.4) * gainmap.SDR_WHITE_NITS
+    np.testing.assert_allclose(baked, exact, rtol=gainmap.COMPOSITE_TOLERANCE, atol=0.0)
+
+
+def test_sidecar_is_reused_until_the_cube_changes(tmp_path, monkeypatch):
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    monkeypatch.setattr(gainmap, "_LUT_CACHE", {})
+    lut_path = str(tmp_path / "test.cube")
+    shutil.copyfile(gainmap.LUT_PATH, lut_path)
+
+    lut_3d = gainmap.load_cube_lut(lut_path)
+    sidecar = gainmap.compile_cube_lut(lut_path)
+    assert os.path.dirname(sidecar) == str(tmp_path / gainmap.LUT_CACHE_DIRNAME)
+    assert stat.S_IMODE(os.stat(sidecar).st_mode) == 0o644 & ~gainmap._umask()
+    assert np.array_equal(lut_3d, gainmap.read_cube_lut(lut_path))
+
+    parses = []
+    read_cube_lut = gainmap.read_cube_lut
+    monkeypatch.setattr(gainmap, "read_cube_lut", lambda path: parses.append(path) or read_cube_lut(path))
+
+    # A new process maps the sidecar without parsing the .cube
+    monkeypatch.setattr(gainmap, "_LUT_CACHE", {})
+    mapped = gainmap.load_cube_lut(lut_path)
+    assert isinstance(mapped, np.memmap) and mapped.filename == sidecar
+    assert parses == []
+
+    # Touching the .cube drops the loaded copy; the unchanged contents hash to the same sidecar
+    st = os.stat(lut_path)
+    os.utime(lut_path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    touched = gainmap.load_cube_lut(lut_path)
+    assert touched is not mapped and touched.filename == sidecar
+    assert parses == []
+
+    # Editing it compiles a new sidecar with the new values
+    with open(lut_path) as f:
+        text = f.read()
+    with open(lut_path, "w") as f:
+        f.write(text.replace("\n0 0 0\n", "\n0.5 0.5 0.5\n", 1))
+    edited = gainmap.load_cube_lut(lut_path)
+    assert parses == [lut_path]
+    assert edited.filename != sidecar and os.path.isfile(sidecar)
+    assert np.array_equal(edited[0, 0, 0], [0.5, 0.5, 0.5])
+    assert np.array_equal(edited[1:], lut_3d[1:])
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+"""
+Read-Ahead Budget
+=================
+
+The reader of HDR_Pipeline charges each item's estimated size to the read
+budget before it loads the item, so a decode never runs past the cap.
+
+    python -m pytest -q test_HDR_Pipeline.py
+"""
+
+# ============================================================================
+# IMPORTS
+# ============================================================================
+
+import threading
+
+import pytest
+
+import HDR_Pipeline
+
+
+def test_reader_charges_before_loading():
+    budget = HDR_Pipeline.pipeline_budget(depth=4, limit_bytes=100)
+    loading = []
+    reader, read = HDR_Pipeline.start_reader(lambda item: loading.append(item) or item, budget, lambda item: 60)
+    try:
+        first = read("a")
+        second = read("b")
+        assert first.result(timeout=5) == ("a", 60)
+
+        # 60 + 60 bytes exceed the cap: "b" may not even start loading
+        with pytest.raises(TimeoutError):
+            second.result(timeout=0.2)
+        assert loading == ["a"]
+
+        budget[1](60)
+        assert second.result(timeout=5) == ("b", 60)
+    finally:
+        HDR_Pipeline.shutdown(reader, budget)
+
+
+def test_failed_load_releases_its_charge():
+    budget = HDR_Pipeline.pipeline_budget(depth=1, limit_bytes=100)
+    released = threading.Event()
+
+    def load(item):
+        if item == "broken":
+            raise ValueError(item)
+        released.set()
+        return item
+
+    reader, read = HDR_Pipeline.start_reader(load, budget, lambda item: 80)
+    try:
+        with pytest.raises(ValueError):
+            read("broken").result(timeout=5)
+        assert read("next").result(timeout=5) == ("next", 80)
+        assert released.is_set()
+    finally:
+        HDR_Pipeline.shutdown(reader, budget)
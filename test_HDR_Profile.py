@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+"""
+Run Instrumentation
+===================
+
+File records must leave out the time a file spends suspended
+(suspend_file / resume_file), summarize must report the right latency
+percentiles, and write_metrics_textfile must emit valid Prometheus text
+exposition format: every sample under a # HELP / # TYPE of its family.
+
+    python -m pytest -q test_HDR_Profile.py
+"""
+
+# ============================================================================
+# IMPORTS
+# ============================================================================
+
+import re
+import time
+import types
+
+import numpy as np
+import pytest
+
+import HDR_Profile
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A manual perf_counter for HDR_Profile, in seconds; instrumentation on."""
+    now = [0.0]
+    monkeypatch.setattr(HDR_Profile, "time", types.SimpleNamespace(perf_counter=lambda: now[0],
+                                                                   strftime=time.strftime))
+    monkeypatch.setattr(HDR_Profile, "_enabled", True)
+    return now
+
+
+def test_suspended_time_is_not_counted(clock):
+    HDR_Profile.start_file("frame_0.tif")
+    with HDR_Profile.stage("decode"):
+        clock[0] = 3.0
+    waiting = HDR_Profile.suspend_file()
+
+    # Another file is recorded while the first waits for its window
+    HDR_Profile.start_file("frame_1.tif")
+    clock[0] = 10.0
+    other = HDR_Profile.finish_file()
+
+    HDR_Profile.resume_file(waiting)
+    with HDR_Profile.stage("gainmap_encode"):
+        clock[0] = 12.0
+    record = HDR_Profile.finish_file()
+
+    assert other["wall_s"] == 7.0
+    assert record["wall_s"] == 5.0
+    assert {name: entry["wall_s"] for name, entry in record["stages"].items()} == {"decode": 3.0,
+                                                                                 "gainmap_encode": 2.0}
+
+
+def record(wall_s, status="ok"):
+    return {"file": "frame.tif", "stages": {}, "status": status, "wall_s": wall_s, "cpu_s": 0.0,
+            "peak_rss_bytes": 0, "bytes_read": 0, "bytes_written": 0}
+
+
+def test_summary_latency_percentiles():
+    latencies = [7.0, 1.0, 9.0, 3.0, 10.0, 2.0, 8.0, 4.0, 6.0, 5.0, 30.0]
+    records = [record(wall_s, "failed" if wall_s == 30.0 else "ok") for wall_s in latencies]
+    summary = HDR_Profile.summarize(records, 20.0)
+    assert summary["latency_p50_s"] == pytest.approx(np.percentile(latencies, 50)) == 6.0
+    assert summary["latency_p95_s"] == pytest.approx(np.percentile(latencies, 95)) == 20.0
+    assert (summary["files"], summary["failed"], summary["images_per_s"]) == (11, 1, 0.55)
+    assert HDR_Profile.summarize([], 0.0)["latency_p95_s"] == 0.0
+
+
+SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{((?:[a-zA-Z_][a-zA-Z0-9_]*="[^"\\\n]*",?)*)\})? (\S+)$')
+
+
+def test_metrics_textfile_is_exposition_format(tmp_path, clock):
+    HDR_Profile.start_file("frame.tif")
+    with HDR_Profile.stage("decode"):
+        HDR_Profile.record_io(read=1000)
+        clock[0] = 0.25
+    summary = HDR_Profile.summarize([HDR_Profile.finish_file()], 0.5)
+
+    path = tmp_path / "hdr_exif.prom"
+    HDR_Profile.write_metrics_textfile(str(path), "gainmap", summary)
+    text = path.read_text()
+    assert text.endswith("\n")
+
+    helps, types_, samples = {}, {}, {}
+    for line in text.splitlines():
+        if line.startswith("# HELP "):
+            name, help_text = line[len("# HELP "):].split(" ", 1)
+            assert name not in helps and help_text
+            helps[name] = help_text
+        elif line.startswith("# TYPE "):
+            name, kind = line[len("# TYPE "):].split(" ")
+            assert name not in types_ and name not in samples and kind == "gauge"
+            types_[name] = kind
+        else:
+            match = SAMPLE.match(line)
+            assert match, line
+            name, labels, value = match.groups()
+            assert name in helps and name in types_, name
+            assert 'tool="gainmap"' in labels
+            samples.setdefault(name, []).append(float(value))
+
+    assert set(samples) == set(types_) == set(helps)
+    assert samples["hdr_exif_images_total"] == [1.0]
+    assert samples["hdr_exif_images_failed"] == [0.0]
+    assert samples["hdr_exif_images_per_second"] == [2.0]
+    assert samples["hdr_exif_latency_seconds"] == [0.25, 0.25]
+    assert samples["hdr_exif_bytes_read"] == [1000.0]
+    assert samples["hdr_exif_stage_seconds"] == [0.25]
+    assert not (tmp_path / "hdr_exif.prom.tmp").exists()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+"""
+Reduced-Resolution Gain Maps
+============================
+
+With --gainmap-scale N the linear light is area-averaged strip by strip
+(reduced_grids), which must match cv2.resize(INTER_AREA) of the whole
+frame even when --tile-budget-mb splits it into many strips. The
+--gainmap-error figures must be the error of the bilinearly upsampled map
+against the full-resolution map at the same headroom.
+
+    python -m pytest -q test_HDR_ReducedGainMap.py
+"""
+
+# ============================================================================
+# IMPORTS
+# ============================================================================
+
+import contextlib
+import io
+
+import cv2
+import numpy as np
+import pytest
+
+import HDR_ISOGainMap as gainmap
+from HDR_Benchmark import synthetic_pq_image
+
+
+@pytest.mark.parametrize("scale", [2, 4])
+def test_strip_streamed_grids_match_whole_frame_area_resize(scale):
+    height, width = 320, 400
+    arrays, stats = gainmap.compute_intermediates(None, image=synthetic_pq_image(height, width))
+    assert len(gainmap.image_strips(height, width, 0.25, align=scale)) > 4
+
+    hdr_small, sdr_small = gainmap.reduced_grids(arrays, stats, scale, tile_budget_mb=0.25)
+    hdr_full, sdr_full = gainmap._strip_linear_nits(arrays, 0, height)
+    for small, full in ((hdr_small, hdr_full), (sdr_small, sdr_full)):
+        reference = cv2.resize(full, (width // scale, height // scale), interpolation=cv2.INTER_AREA)
+        assert small.shape == reference.shape
+        np.testing.assert_allclose(small, reference, rtol=1e-5, atol=1e-4)
+
+
+def test_gain_map_error_figures():
+    full_map = np.full((40, 60), 100, dtype=np.uint8)
+    error = gainmap.gain_map_error(full_map, np.full((10, 15), 110, dtype=np.uint8))
+    assert (error["mean_abs"], error["p99_abs"], error["max_abs"]) == (10.0, 10.0, 10.0)
+    assert error["psnr_db"] == pytest.approx(10 * np.log10(255.0 ** 2 / 100.0))
+    assert gainmap.gain_map_error(full_map, full_map[::4, ::4])["psnr_db"] == float("inf")
+
+
+@pytest.mark.parametrize("scale", [2, 4])
+def test_reported_error_is_against_the_full_map_at_the_same_headroom(tmp_path, scale):
+    image = synthetic_pq_image(160, 200, noise=0.0)
+    with contextlib.redirect_stdout(io.StringIO()) as log:
+        result = gainmap.convert_to_avif_gainmap("frame.tif", str(tmp_path / "frame.avif"), image=image,
+                                                 gainmap_scale=scale, gainmap_error=True, tile_budget_mb=0.25)
+
+    arrays, stats = gainmap.compute_intermediates(None, image=image)
+    full_map, _ = gainmap.encode_full_resolution(arrays, stats, result["estimated_headroom"])
+    assert result["gain_map"].shape == gainmap.reduced_shape(160, 200, scale)
+    error = result["gainmap_error"]
+    assert error == gainmap.gain_map_error(full_map, result["gain_map"])
+    assert f"mean {error['mean_abs']:.2f}" in log.getvalue()
+    # A smooth frame loses little to the reduced grid
+    assert error["mean_abs"] < 2.0 and error["psnr_db"] > 30.0
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+"""
+Sequence Headroom
+=================
+
+With --gainmap-scale above 1 a frame of a --sequence is normalized by its
+temporal window's reduced-grid headroom, the statistic a standalone file is
+normalized by. A window of identical frames must therefore reproduce the
+standalone gain map exactly.
+
+    python -m pytest -q test_HDR_Sequence.py
+"""
+
+# ============================================================================
+# IMPORTS
+# ============================================================================
+
+import contextlib
+import io
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+import HDR_ISOGainMap as gainmap
+from HDR_Benchmark import synthetic_pq_image
+
+
+@pytest.mark.parametrize("gainmap_scale", [2, 4])
+def test_window_of_identical_frames_matches_standalone(tmp_path, gainmap_scale):
+    # A dim noisy ramp with isolated bright pixels
+    image = synthetic_pq_image(270, 480, levels=(0.2, 0.5), tint=(1.0, 1.0, 1.0), noise=0.02,
+                               hot_fraction=0.001)
+    source_dir = tmp_path / "src"
+    source_dir.mkdir()
+    filenames = [f"shot_{index:04d}.tif" for index in range(1, 4)]
+    for filename in filenames:
+        cv2.imwrite(str(source_dir / filename), image)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        standalone = gainmap.convert_to_avif_gainmap(str(source_dir / filenames[0]), str(tmp_path / "still.avif"),
+                                                     gainmap_scale=gainmap_scale)
+        converted_dir = str(tmp_path / "converted")
+        successful, failed, _ = gainmap.process_sequence(str(source_dir), "shot_####.tif", filenames,
+                                                         converted_dir, temporal_window=3,
+                                                         gainmap_scale=gainmap_scale)
+    assert (successful, failed) == (3, 0)
+
+    # The full-resolution ratios peak higher than the area-averaged grid's
+    stats = gainmap.load_intermediates(str(source_dir / filenames[0]))[1]
+    assert stats["max_gain_ratio"] > standalone["estimated_headroom"]
+
+    with open(tmp_path / "still_gainmap.png", "rb") as f:
+        expected = f.read()
+    for filename in filenames:
+        with open(os.path.join(converted_dir, filename.replace(".tif", "_gainmap.png")), "rb") as f:
+            assert f.read() == expected
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+"""
+Resident Server Round Trip
+==========================
+
+Starts `HDR_Server.py serve` on a temporary socket, submits a gainmap job
+and an icc job without waiting, polls their status until both finish, and
+checks that malformed requests get an error reply while the server keeps
+serving. The icc job only has to finish: it fails without ImageMagick.
+
+    python -m pytest -q test_HDR_Server.py
+"""
+
+# ============================================================================
+# IMPORTS
+# ============================================================================
+
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import pytest
+
+import HDR_Server
+from HDR_Benchmark import synthetic_pq_image
+
+
+TIMEOUT_S = 120
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + TIMEOUT_S
+    while time.monotonic() < deadline:
+        result = condition()
+        if result:
+            return result
+        time.sleep(0.1)
+    raise AssertionError("timed out")
+
+
+def raw_request(socket_path, payload):
+    """Send payload as is and return the server's reply."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(socket_path)
+        conn.sendall(payload)
+        return HDR_Server.receive_message(conn)
+
+
+@pytest.fixture
+def server():
+    # Unix socket paths are short (~100 bytes), so not under tmp_path
+    socket_dir = tempfile.mkdtemp(prefix="hdr_server_")
+    socket_path = os.path.join(socket_dir, "server.sock")
+    process = subprocess.Popen([sys.executable, "HDR_Server.py", "--socket", socket_path, "serve"],
+                               cwd=HDR_Server.SCRIPT_DIR, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               text=True)
+
+    def ping():
+        if process.poll() is not None:
+            raise AssertionError(f"server exited: {process.stdout.read()}")
+        try:
+            return HDR_Server.request(socket_path, {"op": "ping"})
+        except HDR_Server.NoServer:
+            return None
+
+    try:
+        wait_for(ping)
+        yield socket_path
+        assert HDR_Server.request(socket_path, {"op": "stop"})["ok"]
+        process.wait(TIMEOUT_S)
+        assert not os.path.exists(socket_path)
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        shutil.rmtree(socket_dir, ignore_errors=True)
+
+
+def test_jobs_finish_and_bad_requests_do_not_stop_the_server(tmp_path, server):
+    source_dir = tmp_path / "src"
+    source_dir.mkdir()
+    source = str(source_dir / "frame.tif")
+    cv2.imwrite(source, synthetic_pq_image(64, 80))
+
+    ids = {}
+    for mode in ("gainmap", "icc"):
+        reply = HDR_Server.request(server, {"op": "submit", "mode": mode, "input": source, "args": [],
+                                            "wait": False})
+        assert reply["ok"], reply
+        assert reply["result"]["status"] in ("queued", "running")
+        ids[mode] = reply["result"]["id"]
+    assert ids["gainmap"] != ids["icc"]
+
+    def finished(mode):
+        job = HDR_Server.request(server, {"op": "status", "job": ids[mode]})["result"]
+        return job if job["status"] in ("ok", "failed") else None
+
+    gainmap_job = wait_for(lambda: finished("gainmap"))
+    assert gainmap_job["status"] == "ok", gainmap_job["log"]
+    assert gainmap_job["outputs"] == [str(tmp_path / "converted_gainmap" / "frame.avif")]
+    assert (tmp_path / "converted_gainmap" / "frame_gainmap.png").exists()
+    assert gainmap_job["record"]["file"] == source
+    wait_for(lambda: finished("icc"))
+
+    for payload in (b"not json\n", b'{"op": "submit", "mode": "nope", "input": "/"}\n',
+                    b'{"op": "status", "job": 999999}\n', b'{"op": "explode"}\n'):
+        reply = raw_request(server, payload)
+        assert reply["ok"] is False and reply["error"], payload
+
+    state = HDR_Server.request(server, {"op": "ping"})["result"]
+    assert (state["ok"] + state["failed"], state["active"]) == (2, 0)
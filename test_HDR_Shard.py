@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+"""
+Shards and Claims
+=================
+
+HDR_Shard's static shards must cover every file exactly once, a claim must
+be won by exactly one of several processes racing for it, and a claim left
+by a crashed node must be broken once its ttl has passed (but not before).
+Same-named files in different subdirectories of a recursive batch must not
+share a claim.
+
+    python -m pytest -q test_HDR_Shard.py
+"""
+
+# ============================================================================
+# IMPORTS
+# ============================================================================
+
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import HDR_ICC
+import HDR_Shard
+
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Child process: wait for the start file, then try to claim the item once
+CLAIM_SCRIPT = """
+import os, sys, time
+import HDR_Shard
+claim_dir, name, start = sys.argv[1:]
+while not os.path.exists(start):
+    time.sleep(0.001)
+print("won" if HDR_Shard.claim(claim_dir, name) else "lost")
+"""
+
+
+@pytest.mark.parametrize("count", [1, 2, 3, 7])
+def test_shards_cover_every_file_once(count):
+    names = [f"shot_{index:04d}.tif" for index in range(500)] + ["a/b.tif", "b/a.tif", "ünïcode.tif"]
+    owners = {name: [index for index in range(1, count + 1) if HDR_Shard.in_shard(name, (index, count))]
+              for name in names}
+    assert all(len(shards) == 1 for shards in owners.values())
+    # Every shard gets work, so N nodes really split the batch
+    assert {shards[0] for shards in owners.values()} == set(range(1, count + 1))
+
+
+def test_two_processes_claim_one_file(tmp_path):
+    claim_dir = str(tmp_path / "claims")
+    start = str(tmp_path / "start")
+    children = [subprocess.Popen([sys.executable, "-c", CLAIM_SCRIPT, claim_dir, "src/frame.tif", start],
+                                 cwd=REPO_DIR, stdout=subprocess.PIPE, text=True)
+                for _ in range(2)]
+    open(start, "w").close()
+    results = sorted(child.communicate(timeout=30)[0].strip() for child in children)
+    assert results == ["lost", "won"]
+    assert os.listdir(claim_dir) == [os.path.basename(HDR_Shard.claim_path(claim_dir, "src/frame.tif"))]
+
+
+def test_live_claim_is_kept_and_stale_claim_is_broken(tmp_path):
+    claim_dir = str(tmp_path / "claims")
+    held = HDR_Shard.claim(claim_dir, "frame.tif", ttl=60)
+    assert held is not None
+    assert HDR_Shard.claim(claim_dir, "frame.tif", ttl=60) is None
+    with pytest.raises(HDR_Shard.ClaimSkipped):
+        HDR_Shard.run_claimed(claim_dir, "frame.tif", lambda: "ran", ttl=60)
+
+    # The holder crashed: its claim has not been touched for longer than ttl
+    old = time.time() - 120
+    os.utime(held, (old, old))
+    assert HDR_Shard.claim(claim_dir, "frame.tif", ttl=60) == held
+    assert time.time() - os.stat(held).st_mtime < 60
+    assert os.listdir(claim_dir) == [os.path.basename(held)]
+
+    HDR_Shard.release(held)
+    assert HDR_Shard.run_claimed(claim_dir, "frame.tif", lambda: "ran", ttl=60) == "ran"
+    assert os.listdir(claim_dir) == []
+
+
+def test_recursive_claims_keep_same_named_files_apart(tmp_path, monkeypatch):
+    source_dir = tmp_path / "src"
+    for subdir in ("a", "b"):
+        (source_dir / subdir).mkdir(parents=True)
+        (source_dir / subdir / "img.tif").write_bytes(b"")
+
+    # Stand-in for magick: write the output under its partial name, then rename
+    def convert(input_path, output_path, icc_profile_path, profile_name, env=None, log=print):
+        partial = HDR_Shard.partial_path(output_path)
+        with open(partial, "w") as f:
+            f.write(input_path)
+        os.replace(partial, output_path)
+    monkeypatch.setattr(HDR_ICC, "convert_to_heif_with_icc", convert)
+
+    successful, failed, skipped = HDR_ICC.process_directory(str(source_dir), jobs=4, recursive=True,
+                                                            claim_dir=str(tmp_path / "claims"))
+    assert (successful, failed, skipped) == (2 * len(HDR_ICC.ICC_PROFILES), 0, 0)
+    for subdir in ("a", "b"):
+        for _, profile_name in HDR_ICC.ICC_PROFILES:
+            output = tmp_path / "converted_with_ICC" / subdir / f"Src_img_SaveAs_{profile_name}.heic"
+            assert output.read_text() == str(source_dir / subdir / "img.tif")
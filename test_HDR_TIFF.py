@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+"""
+Mappable TIFF Layouts
+=====================
+
+HDR_TIFF.source_layout must accept exactly the TIFFs map_bgr can map
+without decoding: uncompressed, chunky, 16-bit RGB in this machine's byte
+order. Compressed, non-native byte order and planar files go to cv2.
+
+    python -m pytest -q test_HDR_TIFF.py
+"""
+
+# ============================================================================
+# IMPORTS
+# ============================================================================
+
+import struct
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+import HDR_TIFF
+
+
+def write_rgb16_tiff(path, rgb, byte_order="<", planar=False, compression=1):
+    """
+    Minimal classic TIFF of an (H, W, 3) uint16 RGB array: one strip right
+    after the header, then the IFD. compression is only recorded in the tag.
+    """
+    height, width = rgb.shape[:2]
+    samples = np.moveaxis(rgb, -1, 0) if planar else rgb
+    pixels = np.ascontiguousarray(samples).astype(rgb.dtype.newbyteorder(byte_order)).tobytes()
+    bits_offset = 8 + len(pixels)
+    ifd_offset = bits_offset + 6
+    entries = [
+        (HDR_TIFF.IMAGE_WIDTH, 4, 1, width),
+        (HDR_TIFF.IMAGE_LENGTH, 4, 1, height),
+        (HDR_TIFF.BITS_PER_SAMPLE, 3, 3, bits_offset),
+        (HDR_TIFF.COMPRESSION, 3, 1, compression),
+        (HDR_TIFF.PHOTOMETRIC, 3, 1, 2),
+        (HDR_TIFF.STRIP_OFFSETS, 4, 1, 8),
+        (HDR_TIFF.SAMPLES_PER_PIXEL, 3, 1, 3),
+        (HDR_TIFF.STRIP_BYTE_COUNTS, 4, 1, len(pixels)),
+        (HDR_TIFF.PLANAR_CONFIGURATION, 3, 1, 2 if planar else 1),
+    ]
+    with open(path, "wb") as f:
+        f.write((b"II" if byte_order == "<" else b"MM") + struct.pack(byte_order + "HI", 42, ifd_offset))
+        f.write(pixels)
+        f.write(struct.pack(byte_order + "3H", 16, 16, 16))
+        f.write(struct.pack(byte_order + "H", len(entries)))
+        for tag, field_type, count, value in entries:
+            field = struct.pack(byte_order + ("H2x" if field_type == 3 and count == 1 else "I"), value)
+            f.write(struct.pack(byte_order + "HHI", tag, field_type, count) + field)
+        f.write(struct.pack(byte_order + "I", 0))
+
+
+@pytest.fixture
+def rgb():
+    return np.random.default_rng(0).integers(0, 65536, size=(12, 20, 3), dtype=np.uint16)
+
+
+NATIVE = "<" if sys.byteorder == "little" else ">"
+FOREIGN = ">" if NATIVE == "<" else "<"
+
+
+def test_uncompressed_native_tiff_is_mapped(tmp_path, rgb):
+    path = str(tmp_path / "native.tif")
+    write_rgb16_tiff(path, rgb, NATIVE)
+    assert HDR_TIFF.source_layout(path) == (8, 12, 20)
+    assert np.array_equal(HDR_TIFF.map_bgr(path), rgb[..., ::-1])
+    assert np.array_equal(HDR_TIFF.map_bgr(path), cv2.imread(path, cv2.IMREAD_UNCHANGED))
+
+
+def test_opencv_uncompressed_tiff_is_mapped(tmp_path, rgb):
+    path = str(tmp_path / "opencv.tif")
+    cv2.imwrite(path, rgb[..., ::-1], [cv2.IMWRITE_TIFF_COMPRESSION, 1])
+    assert HDR_TIFF.source_layout(path) is not None
+    assert np.array_equal(HDR_TIFF.map_bgr(path), rgb[..., ::-1])
+
+
+@pytest.mark.parametrize("layout", [
+    {"compression": 5},
+    {"byte_order": FOREIGN},
+    {"planar": True},
+])
+def test_layouts_that_need_decoding_are_rejected(tmp_path, rgb, layout):
+    path = str(tmp_path / "rejected.tif")
+    write_rgb16_tiff(path, rgb, **dict({"byte_order": NATIVE}, **layout))
+    assert HDR_TIFF.source_layout(path) is None
+    assert HDR_TIFF.map_bgr(path) is None
+    # The decoded size is still known from the header for the read budget
+    assert HDR_TIFF.decoded_nbytes(path) == rgb.nbytes
+
+
+def test_opencv_compressed_tiff_is_rejected(tmp_path, rgb):
+    path = str(tmp_path / "lzw.tif")
+    cv2.imwrite(path, rgb, [cv2.IMWRITE_TIFF_COMPRESSION, 5])
+    assert HDR_TIFF.source_layout(path) is None
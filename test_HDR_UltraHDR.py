@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+"""
+Ultra HDR JPEG Layout
+=====================
+
+An Ultra HDR JPEG written by a --container ultrahdr conversion is read back
+the way a decoder would: the MPF index must locate the gain map JPEG (an
+SOI at the second entry's offset, entry sizes adding up to the file), the
+hdrgm XMP must carry the gain range of the computed headroom, and both the
+primary image and the gain map must decode.
+
+    python -m pytest -q test_HDR_UltraHDR.py
+"""
+
+# ============================================================================
+# IMPORTS
+# ============================================================================
+
+import contextlib
+import io
+import re
+import struct
+
+import cv2
+import numpy as np
+
+import HDR_ISOGainMap as gainmap
+import HDR_UltraHDR
+from HDR_Benchmark import synthetic_pq_image
+
+
+def mpf_entries(data):
+    """(attribute, size, absolute offset) of each MP entry in the APP2 MPF index."""
+    position = 2
+    while data[position] == 0xFF and data[position + 1] != 0xDA:
+        length = struct.unpack(">H", data[position + 2:position + 4])[0]
+        payload = data[position + 4:position + 2 + length]
+        if data[position + 1] == 0xE2 and payload.startswith(HDR_UltraHDR.MPF_IDENTIFIER):
+            header = position + 4 + len(HDR_UltraHDR.MPF_IDENTIFIER)
+            tiff = data[header:]
+            assert tiff[:4] == b"MM\x00\x2A"
+            ifd = struct.unpack(">I", tiff[4:8])[0]
+            count = struct.unpack(">H", tiff[ifd:ifd + 2])[0]
+            for index in range(count):
+                tag, _, size, offset = struct.unpack(">HHII", tiff[ifd + 2 + 12 * index:ifd + 14 + 12 * index])
+                if tag == 0xB002:
+                    entries = []
+                    for entry in range(size // 16):
+                        attribute, entry_size, entry_offset, _, _ = struct.unpack(
+                            ">IIIHH", tiff[offset + 16 * entry:offset + 16 * (entry + 1)])
+                        # The primary image's offset is 0, the others count from the TIFF header
+                        entries.append((attribute, entry_size, header + entry_offset if entry_offset else 0))
+                    return entries
+        position += 2 + length
+    raise AssertionError("no MPF index before the scan")
+
+
+def hdrgm(data, name):
+    return float(re.search(rf'hdrgm:{name}="([^"]+)"'.encode(), data).group(1))
+
+
+def test_ultrahdr_jpeg_indexes_and_decodes_both_images(tmp_path):
+    image = synthetic_pq_image(96, 128, levels=(0.0, 0.8), noise=0.0)
+    output_file = str(tmp_path / "frame.jpg")
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = gainmap.convert_to_avif_gainmap("frame.tif", output_file, image=image, container="ultrahdr")
+    with open(output_file, "rb") as f:
+        data = f.read()
+
+    (primary_attribute, primary_size, primary_offset), (_, gain_map_size, gain_map_offset) = mpf_entries(data)
+    assert primary_attribute == HDR_UltraHDR.MP_ATTRIBUTE_PRIMARY
+    assert primary_offset == 0
+    assert data[gain_map_offset:gain_map_offset + 2] == b"\xFF\xD8"
+    assert gain_map_offset == primary_size
+    assert primary_size + gain_map_size == len(data)
+    primary, gain_map_jpeg = data[:primary_size], data[gain_map_offset:]
+    assert re.search(rb'Item:Semantic="GainMap" Item:Mime="image/jpeg" Item:Length="(\d+)"',
+                     primary).group(1) == str(gain_map_size).encode()
+
+    # The offsets make the stored log gain at most the linear headroom
+    headroom_stops = np.log2(result["estimated_headroom"])
+    gain_map_max = hdrgm(gain_map_jpeg, "GainMapMax")
+    assert headroom_stops - 0.05 <= gain_map_max <= headroom_stops + 1e-5
+    assert gain_map_max == round(result["ultrahdr_metadata"]["gain_map_max"], 6)
+    assert hdrgm(gain_map_jpeg, "HDRCapacityMax") == gain_map_max
+    assert hdrgm(gain_map_jpeg, "GainMapMin") < 0.0 == hdrgm(gain_map_jpeg, "HDRCapacityMin")
+
+    decoded_primary = cv2.imdecode(np.frombuffer(primary, np.uint8), cv2.IMREAD_COLOR)
+    assert decoded_primary.shape == image.shape
+    expected_primary = np.clip(result["sdr_base"], 0.0, 1.0) * 255.0
+    assert np.abs(decoded_primary - expected_primary).mean() < 2.0
+
+    decoded_gain_map = cv2.imdecode(np.frombuffer(gain_map_jpeg, np.uint8), cv2.IMREAD_UNCHANGED)
+    assert decoded_gain_map.shape == image.shape[:2]
+    # Normalized to [GainMapMin, GainMapMax], so the map spans the code range
+    assert decoded_gain_map.min() <= 4 and decoded_gain_map.max() >= 251
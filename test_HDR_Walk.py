@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+"""
+Batch Walking and Resume Journal
+================================
+
+walk_images must yield the supported images in name order, directory by
+directory, entering subdirectories only with recursive and never hidden
+entries or symlinked directories; an unordered walk must find the same
+files, and largest_first must order them by size. A run interrupted while
+appending to its journal leaves a torn last line. The rerun must skip
+exactly the items whose lines are complete, and its own records must
+still parse.
+
+    python -m pytest -q test_HDR_Walk.py
+"""
+
+# ============================================================================
+# IMPORTS
+# ============================================================================
+
+import json
+import os
+
+import HDR_Walk
+
+
+EXTENSIONS = (".tif", ".tiff")
+
+
+def test_walk_filters_recurses_and_orders(tmp_path):
+    files = {"b.tif": 30, "a.TIFF": 10, "c.jpg": 5, "notes.txt": 1, ".hidden.tif": 2,
+             "sub/z.tif": 50, "sub/deeper/y.tif": 20, "sub/x.png": 3, ".cache/w.tif": 4, "sub2/v.tif": 30}
+    for path, size in files.items():
+        os.makedirs(tmp_path / os.path.dirname(path), exist_ok=True)
+        (tmp_path / path).write_bytes(b"\0" * size)
+    os.mkdir(tmp_path / "not_a_file.tif")
+    os.symlink(tmp_path / "sub", tmp_path / "linked")
+
+    flat = list(HDR_Walk.walk_images(str(tmp_path), EXTENSIONS))
+    assert flat == [("a.TIFF", 10), ("b.tif", 30)]
+
+    walked = list(HDR_Walk.walk_images(str(tmp_path), EXTENSIONS, recursive=True))
+    # A directory's files come before its subdirectories'
+    nested = [(os.path.join("sub", "z.tif"), 50), (os.path.join("sub", "deeper", "y.tif"), 20),
+              (os.path.join("sub2", "v.tif"), 30)]
+    assert walked == flat + nested
+
+    unordered = list(HDR_Walk.walk_images(str(tmp_path), EXTENSIONS, recursive=True, ordered=False))
+    assert sorted(unordered) == sorted(walked)
+
+    assert HDR_Walk.largest_first(unordered) == [nested[0], ("b.tif", 30), nested[2], nested[1], ("a.TIFF", 10)]
+
+
+def test_resume_after_torn_last_line(tmp_path):
+    path = str(tmp_path / "batch.journal")
+    done, record = HDR_Walk.open_journal(path)
+    assert done == set()
+    for item in ("a.tif", "sub/b.tif", "c.tif"):
+        record(item, status="ok")
+
+    # Crash in the middle of the fourth record
+    line = json.dumps({"item": "d.tif", "status": "ok"})
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(line[:len(line) // 2])
+
+    done, record = HDR_Walk.open_journal(path)
+    assert done == {"a.tif", "sub/b.tif", "c.tif"}
+    record("d.tif", status="ok")
+    record("e.tif", status="failed")
+
+    done, _ = HDR_Walk.open_journal(path)
+    assert done == {"a.tif", "sub/b.tif", "c.tif", "d.tif", "e.tif"}
+    with open(path, encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 6
+    last = json.loads(lines[-1])
+    assert (last["item"], last["status"]) == ("e.tif", "failed")